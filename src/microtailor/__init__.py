@@ -1,5 +1,10 @@
 """microtailor."""
 
 from ._stitcher import Stitcher
+from ._incremental import IncrementalStitcher
+from ._fusion import MosaicFuser
+from ._stack import StackStitcher
+from ._time_series import TimeSeriesStitcher
+from ._tile_source import TileSource, ArrayTileSource, CallableTileSource
 
-__all__ = ["Stitcher"]
+__all__ = ["Stitcher", "IncrementalStitcher", "MosaicFuser", "StackStitcher", "TimeSeriesStitcher", "TileSource", "ArrayTileSource", "CallableTileSource"]
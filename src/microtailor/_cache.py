@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from threading import RLock
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import numpy as np
+
+
+def _nbytes(value : Any) -> int:
+    """Estimate the memory size of a cached value in bytes."""
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return int(getattr(value, "nbytes", 0))
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a memory budget in bytes.
+
+    Parameters
+    ----------
+    max_bytes : Optional[int]
+        The memory budget. The least recently used entries are evicted when the total size
+        of the cached values exceeds the budget. If None, the cache is unbounded.
+    """
+
+    def __init__(self, max_bytes : Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self._entries : "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes : Dict[Hashable, int] = {}
+        self._total_bytes = 0
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def total_bytes(self) -> int:
+        """The total size of the cached values in bytes."""
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key : Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key : Hashable, default : Any = None) -> Any:
+        """Return the cached value and mark it as recently used."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key : Hashable, value : Any) -> None:
+        """Store a value, evicting the least recently used entries if needed.
+
+        A value larger than the whole budget is not stored.
+        """
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+            while self.max_bytes is not None and self._total_bytes > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(old_key)
+
+    def get_or_compute(self, key : Hashable, func : Callable[[], Any]) -> Any:
+        """Return the cached value, or compute and store it on a cache miss.
+
+        The computation runs outside the lock, so that several threads can compute different entries
+        at the same time.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        value = func()
+        self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the cache is copied empty, e.g. to worker processes
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.__init__(state["max_bytes"])  # type: ignore[misc]
@@ -1,42 +1,295 @@
-from pydantic import BaseModel, Extra, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from abc import ABC, abstractmethod
-from typing import Optional
-from ._typing_utils import NumArray, Float, IntArray
+from itertools import product
+from typing import Any, Dict, List, Optional, Tuple, Union
+from typing_extensions import Literal
+from ._typing_utils import NumArray, Float, FloatArray, IntArray
+from ._cache import LRUCache
+from ._tile_source import read_tile_region
 import numpy as np
-import numpy.typing as npt
 
-from ._utils import calc_phase_correlation_matrix
+from ._utils import (
+    calc_real_spectra,
+    calc_phase_correlation_matrices,
+    calc_phase_correlation_matrices_from_real_spectra,
+    SummedAreaTile,
+    find_top_peaks,
+    refine_peak_subpixel,
+    score_overlap_candidates,
+)
 
 class CandidateEstimator(ABC,BaseModel):
     @abstractmethod
     def __call__(
-            self, 
-            images : NumArray, 
+            self,
+            images : NumArray,
             pair_indices : IntArray,
-            estimated_displacement: NumArray,
-            allowed_error: Float,
-            ) -> npt.NDArray[np.float_]:
+            estimated_displacement: Optional[NumArray],
+            allowed_error: Union[Float,FloatArray],
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Estimate the candidate displacement of the image pairs.
+
+        Parameters
+        ----------
+        images : NumArray
+            The input images. The first dimension corresponds to the mosaic position.
+        pair_indices : IntArray
+            The (n_pairs, 2) array of the image indices of the pairs.
+        estimated_displacement : Optional[NumArray]
+            The (n_pairs, ndim) array of the estimated displacement of the second image with respect
+            to the first image. NaN values mean that the displacement is not estimated.
+        allowed_error : Union[Float,FloatArray]
+            The allowed error from the `estimated_displacement` in pixel, or the (n_pairs,) array of the allowed errors.
+
+        Returns
+        -------
+        candidate_displacement : FloatArray
+            The (n_pairs, ndim) array of the candidate displacement. NaN if no candidate is found.
+        extra_fields : Dict[str,NumArray]
+            The additional per-pair values to be stored in the pair dataframe.
+        """
         ...
-        
+
+    def clear_cache(self) -> None:
+        """Clear the cached values computed during a stitching run."""
+
+
+def _peak_interpretations(peak : IntArray, shape : Tuple[int,...]) -> IntArray:
+    """Enumerate the displacements consistent with a periodic phase correlation peak."""
+    return np.array(list(product(*[(p, p - n) if p > 0 else (p,) for p, n in zip(peak, shape)])))
+
+
+def _calc_search_window_slices(
+        image_shape : Tuple[int,...],
+        estimated_displacement : NumArray,
+        allowed_error : Float) -> Tuple[Tuple[slice,...],Tuple[slice,...]]:
+    """Calculate the same-sized crops of two images covering the predicted overlap and the error margin.
+
+    Parameters
+    ----------
+    image_shape : Tuple[int,...]
+        The shape of the images.
+    estimated_displacement : NumArray
+        The estimated position of the second image with respect to the first image.
+    allowed_error : Float
+        The allowed error from the `estimated_displacement` in pixel.
+
+    Returns
+    -------
+    slices1 : Tuple[slice,...]
+        The crop of the first image.
+    slices2 : Tuple[slice,...]
+        The crop of the second image. The displacement between the crops is shifted by
+        `slices2.start - slices1.start` from the full-frame displacement.
+    """
+    slices1 = []
+    slices2 = []
+    for n, d in zip(image_shape, estimated_displacement):
+        start1 = int(np.clip(np.floor(d - allowed_error), 0, n))
+        stop1 = int(np.clip(np.ceil(n + d + allowed_error), 0, n))
+        start2 = int(np.clip(np.floor(-d - allowed_error), 0, n))
+        stop2 = int(np.clip(np.ceil(n - d + allowed_error), 0, n))
+        length = max(stop1 - start1, stop2 - start2, 1)
+        start1 = min(start1, n - length)
+        start2 = min(start2, n - length)
+        slices1.append(slice(start1, start1 + length))
+        slices2.append(slice(start2, start2 + length))
+    return tuple(slices1), tuple(slices2)
+
 
 class PhaseCorrelationEstimator(CandidateEstimator):
     num_candidates :int  = Field(5,description="number of candidate points")
+    peak_suppression_radius : int = Field(1,
+        description="The radius of the non-maximum suppression of the phase correlation peaks, so that the candidates "
+        + "are the distinct peaks. Set 0 to disable the suppression and take the highest pixels, "
+        + "which keeps the neighbors of a split peak as candidates.")
+    min_overlap_ratio : float = Field(0.05,
+        description="The minimum overlap area ratio of the displacement candidates.")
+    fft_cache_bytes : Optional[int] = Field(2**30,
+        description="The memory budget in bytes for the cached tile spectra. If None, the cache is unbounded.")
+    crop_to_overlap : bool = Field(False,
+        description="If True, correlate only the overlap region predicted by the estimated displacement "
+        + "expanded by the allowed error, instead of the full frames.")
+    precision : Literal["float32","float64"] = Field("float32",
+        description="The working precision of the Fourier transforms.")
+    batch_size : int = Field(16, description="The number of pairs correlated in a single batched transform.")
+    workers : Optional[int] = Field(None, description="The number of workers for scipy.fft. If None, a single worker is used.")
+    sat_cache_bytes : Optional[int] = Field(2**30,
+        description="The memory budget in bytes for the cached summed-area tables used to rank the candidates. "
+        + "If None, the cache is unbounded.")
+    upsample_factor : int = Field(1,
+        description="If larger than 1, the best candidate of each pair is refined to 1 / upsample_factor pixel "
+        + "by the upsampled DFT of the cached tile spectra.")
+    _spectrum_cache : LRUCache = PrivateAttr()
+    _sat_cache : LRUCache = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._spectrum_cache = LRUCache(self.fft_cache_bytes)
+        self._sat_cache = LRUCache(self.sat_cache_bytes)
+
+    def clear_cache(self) -> None:
+        self._spectrum_cache.clear()
+        self._sat_cache.clear()
+
+    def _tile_spectra(self, images : NumArray, indices : IntArray) -> Dict[int,NumArray]:
+        """Return the real-input spectra of the tiles, transforming the uncached tiles in one batch."""
+        spectra = {}
+        missing = []
+        for index in np.unique(indices).tolist():
+            spectrum = self._spectrum_cache.get(index)
+            if spectrum is None:
+                missing.append(index)
+            else:
+                spectra[index] = spectrum
+        self._spectrum_cache.hits += len(spectra)
+        self._spectrum_cache.misses += len(missing)
+        if missing:
+            missing_spectra = calc_real_spectra(
+                np.stack([images[index] for index in missing]), self.precision, self.workers)
+            for index, spectrum in zip(missing, missing_spectra):
+                self._spectrum_cache.put(index, spectrum)
+                spectra[index] = spectrum
+        return spectra
 
-    def __call__(self, 
-            images : NumArray, 
+    def _summed_area_tiles(self,
+            images : NumArray,
+            pair : IntArray,
+            estimated : Optional[NumArray],
+            allowed_error : Float) -> Tuple[SummedAreaTile,SummedAreaTile]:
+        """Return the summed-area tiles of a pair, cropped to the search window if `crop_to_overlap` is True."""
+        if self.crop_to_overlap and estimated is not None:
+            image_shape = tuple(images.shape[1:])
+            return tuple(  # type: ignore[return-value]
+                SummedAreaTile(read_tile_region(images, index, slices), [s.start for s in slices])
+                for index, slices in zip(pair, _calc_search_window_slices(image_shape, estimated, allowed_error)))
+        return tuple(  # type: ignore[return-value]
+            self._sat_cache.get_or_compute(int(index), lambda: SummedAreaTile(images[index])) for index in pair)
+
+    def _refine_subpixel(self,
+            images : NumArray,
+            pair : IntArray,
+            displacement : NumArray,
+            estimated : Optional[NumArray],
+            allowed_error : Float) -> FloatArray:
+        """Refine the displacement of a pair from the tile spectra, or from the spectra of the crops if `crop_to_overlap` is True."""
+        image_shape = tuple(images.shape[1:])
+        if self.crop_to_overlap and estimated is not None:
+            slices1, slices2 = _calc_search_window_slices(image_shape, estimated, allowed_error)
+            offset = np.array([s1.start - s2.start for s1, s2 in zip(slices1, slices2)])
+            F1, F2 = calc_real_spectra(
+                np.stack([read_tile_region(images, pair[0], slices1), read_tile_region(images, pair[1], slices2)]),
+                self.precision, self.workers)
+            peak, _ = refine_peak_subpixel(F1, F2, tuple(s.stop - s.start for s in slices1),
+                                           displacement - offset, self.upsample_factor)
+            return peak + offset
+        spectra = self._tile_spectra(images, pair)
+        peak, _ = refine_peak_subpixel(spectra[int(pair[0])], spectra[int(pair[1])], image_shape,
+                                       displacement, self.upsample_factor)
+        return peak
+
+    def _phase_correlation_matrices(self,
+            images : NumArray,
             pair_indices : IntArray,
-            estimated_positions : Optional[NumArray],
-            allowed_error: Float,) -> npt.NDArray[np.float_]:
-        
-        for pair_index in pair_indices:
-            images = images[pair_index]
-            assert len(images) == 2
-            pcm = calc_phase_correlation_matrix(
-                images[0],images[1]
+            estimated_displacements : List[Optional[NumArray]],
+            allowed_errors : FloatArray) -> List[Tuple[FloatArray,IntArray]]:
+        """Compute the phase correlation matrices of the pairs and the offsets of their origins from the full frames."""
+        image_shape = tuple(images.shape[1:])
+        results : List[Tuple[FloatArray,IntArray]] = [None] * len(pair_indices)  # type: ignore
+        full_frame = []
+        cropped : Dict[Tuple[int,...],List[Tuple[int,Tuple[slice,...],Tuple[slice,...]]]] = {}
+        for j, estimated in enumerate(estimated_displacements):
+            if self.crop_to_overlap and estimated is not None:
+                slices1, slices2 = _calc_search_window_slices(image_shape, estimated, allowed_errors[j])
+                crop_shape = tuple(s.stop - s.start for s in slices1)
+                cropped.setdefault(crop_shape, []).append((j, slices1, slices2))
+            else:
+                full_frame.append(j)
+
+        if full_frame:
+            spectra = self._tile_spectra(images, pair_indices[full_frame])
+            pcms = calc_phase_correlation_matrices_from_real_spectra(
+                np.stack([spectra[int(pair_indices[j,0])] for j in full_frame]),
+                np.stack([spectra[int(pair_indices[j,1])] for j in full_frame]),
+                image_shape,
+                self.workers,
             )
-            row, col = np.unravel_index(np.argsort(pcm.ravel(),), pcm.shape)
+            offset = np.zeros(len(image_shape), dtype=np.int64)
+            for j, pcm in zip(full_frame, pcms):
+                results[j] = (pcm, offset)
+
+        for crop_shape, entries in cropped.items():
+            pcms = calc_phase_correlation_matrices(
+                np.stack([read_tile_region(images, pair_indices[j,0], slices1) for j, slices1, _ in entries]),
+                np.stack([read_tile_region(images, pair_indices[j,1], slices2) for j, _, slices2 in entries]),
+                self.precision,
+                self.workers,
+            )
+            for (j, slices1, slices2), pcm in zip(entries, pcms):
+                results[j] = (pcm, np.array([s1.start - s2.start for s1, s2 in zip(slices1, slices2)]))
+        return results
+
+    def __call__(self,
+            images : NumArray,
+            pair_indices : IntArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error: Union[Float,FloatArray],) -> Tuple[FloatArray, Dict[str,NumArray]]:
+
+        pair_indices = np.asarray(pair_indices)
+        allowed_errors = np.broadcast_to(np.asarray(allowed_error, dtype=np.float64), (len(pair_indices),))
+        image_shape = np.array(images.shape[1:])
+        candidate_displacement = np.full((len(pair_indices), len(image_shape)), np.nan)
+        nccs = np.full(len(pair_indices), np.nan)
+
+        def estimated_displacement_of(j : int) -> Optional[NumArray]:
+            if estimated_displacement is None or np.any(np.isnan(estimated_displacement[j])):
+                return None
+            return estimated_displacement[j]
+
+        for batch_start in range(0, len(pair_indices), self.batch_size):
+            batch = np.arange(batch_start, min(batch_start + self.batch_size, len(pair_indices)))
+            estimates = [estimated_displacement_of(j) for j in batch]
+            pcms = self._phase_correlation_matrices(images, pair_indices[batch], estimates, allowed_errors[batch])
+            candidate_pairs = []
+            candidates = []
+            for j, estimated, (pcm, offset) in zip(batch, estimates, pcms):
+                allowed_error = allowed_errors[j]
+                window = None if estimated is None else (
+                    np.ceil(estimated - allowed_error - offset), np.floor(estimated + allowed_error - offset))
+                peaks = find_top_peaks(pcm, self.num_candidates, self.peak_suppression_radius, window)
+                if len(peaks) == 0:
+                    continue
+                displacements = np.concatenate([_peak_interpretations(peak, pcm.shape) for peak in peaks]) + offset
+                if estimated is not None:
+                    within = np.all(np.abs(displacements - estimated) <= allowed_error, axis=1)
+                    displacements = displacements[within]
+                overlap_ratios = np.prod(np.clip(1 - np.abs(displacements) / image_shape, 0, None), axis=1)
+                displacements = displacements[overlap_ratios >= self.min_overlap_ratio]
+                if len(displacements) == 0:
+                    continue
+                candidate_pairs.append(np.full(len(displacements), j))
+                candidates.append(displacements)
+            if not candidates:
+                continue
+            candidate_pairs = np.concatenate(candidate_pairs)
+            candidates = np.concatenate(candidates)
+
+            # score all the candidates of the batch at once, then take the best candidate of each pair
+            scores = score_overlap_candidates(
+                lambda j: self._summed_area_tiles(images, pair_indices[j], estimated_displacement_of(j), allowed_errors[j]),
+                candidate_pairs, candidates, tuple(image_shape))
+            order = np.lexsort((-scores, candidate_pairs))
+            best = order[np.r_[True, candidate_pairs[order][1:] != candidate_pairs[order][:-1]]]
+            candidate_displacement[candidate_pairs[best]] = candidates[best]
+            nccs[candidate_pairs[best]] = np.where(np.isfinite(scores[best]), scores[best], np.nan)
+
+            if self.upsample_factor > 1:
+                for j in candidate_pairs[best]:
+                    candidate_displacement[j] = self._refine_subpixel(
+                        images, pair_indices[j], candidate_displacement[j], estimated_displacement_of(j), allowed_errors[j])
+        return candidate_displacement, {"ncc" : nccs}
 
 
 candidate_estimators={
     "phase_correlation" : PhaseCorrelationEstimator,
-}
\ No newline at end of file
+}
@@ -0,0 +1,323 @@
+from pydantic import BaseModel, Extra, Field
+from typing import Any, List, Optional, Tuple, Union
+from typing_extensions import Literal
+import numpy as np
+import pandas as pd
+
+from ._multiscale import MultiscaleWriter
+from ._parallel import map_chunks
+from ._stitcher import _position_columns
+from ._tile_source import CachedTileSource, StackTileSource, SubsetTileSource, TileSource, TileSourceLike, as_tile_source, downsample_mean, read_tile_region
+from ._typing_utils import FloatArray, IntArray, NumArray
+
+
+def _as_positions(positions : Union[pd.DataFrame,NumArray], ndim : int) -> FloatArray:
+    """Convert the positions returned by `Stitcher.stitch` or an (n_tiles, ndim) array to a float array."""
+    if isinstance(positions, pd.DataFrame):
+        return positions[_position_columns(ndim)].to_numpy(dtype=np.float64)
+    return np.asarray(positions, dtype=np.float64).reshape(-1, ndim)
+
+
+def mosaic_geometry(positions : NumArray, tile_shape : Tuple[int,...]) -> Tuple[IntArray, Tuple[int,...]]:
+    """Calculate the integer tile offsets in the mosaic and the mosaic shape.
+
+    Parameters
+    ----------
+    positions : NumArray
+        The (..., n_tiles, ndim) array of the tile positions in pixel. The positions are rounded to the nearest pixel.
+        The leading axes, if any, index the images of a stack sharing the mosaic geometry.
+    tile_shape : Tuple[int,...]
+        The shape of a single tile.
+
+    Returns
+    -------
+    offsets : IntArray
+        The array of the tile offsets from the mosaic origin, the minimum position, with the shape of `positions`.
+    mosaic_shape : Tuple[int,...]
+        The shape of the mosaic.
+    """
+    rounded = np.round(np.asarray(positions, dtype=np.float64)).astype(np.int64)
+    ndim = rounded.shape[-1]
+    offsets = rounded - rounded.reshape(-1, ndim).min(axis=0)
+    mosaic_shape = tuple(int(n) for n in (offsets + np.array(tile_shape)).reshape(-1, ndim).max(axis=0))
+    return offsets, mosaic_shape
+
+
+def blending_weights(tile_shape : Tuple[int,...], blending : str) -> FloatArray:
+    """Calculate the per-pixel blending weights of a tile.
+
+    Parameters
+    ----------
+    tile_shape : Tuple[int,...]
+        The shape of a single tile.
+    blending : str
+        Either "average" for the uniform weights or "linear" for the weights increasing linearly from the tile edges.
+
+    Returns
+    -------
+    weights : FloatArray
+        The float32 weights with the shape of the tile.
+    """
+    if blending == "average":
+        return np.ones(tile_shape, dtype=np.float32)
+    if blending != "linear":
+        raise ValueError(f"Unknown blending method {blending}.")
+    weights = np.ones(tile_shape, dtype=np.float32)
+    for axis, n in enumerate(tile_shape):
+        ramp = np.minimum(np.arange(n) + 1, n - np.arange(n)).astype(np.float32)
+        weights *= ramp.reshape((-1,) + (1,) * (len(tile_shape) - axis - 1))
+    return weights
+
+
+def block_slices(mosaic_shape : Tuple[int,...], block_shape : Tuple[int,...]) -> List[Tuple[slice,...]]:
+    """Split the mosaic into blocks in the C order."""
+    starts = np.stack(np.meshgrid(*[np.arange(0, n, b) for n, b in zip(mosaic_shape, block_shape)], indexing="ij"),
+                      axis=-1).reshape(-1, len(mosaic_shape))
+    return [tuple(slice(int(s), int(min(s + b, n))) for s, b, n in zip(start, block_shape, mosaic_shape)) for start in starts]
+
+
+def fuse_block(
+    images : TileSource,
+    offsets : IntArray,
+    weights : FloatArray,
+    block : Tuple[slice,...],
+    ) -> FloatArray:
+    """Blend the tiles intersecting a block of the mosaic.
+
+    Only the regions of the tiles inside the block are read. The pixels without tiles are zero.
+
+    Parameters
+    ----------
+    images : TileSource
+        The tiles.
+    offsets : IntArray
+        The (n_tiles, ndim) array of the tile offsets in the mosaic.
+    weights : FloatArray
+        The blending weights of a tile.
+    block : Tuple[slice,...]
+        The region of the mosaic.
+
+    Returns
+    -------
+    fused : FloatArray
+        The float32 blended block.
+    """
+    tile_shape = np.array(weights.shape)
+    block_start = np.array([s.start for s in block])
+    block_stop = np.array([s.stop for s in block])
+    block_shape = tuple(block_stop - block_start)
+    intersecting = np.nonzero(np.all((offsets < block_stop) & (offsets + tile_shape > block_start), axis=1))[0]
+
+    fused = np.zeros(block_shape, dtype=np.float32)
+    total_weights = np.zeros(block_shape, dtype=np.float32)
+    for index in intersecting:
+        start = np.maximum(offsets[index], block_start)
+        stop = np.minimum(offsets[index] + tile_shape, block_stop)
+        tile_region = tuple(slice(int(a), int(b)) for a, b in zip(start - offsets[index], stop - offsets[index]))
+        block_region = tuple(slice(int(a), int(b)) for a, b in zip(start - block_start, stop - block_start))
+        tile_weights = weights[tile_region]
+        fused[block_region] += tile_weights * read_tile_region(images, index, tile_region)
+        total_weights[block_region] += tile_weights
+    np.divide(fused, total_weights, out=fused, where=total_weights > 0)
+    return fused
+
+
+def _cast_block(block : FloatArray, dtype : np.dtype) -> NumArray:
+    """Cast a fused block to the output dtype, rounding and clipping for the integer dtypes."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.round(block), info.min, info.max).astype(dtype)
+    return block.astype(dtype)
+
+
+class MosaicFuser(BaseModel, extra=Extra.forbid):
+    """Fuse the stitched tiles into a mosaic block by block.
+
+    Each block of the output is blended from the tiles intersecting it and written before the next one, so that
+    the mosaic is never held in memory. The blocks are processed in parallel threads.
+    """
+    block_shape : Optional[Tuple[int,...]] = Field(None,
+        description="The shape of the output blocks. If None, 1024 pixels along each axis. "
+        + "Set it to the chunk shape of a chunked output.")
+    blending : Literal["linear","average"] = Field("linear",
+        description="The blending of the overlapping tiles, either linear (feathering from the tile edges) or average.")
+    dtype : Optional[str] = Field(None, description="The output dtype. If None, the dtype of the tiles.")
+    n_jobs : int = Field(1,
+        description="The number of threads writing the blocks. Negative values are counted back from the number of CPUs.")
+    tile_cache_bytes : Optional[int] = Field(2**30,
+        description="The memory budget in bytes for the cache of the recently read tiles. If 0, tiles are not cached.")
+
+    def _block_shape(self, ndim : int) -> Tuple[int,...]:
+        if self.block_shape is None:
+            return (1024,) * ndim
+        if len(self.block_shape) != ndim:
+            raise ValueError("block_shape must have the dimension same as the images.")
+        return tuple(self.block_shape)
+
+    def fuse(self,
+             images : TileSourceLike,
+             positions : Union[pd.DataFrame,NumArray],
+             output : Optional[Union[str,Any]] = None,
+             ) -> NumArray:
+        """Fuse the tiles into a mosaic.
+
+        Parameters
+        ----------
+        images : TileSourceLike
+            The tiles. See `Stitcher.stitch` for the accepted types.
+        positions : Union[pd.DataFrame,NumArray]
+            The tile positions, either the `positions_df` returned by `Stitcher.stitch` or an (n_tiles, ndim) array.
+        output : Optional[Union[str,Any]], optional
+            The output. Either a path of the `.npy` file to create as a memory map, an array-like object
+            with the mosaic shape supporting the assignment to slices (e.g. a zarr or h5py dataset),
+            or None to return an in-memory array.
+
+        Returns
+        -------
+        mosaic : NumArray
+            The fused mosaic, i.e. the memory map, `output`, or the in-memory array.
+        """
+        images, offsets, mosaic_shape, dtype, weights = self._prepare(images, positions)
+        mosaic = self._open_output(output, mosaic_shape, dtype)
+        blocks = block_slices(mosaic_shape, self._block_shape(len(mosaic_shape)))
+
+        def write_blocks(chunk : IntArray) -> None:
+            for b in chunk:
+                mosaic[blocks[b]] = _cast_block(fuse_block(images, offsets, weights, blocks[b]), dtype)
+
+        map_chunks(write_blocks, len(blocks), self.n_jobs, "thread")
+        if isinstance(mosaic, np.memmap):
+            mosaic.flush()
+        return mosaic
+
+    def fuse_stack(self,
+             stack : Any,
+             positions : NumArray,
+             output : Optional[Union[str,Any]] = None,
+             ) -> NumArray:
+        """Fuse all the images of a multichannel or time-lapse stack as one streaming job.
+
+        The blocks of all the images are written by the same pool of threads, in the C order of the stack
+        indices and the blocks, and the images share the mosaic origin and shape.
+
+        Parameters
+        ----------
+        stack : Any
+            The array-like stack of the tiles with the shape (n_tiles, *stack_shape, *tile_shape).
+        positions : NumArray
+            The (*stack_shape, n_tiles, ndim) array of the tile positions of each image, e.g. returned by
+            `StackStitcher.stitch`.
+        output : Optional[Union[str,Any]], optional
+            The output with the shape (*stack_shape, *mosaic_shape). See `fuse` for the accepted types.
+
+        Returns
+        -------
+        mosaic : NumArray
+            The fused mosaics, i.e. the memory map, `output`, or the in-memory array.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        source = StackTileSource(stack, positions.ndim - 2)
+        stack_shape = source.stack_shape
+        if positions.shape[:-1] != stack_shape + (source.n_tiles,) or positions.shape[-1] != len(source.tile_shape):
+            raise ValueError(f"positions must have the shape {stack_shape + (source.n_tiles, len(source.tile_shape))}.")
+        images, offsets, mosaic_shape, dtype, weights = self._prepare(source, positions.reshape(-1, positions.shape[-1]))
+        offsets = offsets.reshape(-1, source.n_tiles, offsets.shape[-1])
+        mosaic = self._open_output(output, stack_shape + mosaic_shape, dtype)
+        blocks = block_slices(mosaic_shape, self._block_shape(len(mosaic_shape)))
+
+        def write_blocks(chunk : IntArray) -> None:
+            for item in chunk:
+                s, b = divmod(int(item), len(blocks))
+                stack_index = tuple(int(i) for i in np.unravel_index(s, stack_shape))
+                image = SubsetTileSource(images, source.image_indices(stack_index))
+                mosaic[stack_index + blocks[b]] = _cast_block(fuse_block(image, offsets[s], weights, blocks[b]), dtype)
+
+        map_chunks(write_blocks, len(offsets) * len(blocks), self.n_jobs, "thread")
+        if isinstance(mosaic, np.memmap):
+            mosaic.flush()
+        return mosaic
+
+    def fuse_multiscale(self,
+             images : TileSourceLike,
+             positions : Union[pd.DataFrame,NumArray],
+             path : str,
+             n_levels : int,
+             ) -> MultiscaleWriter:
+        """Fuse the tiles into a chunked multiscale store in a single streaming pass.
+
+        The chunks of the coarsest level are processed in parallel. Each of them is cascaded depth-first
+        from the full-resolution blocks under it: every chunk is written as soon as it is fused or
+        downsampled from the chunks of the previous level held in memory, so that no level is read back.
+
+        Parameters
+        ----------
+        images : TileSourceLike
+            The tiles. See `Stitcher.stitch` for the accepted types.
+        positions : Union[pd.DataFrame,NumArray]
+            The tile positions, either the `positions_df` returned by `Stitcher.stitch` or an (n_tiles, ndim) array.
+        path : str
+            The directory of the store. See `MultiscaleWriter` for the layout.
+        n_levels : int
+            The number of the levels including the full resolution. Each level halves the previous one.
+            The chunk shape is `block_shape`.
+
+        Returns
+        -------
+        writer : MultiscaleWriter
+            The writer of the store, describing the level shapes.
+        """
+        images, offsets, mosaic_shape, dtype, weights = self._prepare(images, positions)
+        writer = MultiscaleWriter(path, mosaic_shape, self._block_shape(len(mosaic_shape)), dtype, n_levels)
+        chunk_shape = np.array(writer.chunk_shape)
+
+        def cascade(level : int, chunk_index : Tuple[int,...]) -> FloatArray:
+            region = writer.chunk_slices(level, chunk_index)
+            if level == 0:
+                fused = fuse_block(images, offsets, weights, region)
+            else:
+                # the region of the previous level, including the trailing odd pixel at the edges
+                child_shape = writer.shapes[level - 1]
+                child_start = np.array([2 * s.start for s in region])
+                child_stop = np.array([n if s.stop == m else 2 * s.stop
+                                       for s, n, m in zip(region, child_shape, writer.shapes[level])])
+                children = np.zeros(tuple(child_stop - child_start), dtype=np.float32)
+                first = child_start // chunk_shape
+                last = -(-child_stop // chunk_shape)
+                for child_index in np.ndindex(*(last - first)):
+                    child_index = tuple(int(i) for i in first + np.array(child_index))
+                    child_region = writer.chunk_slices(level - 1, child_index)
+                    children[tuple(slice(s.start - a, s.stop - a) for s, a in zip(child_region, child_start))] = \
+                        cascade(level - 1, child_index)
+                fused = downsample_mean(children, 2)
+            writer.write_chunk(level, chunk_index, _cast_block(fused, dtype))
+            return fused
+
+        top_level = n_levels - 1
+        top_chunks = list(np.ndindex(*writer.chunk_grid(top_level)))
+
+        def write_chunks(chunk : IntArray) -> None:
+            for c in chunk:
+                cascade(top_level, top_chunks[c])
+
+        map_chunks(write_chunks, len(top_chunks), self.n_jobs, "thread")
+        return writer
+
+    def _open_output(self, output : Optional[Union[str,Any]], shape : Tuple[int,...], dtype : np.dtype) -> Any:
+        if output is None:
+            return np.zeros(shape, dtype=dtype)
+        if isinstance(output, str):
+            return np.lib.format.open_memmap(output, mode="w+", dtype=dtype, shape=shape)
+        if tuple(output.shape) != shape:
+            raise ValueError(f"the output shape {tuple(output.shape)} differs from the mosaic shape {shape}.")
+        return output
+
+    def _prepare(self,
+                 images : TileSourceLike,
+                 positions : Union[pd.DataFrame,NumArray],
+                 ) -> Tuple[TileSource, IntArray, Tuple[int,...], np.dtype, FloatArray]:
+        images = as_tile_source(images, n_tiles=len(positions))
+        offsets, mosaic_shape = mosaic_geometry(_as_positions(positions, images.ndim - 1), images.tile_shape)
+        dtype = np.dtype(self.dtype) if self.dtype is not None else images.dtype
+        if self.tile_cache_bytes != 0:
+            images = CachedTileSource(images, self.tile_cache_bytes)
+        return images, offsets, mosaic_shape, dtype, blending_weights(images.tile_shape, self.blending)
@@ -1,23 +1,269 @@
+from pydantic import BaseModel, Field
 from abc import ABC, abstractmethod
-from enum import Enum
-import pandas as pd
+from inspect import signature
+from typing import Optional, Tuple
+from typing_extensions import Literal
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as splinalg
+from ._typing_utils import NumArray, Float, FloatArray, IntArray
 
-class GlobalOptimizer(ABC):
+# scipy renamed the relative tolerance of cg from tol to rtol
+_CG_TOL_KEYWORD = "rtol" if "rtol" in signature(splinalg.cg).parameters else "tol"
+
+class GlobalOptimizer(ABC,BaseModel):
     @abstractmethod
-    def __call__(self, positions, ) -> pd.DataFrame:
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Float,
+            initial_positions : Optional[NumArray] = None,
+            weights : Optional[NumArray] = None,
+            ) -> FloatArray:
+        """Optimize the tile positions from the pair displacements.
+
+        Parameters
+        ----------
+        images : NumArray
+            The input images. The first dimension corresponds to the mosaic position.
+        pair_indices : IntArray
+            The (n_pairs, 2) array of the image indices of the pairs.
+        displacement : NumArray
+            The (n_pairs, ndim) array of the locally optimized displacement.
+        estimated_displacement : Optional[NumArray]
+            The (n_pairs, ndim) array of the estimated displacement. NaN values mean that the displacement
+            is not estimated.
+        allowed_error : Float
+            The allowed error from the `estimated_displacement` in pixel.
+        initial_positions : Optional[NumArray], optional
+            The (n_tiles, ndim) array of the positions to warm-start the optimization, e.g. the previous
+            solution of an incremental run. NaN values mean that the position is unknown.
+        weights : Optional[NumArray], optional
+            The (n_pairs,) array of the confidence of the displacements, e.g. the normalized cross correlation.
+            If None, all the pairs are weighted equally.
+
+        Returns
+        -------
+        positions : FloatArray
+            The (n_tiles, ndim) array of the tile positions. The pairs without a valid displacement fall back to
+            `estimated_displacement`. The tiles which are still not connected to the largest component
+            (or to the tiles with `initial_positions`) cannot be placed and are NaN.
+        """
         ...
 
+def _accumulate_along_tree(predecessors : IntArray, steps : FloatArray) -> FloatArray:
+    """Accumulate the steps from the roots of a tree by pointer jumping.
+
+    Parameters
+    ----------
+    predecessors : IntArray
+        The predecessor of each node, negative for the roots.
+    steps : FloatArray
+        The (n_nodes, ndim) array of the displacement of each node from its predecessor (zero for the roots).
+
+    Returns
+    -------
+    positions : FloatArray
+        The (n_nodes, ndim) array of the positions relative to the roots.
+    """
+    positions = steps.copy()
+    ancestors = predecessors.copy()
+    has_ancestor = ancestors >= 0
+    while np.any(has_ancestor):
+        positions[has_ancestor] += positions[ancestors[has_ancestor]]
+        ancestors[has_ancestor] = ancestors[ancestors[has_ancestor]]
+        has_ancestor = ancestors >= 0
+    return positions
+
+
+def _fill_with_estimates(
+        displacement : FloatArray,
+        estimated_displacement : Optional[NumArray],
+        weights : FloatArray) -> Tuple[FloatArray, np.ndarray, np.ndarray]:
+    """Fill the pair displacements which are NaN (or have NaN weights) with the estimated displacements.
+
+    Returns the filled displacements, the mask of the valid pairs and the mask of the pairs filled by the estimates.
+    """
+    valid = ~np.any(np.isnan(displacement), axis=1) & ~np.isnan(weights)
+    if estimated_displacement is None:
+        return displacement, valid, np.zeros(len(displacement), dtype=bool)
+    estimated_displacement = np.asarray(estimated_displacement, dtype=np.float64)
+    estimated = ~valid & ~np.any(np.isnan(estimated_displacement), axis=1)
+    return np.where(estimated[:,np.newaxis], estimated_displacement, displacement), valid, estimated
+
+def _unplaced_tiles(n_tiles : int, pair_indices : IntArray, initial_positions : Optional[NumArray]) -> np.ndarray:
+    """Find the tiles which the pairs do not connect to the tiles with `initial_positions`, or to the largest component
+    if no initial position is known."""
+    graph = sparse.csr_matrix((np.ones(len(pair_indices)), (pair_indices[:,0], pair_indices[:,1])), shape=(n_tiles, n_tiles))
+    n_components, labels = csgraph.connected_components(graph, directed=False)
+    placed = np.zeros(n_components, dtype=bool)
+    known = np.zeros(n_tiles, dtype=bool) if initial_positions is None \
+        else ~np.any(np.isnan(np.asarray(initial_positions, dtype=np.float64)), axis=1)
+    if np.any(known):
+        placed[labels[known]] = True
+    else:
+        placed[np.argmax(np.bincount(labels, minlength=n_components))] = True
+    return ~placed[labels]
+
+
 class MaximumSpanningTreeOptimizer(GlobalOptimizer):
-    def __call__(self, positions, ) -> pd.DataFrame:
-        ...
+    """Tile positions accumulated along the maximum spanning tree of the pair graph weighted by the pair confidence.
+
+    The estimated displacements of the invalid pairs are the edges of the lowest confidence,
+    so that they join the tree only where no valid pair connects the tiles.
+    """
+
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Float,
+            initial_positions : Optional[NumArray] = None,
+            weights : Optional[NumArray] = None,
+            ) -> FloatArray:
+        n_tiles = images.shape[0]
+        pair_indices = np.asarray(pair_indices)
+        displacement = np.asarray(displacement, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(len(pair_indices))
+        weights = np.asarray(weights, dtype=np.float64)
+        displacement, valid, estimated = _fill_with_estimates(displacement, estimated_displacement, weights)
+        if not np.any(valid):
+            raise RuntimeError("There is no valid pair displacement.")
+        pair_ids = np.nonzero(valid | estimated)[0]
+
+        # negate the weights (shifted to be nonzero) to get the maximum tree as the minimum tree,
+        # with the estimated pairs costing more than all the valid pairs
+        costs = np.where(valid[pair_ids], -(weights[pair_ids] - np.nanmin(weights[valid]) + 1.), -0.5)
+        graph = sparse.csr_matrix((costs, (pair_indices[pair_ids,0], pair_indices[pair_ids,1])), shape=(n_tiles, n_tiles))
+        tree = csgraph.minimum_spanning_tree(graph)
+        tree = (tree + tree.T).tocsr()
+
+        # look up the pair of each tree edge
+        edge_to_pair = sparse.csr_matrix((pair_ids + 1, (pair_indices[pair_ids,0], pair_indices[pair_ids,1])), shape=(n_tiles, n_tiles))
+        edge_to_pair = (edge_to_pair + edge_to_pair.T).tocsr()
+
+        n_components, labels = csgraph.connected_components(tree, directed=False)
+        roots = np.unique(labels, return_index=True)[1]
+        predecessors = np.full(n_tiles, -1, dtype=np.int64)
+        for root in roots:
+            _, component_predecessors = csgraph.breadth_first_order(tree, root, directed=False, return_predecessors=True)
+            reached = component_predecessors >= 0
+            predecessors[reached] = component_predecessors[reached]
+
+        nodes = np.nonzero(predecessors >= 0)[0]
+        parents = predecessors[nodes]
+        edge_pairs = np.asarray(edge_to_pair[parents, nodes]).ravel() - 1
+        signs = np.where(pair_indices[edge_pairs,0] == parents, 1., -1.)
+        steps = np.zeros((n_tiles, displacement.shape[1]))
+        steps[nodes] = signs[:,np.newaxis] * displacement[edge_pairs]
+        positions = _accumulate_along_tree(predecessors, steps)
+
+        if initial_positions is not None:
+            # anchor each component to the warm start
+            initial_positions = np.asarray(initial_positions, dtype=np.float64)
+            for component in range(n_components):
+                members = labels == component
+                known = members & ~np.any(np.isnan(initial_positions), axis=1)
+                if np.any(known):
+                    positions[members] += np.mean(initial_positions[known] - positions[known], axis=0)
+        positions[_unplaced_tiles(n_tiles, pair_indices[pair_ids], initial_positions)] = np.nan
+        if initial_positions is None:
+            positions -= np.nanmin(positions, axis=0)
+        return positions
 
 class ElasticOptimizer(GlobalOptimizer):
-    def __init__(self) -> None:
-        super().__init__()
-    def __call__(self, positions, ) -> pd.DataFrame:
-        ...
+    """Weighted sparse least-squares fit of the tile positions to the pair displacements.
+
+    Each valid pair (i, j) with the displacement d_ij contributes the residual x_j - x_i - d_ij,
+    weighted by the pair weight. The invalid pairs contribute their estimated displacements with the weak
+    `estimated_weight`. The normal equations are never formed densely, so that the memory
+    and the time grow linearly in the number of pairs.
+    """
+    solver : Literal["lsqr","cg"] = Field("lsqr", 
+        description="The iterative solver for the sparse least squares, either lsqr or cg (on the normal equations).")
+    robust_iterations : int = Field(0,
+        description="The number of the iteratively reweighted least squares steps to down-weight the outlier pairs.")
+    robust_scale : float = Field(2., 
+        description="The residual scale in pixel of the Cauchy loss used to down-weight the outlier pairs in the robust steps.")
+    min_weight : float = Field(1e-3, description="The lower bound of the pair weights.")
+    estimated_weight : float = Field(1e-3,
+        description="The weight of the estimated displacements of the pairs without a valid displacement.")
+    tol : float = Field(1e-10, description="The convergence tolerance of the iterative solver.")
+    max_iterations : Optional[int] = Field(None, description="The maximum iteration of the iterative solver.")
+
+    def _solve(self, incidence : sparse.csr_matrix, pair_weights : FloatArray, rhs : FloatArray) -> FloatArray:
+        """Solve the weighted least squares `incidence @ x = rhs` for each column of `rhs`."""
+        sqrt_weights = np.sqrt(pair_weights)
+        weighted = sparse.diags(sqrt_weights) @ incidence
+        if self.solver == "lsqr":
+            return np.stack([
+                splinalg.lsqr(weighted, sqrt_weights * b, atol=self.tol, btol=self.tol, iter_lim=self.max_iterations)[0]
+                for b in rhs.T], axis=1)
+        else:
+            laplacian = (weighted.T @ weighted).tocsr()
+            solutions = []
+            for b in rhs.T:
+                solution, _info = splinalg.cg(laplacian, weighted.T @ (sqrt_weights * b), 
+                                              maxiter=self.max_iterations, **{_CG_TOL_KEYWORD : self.tol})
+                solutions.append(solution)
+            return np.stack(solutions, axis=1)
+
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Float,
+            initial_positions : Optional[NumArray] = None,
+            weights : Optional[NumArray] = None,
+            ) -> FloatArray:
+        n_tiles = images.shape[0]
+        ndim = len(images.shape[1:])
+        pair_indices = np.asarray(pair_indices)
+        displacement = np.asarray(displacement, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(len(pair_indices))
+        weights = np.asarray(weights, dtype=np.float64)
+        displacement, valid, estimated = _fill_with_estimates(displacement, estimated_displacement, weights)
+        weights = np.where(valid, np.clip(weights, self.min_weight, None), self.estimated_weight)
+        used = valid | estimated
+        pair_indices = pair_indices[used]
+        displacement = displacement[used]
+        weights = weights[used]
+
+        n_pairs = len(pair_indices)
+        incidence = sparse.csr_matrix(
+            (np.tile([-1., 1.], n_pairs), (np.repeat(np.arange(n_pairs), 2), pair_indices.ravel())),
+            shape=(n_pairs, n_tiles))
+
+        # solve for the correction from the warm start, so that the minimum-norm solution stays close to it
+        if initial_positions is not None:
+            prior = np.nan_to_num(np.asarray(initial_positions, dtype=np.float64), nan=0.)
+        else:
+            prior = np.zeros((n_tiles, ndim))
+        rhs = displacement - incidence @ prior
+
+        robust_weights = np.ones(n_pairs)
+        for _ in range(self.robust_iterations + 1):
+            correction = self._solve(incidence, weights * robust_weights, rhs)
+            residuals = np.linalg.norm(incidence @ correction - rhs, axis=1)
+            robust_weights = 1. / (1. + (residuals / self.robust_scale) ** 2)
+        positions = prior + correction
+        positions[_unplaced_tiles(n_tiles, pair_indices, initial_positions)] = np.nan
+
+        if initial_positions is None:
+            positions -= np.nanmin(positions, axis=0)
+        return positions
 
 global_optimizers={
     "maximum_spanning_tree" : MaximumSpanningTreeOptimizer,
     "elastic" : ElasticOptimizer,
-}
\ No newline at end of file
+}
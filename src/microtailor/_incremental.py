@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+from ._stitcher import Stitcher, _find_pairs, _get_displacements, _label_components, _position_columns
+from ._tile_source import ConcatenatedTileSource, TileSourceLike, as_tile_source
+from ._typing_utils import FloatArray, IntArray, NumArray
+
+
+class IncrementalStitcher:
+    """Stitch the tiles incrementally while they are being acquired.
+
+    Each call to `add_tiles` discovers only the pairs including the new tiles, and runs the candidate
+    estimation and the pair optimization only for those pairs, with the scheduling and the result store
+    of `stitcher`. `current_positions` runs the global optimizer warm-started from the previous solution,
+    or for each connected component if `stitcher.stitch_components_separately` is set.
+
+    Parameters
+    ----------
+    stitcher : Optional[Stitcher], optional
+        The stitcher providing the stages and the scheduling options. If None, the default Stitcher is used.
+    overlap_threshold_percentage : float, optional
+        The area percentage threshold to calculate pair displacement between tiles. Effective only when tile_indices is None.
+    allowed_error : float, optional
+        The allowed error from the `estimated_positions` in pixel, by default 20.
+    """
+
+    def __init__(
+        self,
+        stitcher : Optional[Stitcher] = None,
+        overlap_threshold_percentage : float = 5,
+        allowed_error : float = 20,
+    ) -> None:
+        self.stitcher = stitcher if stitcher is not None else Stitcher()
+        self.overlap_threshold_percentage = overlap_threshold_percentage
+        self.allowed_error = allowed_error
+        self._sources = ConcatenatedTileSource()
+        self._tile_indices : Optional[IntArray] = None
+        self._estimated_positions : Optional[NumArray] = None
+        self._positions : Optional[FloatArray] = None
+        self.pairs_df = pd.DataFrame()
+
+    @property
+    def n_tiles(self) -> int:
+        """The number of the added tiles."""
+        return len(self._sources) if self._sources.sources else 0
+
+    def add_tiles(
+        self,
+        images : TileSourceLike,
+        tile_indices : Optional[IntArray] = None,
+        estimated_positions : Optional[NumArray] = None,
+    ) -> pd.DataFrame:
+        """Add newly acquired tiles and register them to the existing tiles.
+
+        Parameters
+        ----------
+        images : TileSourceLike
+            The new tiles. See `Stitcher.stitch` for the accepted types.
+        tile_indices : Optional[IntArray], optional
+            The integer index of the new tiles. Must be supplied if it was supplied for the previous tiles.
+        estimated_positions : Optional[NumArray], optional
+            The estimated position of the new tiles in pixel. Must be supplied if it was supplied for the previous tiles.
+
+        Returns
+        -------
+        new_pairs_df : pd.DataFrame
+            The pairs including the new tiles, with the displacements computed at each stage.
+        """
+        if tile_indices is None and estimated_positions is None:
+            raise ValueError("tile_indices and estimated_positions must not be None together.")
+        if self.n_tiles > 0 and ((tile_indices is None) != (self._tile_indices is None)
+                                 or (estimated_positions is None) != (self._estimated_positions is None)):
+            raise ValueError("tile_indices and estimated_positions must be supplied consistently with the previous tiles.")
+        n_new = len(tile_indices) if tile_indices is not None else len(estimated_positions)
+        source = as_tile_source(images, n_tiles=n_new)
+        if len(source) != n_new:
+            raise ValueError("images and the positions must have the same length.")
+
+        start = self.n_tiles
+        self._sources.append(source)
+        if tile_indices is not None:
+            tile_indices = np.asarray(tile_indices)
+            self._tile_indices = tile_indices if self._tile_indices is None \
+                else np.concatenate([self._tile_indices, tile_indices])
+        if estimated_positions is not None:
+            estimated_positions = np.asarray(estimated_positions)
+            self._estimated_positions = estimated_positions if self._estimated_positions is None \
+                else np.concatenate([self._estimated_positions, estimated_positions])
+
+        image_shape = self._sources.tile_shape
+        new_pairs_df = _find_pairs(image_shape, self._tile_indices, self._estimated_positions,
+                                   self.overlap_threshold_percentage, start)
+        if len(new_pairs_df) > 0:
+            self._register_pairs(new_pairs_df)
+        self.pairs_df = pd.concat([self.pairs_df, new_pairs_df], ignore_index=True)
+        return new_pairs_df
+
+    def _register_pairs(self, new_pairs_df : pd.DataFrame) -> None:
+        """Run the per-pair stages for the new pairs, keeping the results of the previous pairs.
+
+        The position interpolator is fitted on all the pairs, but only the new pairs get the interpolated
+        displacements, since the previous pairs are not optimized again.
+        """
+        ndim = len(self._sources.tile_shape)
+        grid_coords = self._tile_indices if self._tile_indices is not None \
+            else self._estimated_positions / np.array(self._sources.tile_shape)
+        self.stitcher._register_pairs(
+            self._sources,
+            new_pairs_df,
+            _get_displacements(new_pairs_df, "estimated_displacement", ndim),
+            self.allowed_error,
+            grid_coords,
+            interpolation_context=self.pairs_df,
+        )
+
+    def _initial_positions(self) -> Optional[FloatArray]:
+        """Extend the previous solution to the new tiles, using the estimated positions if available."""
+        if self._positions is None:
+            return None
+        ndim = len(self._sources.tile_shape)
+        initial_positions = np.full((self.n_tiles, ndim), np.nan)
+        n_solved = len(self._positions)
+        initial_positions[:n_solved] = self._positions
+        if self._estimated_positions is not None:
+            offset = np.nanmean(self._positions - self._estimated_positions[:n_solved], axis=0)
+            initial_positions[n_solved:] = self._estimated_positions[n_solved:] + offset
+        return initial_positions
+
+    def current_positions(self) -> pd.DataFrame:
+        """Optimize the tile positions with the pairs registered so far.
+
+        Returns
+        -------
+        positions_df : pd.DataFrame
+            The stitched tile positions indexed by the tile number, with the columns such as "y_pos" and "x_pos".
+        """
+        if len(self.pairs_df) == 0:
+            raise RuntimeError("There is no valid image pairs yet.")
+        ndim = len(self._sources.tile_shape)
+        if self.stitcher.stitch_components_separately:
+            _, component_labels = _label_components(self.n_tiles, self.pairs_df[["image_index1","image_index2"]].values)
+        else:
+            component_labels = None
+        self._positions = self.stitcher._optimize_positions(
+            self._sources,
+            self.pairs_df,
+            _get_displacements(self.pairs_df, "estimated_displacement", ndim),
+            self.allowed_error,
+            component_labels,
+            self._tile_indices,
+            self._estimated_positions,
+            initial_positions=self._initial_positions(),
+        )
+        positions_df = pd.DataFrame(self._positions, columns=_position_columns(ndim))
+        if component_labels is not None:
+            positions_df["component"] = component_labels
+        return positions_df
@@ -0,0 +1,124 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ._typing_utils import NumArray
+
+METADATA_FILE = "multiscale.json"
+
+
+def pyramid_shapes(shape : Tuple[int,...], n_levels : int) -> List[Tuple[int,...]]:
+    """Calculate the shapes of the pyramid levels, halving the previous level and discarding the trailing odd pixel."""
+    shapes = [tuple(int(n) for n in shape)]
+    for _ in range(n_levels - 1):
+        shapes.append(tuple(n // 2 for n in shapes[-1]))
+    if min(shapes[-1]) < 1:
+        raise ValueError(f"the shape {tuple(shape)} is too small for {n_levels} pyramid levels.")
+    return shapes
+
+
+def _chunk_file(path : str, level : int, chunk_index : Tuple[int,...]) -> str:
+    return os.path.join(path, str(level), ".".join(str(i) for i in chunk_index) + ".npy")
+
+
+class MultiscaleWriter:
+    """Writer of the chunked multiscale directory store.
+
+    The store is readable with NumPy only. The layout is::
+
+        path/multiscale.json    the shapes, the chunk shape, the dtype and the scales of the levels
+        path/<level>/<i>.<j>.npy  the chunk (i, j) of each level, level 0 being the full resolution
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store. Created if it does not exist.
+    shape : Tuple[int,...]
+        The shape of the full-resolution level.
+    chunk_shape : Tuple[int,...]
+        The chunk shape, common to all the levels.
+    dtype : Any
+        The dtype of the stored arrays.
+    n_levels : int
+        The number of the levels including the full resolution. Each level halves the previous one.
+    """
+
+    def __init__(self, path : str, shape : Tuple[int,...], chunk_shape : Tuple[int,...], dtype : Any, n_levels : int) -> None:
+        if len(chunk_shape) != len(shape):
+            raise ValueError("chunk_shape must have the dimension same as shape.")
+        self.path = path
+        self.shapes = pyramid_shapes(shape, n_levels)
+        self.chunk_shape = tuple(int(n) for n in chunk_shape)
+        self.dtype = np.dtype(dtype)
+        for level in range(n_levels):
+            os.makedirs(os.path.join(path, str(level)), exist_ok=True)
+        metadata = {
+            "dtype" : self.dtype.str,
+            "chunks" : list(self.chunk_shape),
+            "levels" : [{"path" : str(level), "shape" : list(level_shape), "scale" : 2 ** level}
+                        for level, level_shape in enumerate(self.shapes)],
+        }
+        with open(os.path.join(path, METADATA_FILE), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def chunk_slices(self, level : int, chunk_index : Tuple[int,...]) -> Tuple[slice,...]:
+        """Return the region of a chunk in its level."""
+        return tuple(slice(i * c, min((i + 1) * c, n))
+                     for i, c, n in zip(chunk_index, self.chunk_shape, self.shapes[level]))
+
+    def chunk_grid(self, level : int) -> Tuple[int,...]:
+        """Return the number of the chunks along each axis of a level."""
+        return tuple(-(-n // c) for n, c in zip(self.shapes[level], self.chunk_shape))
+
+    def write_chunk(self, level : int, chunk_index : Tuple[int,...], data : NumArray) -> None:
+        """Write a chunk, which must have the shape of its region."""
+        expected = tuple(s.stop - s.start for s in self.chunk_slices(level, chunk_index))
+        if data.shape != expected:
+            raise ValueError(f"the chunk shape {data.shape} differs from the expected {expected}.")
+        np.save(_chunk_file(self.path, level, chunk_index), np.asarray(data, dtype=self.dtype))
+
+
+def read_multiscale_metadata(path : str) -> Dict[str,Any]:
+    """Read the metadata of a multiscale store written by `MultiscaleWriter`."""
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        return json.load(f)
+
+
+def read_multiscale_level(path : str, level : int = 0, region : Optional[Tuple[slice,...]] = None) -> NumArray:
+    """Read a level of a multiscale store written by `MultiscaleWriter`, loading only the chunks in the region.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store.
+    level : int, optional
+        The level, 0 being the full resolution, by default 0.
+    region : Optional[Tuple[slice,...]], optional
+        The region of the level to read with the slices of step 1. If None, the whole level.
+
+    Returns
+    -------
+    array : NumArray
+        The array of the region.
+    """
+    metadata = read_multiscale_metadata(path)
+    shape = metadata["levels"][level]["shape"]
+    chunks = metadata["chunks"]
+    if region is None:
+        region = tuple(slice(None) for _ in shape)
+    starts, stops, _ = zip(*[s.indices(n) for s, n in zip(region, shape)])
+    array = np.empty(tuple(max(b - a, 0) for a, b in zip(starts, stops)), dtype=np.dtype(metadata["dtype"]))
+    if array.size == 0:
+        return array
+    ranges = [range(a // c, -(-b // c)) for a, b, c in zip(starts, stops, chunks)]
+    for chunk_index in np.ndindex(*[len(r) for r in ranges]):
+        chunk_index = tuple(r[i] for r, i in zip(ranges, chunk_index))
+        chunk_start = [i * c for i, c in zip(chunk_index, chunks)]
+        lo = [max(a, s) for a, s in zip(starts, chunk_start)]
+        hi = [min(b, s + c) for b, s, c in zip(stops, chunk_start, chunks)]
+        chunk = np.load(_chunk_file(path, level, chunk_index), mmap_mode="r")
+        array[tuple(slice(l - a, h - a) for l, h, a in zip(lo, hi, starts))] = \
+            chunk[tuple(slice(l - s, h - s) for l, h, s in zip(lo, hi, chunk_start))]
+    return array
@@ -1,15 +1,149 @@
+from pydantic import BaseModel, Field
 from abc import ABC, abstractmethod
-import pandas as pd
+from itertools import product
+from typing import Callable, Dict, Optional, Tuple, Union
+from typing_extensions import Literal
+import numpy as np
+from ._cache import LRUCache
+from ._tile_source import read_tile_region
+from ._typing_utils import NumArray, Float, FloatArray, IntArray
+from ._utils import SummedAreaTile, calc_overlap_nccs
 
-class PairOptimizer(ABC):
+class PairOptimizer(ABC,BaseModel):
     @abstractmethod
-    def __call__(self, positions, ) -> pd.DataFrame:
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            initial_displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Union[Float,FloatArray],
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Optimize the displacement of the image pairs locally.
+
+        Parameters
+        ----------
+        images : NumArray
+            The input images. The first dimension corresponds to the mosaic position.
+        pair_indices : IntArray
+            The (n_pairs, 2) array of the image indices of the pairs.
+        initial_displacement : NumArray
+            The (n_pairs, ndim) array of the initial displacement of the second image with respect
+            to the first image.
+        estimated_displacement : Optional[NumArray]
+            The (n_pairs, ndim) array of the estimated displacement. NaN values mean that the displacement
+            is not estimated.
+        allowed_error : Union[Float,FloatArray]
+            The allowed error from the `estimated_displacement` in pixel, or the (n_pairs,) array of the allowed errors.
+
+        Returns
+        -------
+        optimized_displacement : FloatArray
+            The (n_pairs, ndim) array of the optimized displacement.
+        extra_fields : Dict[str,NumArray]
+            The additional per-pair values to be stored in the pair dataframe.
+        """
         ...
 
+def _calc_window_regions(image_shape : IntArray, lower : IntArray, upper : IntArray) -> Tuple[Tuple[IntArray,IntArray],Tuple[IntArray,IntArray]]:
+    """Calculate the regions of the two tiles containing the overlaps for all the displacements in [lower, upper]."""
+    region1 = (np.clip(lower, 0, image_shape), np.clip(image_shape + upper, 0, image_shape))
+    region2 = (np.clip(-upper, 0, image_shape), np.clip(image_shape - lower, 0, image_shape))
+    return region1, region2
+
 class NormalizedClossCorrelationOptimizer(PairOptimizer):
-    def __call__(self, positions, ) -> pd.DataFrame:
-        ...
+    """Refine the pair displacement by maximizing the normalized cross correlation of the overlap.
+
+    The sums and squared sums of the overlaps are read from the summed-area tables of the tiles, so that
+    each shift costs a single pass over the overlap. The evaluated shifts are memoized during the search.
+    The integer shifts are searched from the rounded initial displacement. If the search stays there, the subpixel
+    initial displacement (e.g. from the upsampled phase correlation) is returned unchanged.
+    """
+    search : Literal["hill_climb","exhaustive"] = Field("hill_climb",
+        description="The search strategy within the allowed window, either hill_climb or exhaustive.")
+    min_overlap_ratio : float = Field(0.05,
+        description="The minimum overlap area ratio of the evaluated displacements.")
+    tile_cache_bytes : Optional[int] = Field(2**28,
+        description="The memory budget in bytes for the summed-area tables cached during a call.")
+    crop_to_overlap : bool = Field(True,
+        description="If True, the summed-area tables are computed only on the regions overlapping within the search window "
+        + "instead of the whole tiles, which keeps the memory bounded for large volumes.")
+
+    def _search(self,
+            ncc_at : Callable[[Tuple[int,...]],Float],
+            start : Tuple[int,...],
+            lower : IntArray,
+            upper : IntArray) -> Tuple[Tuple[int,...],Float]:
+        """Search the displacement maximizing `ncc_at` within [lower, upper]."""
+        if self.search == "exhaustive":
+            candidates = product(*[range(l, u + 1) for l, u in zip(lower, upper)])
+            best = max(candidates, key=ncc_at)
+            return best, ncc_at(best)
+
+        ndim = len(start)
+        steps = np.concatenate([np.eye(ndim, dtype=np.int64), -np.eye(ndim, dtype=np.int64)])
+        current = start
+        current_ncc = ncc_at(current)
+        while True:
+            neighbors = [tuple(n) for n in np.array(current) + steps 
+                         if np.all(n >= lower) and np.all(n <= upper)]
+            if not neighbors:
+                return current, current_ncc
+            best = max(neighbors, key=ncc_at)
+            if ncc_at(best) <= current_ncc:
+                return current, current_ncc
+            current, current_ncc = best, ncc_at(best)
+
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            initial_displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Union[Float,FloatArray],
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        pair_indices = np.asarray(pair_indices)
+        allowed_errors = np.broadcast_to(np.asarray(allowed_error, dtype=np.float64), (len(pair_indices),))
+        image_shape = np.array(images.shape[1:])
+        tiles = LRUCache(self.tile_cache_bytes)
+        optimized_displacement = np.full((len(pair_indices), len(image_shape)), np.nan)
+        nccs = np.full(len(pair_indices), np.nan)
+
+        for j, (index1, index2) in enumerate(pair_indices):
+            initial = np.asarray(initial_displacement[j], dtype=np.float64)
+            if np.any(np.isnan(initial)):
+                continue
+            rounded = np.round(initial)
+            start = rounded.astype(np.int64)
+            center = start
+            if estimated_displacement is not None and not np.any(np.isnan(estimated_displacement[j])):
+                center = np.asarray(estimated_displacement[j], dtype=np.float64)
+            lower = np.maximum(np.ceil(center - allowed_errors[j]), -image_shape + 1).astype(np.int64)
+            upper = np.minimum(np.floor(center + allowed_errors[j]), image_shape - 1).astype(np.int64)
+            start = np.clip(start, lower, upper)
+
+            if self.crop_to_overlap:
+                tile1, tile2 = [
+                    SummedAreaTile(read_tile_region(images, index, tuple(slice(a, b) for a, b in zip(starts, stops))), starts)
+                    for index, (starts, stops) in zip((index1, index2), _calc_window_regions(image_shape, lower, upper))]
+            else:
+                tile1 = tiles.get_or_compute(int(index1), lambda: SummedAreaTile(images[index1]))
+                tile2 = tiles.get_or_compute(int(index2), lambda: SummedAreaTile(images[index2]))
+            memo : Dict[Tuple[int,...],Float] = {}
+            def ncc_at(displacement : Tuple[int,...]) -> Float:
+                if displacement not in memo:
+                    overlap_ratio = np.prod(np.clip(1 - np.abs(displacement) / image_shape, 0, None))
+                    memo[displacement] = calc_overlap_nccs(tile1, tile2, np.array(displacement), tuple(image_shape))[0] \
+                        if overlap_ratio >= self.min_overlap_ratio else -np.inf
+                return memo[displacement]
+
+            best, best_ncc = self._search(ncc_at, tuple(start.tolist()), lower, upper)
+            if np.isfinite(best_ncc):
+                # keep the subpixel offset of the initial displacement if the integer search confirms its rounded position
+                optimized_displacement[j] = initial if np.array_equal(best, rounded) else best
+                nccs[j] = best_ncc
+        return optimized_displacement, {"ncc" : nccs}
 
 pair_optimizers={
     "normalized_cross_correlation" : NormalizedClossCorrelationOptimizer,
-}
\ No newline at end of file
+}
@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Optional, TypeVar
+
+import numpy as np
+
+from ._typing_utils import IntArray
+
+T = TypeVar("T")
+
+executors = {
+    "thread" : ThreadPoolExecutor,
+    "process" : ProcessPoolExecutor,
+}
+
+
+def _resolve_n_jobs(n_jobs : int) -> int:
+    """Convert the joblib-style `n_jobs` (negative values count back from the number of CPUs) to a worker count."""
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0.")
+    if n_jobs < 0:
+        n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def split_into_chunks(n_items : int, n_jobs : int, chunk_size : Optional[int] = None) -> List[IntArray]:
+    """Split the item indices into contiguous chunks.
+
+    Parameters
+    ----------
+    n_items : int
+        The number of items.
+    n_jobs : int
+        The number of workers. If `chunk_size` is None, about four chunks are made per worker
+        to balance the load.
+    chunk_size : Optional[int], optional
+        The number of items per chunk.
+
+    Returns
+    -------
+    chunks : List[IntArray]
+        The item indices of the chunks in order.
+    """
+    if chunk_size is None:
+        chunk_size = max(int(np.ceil(n_items / (4 * n_jobs))), 1)
+    return [np.arange(start, min(start + chunk_size, n_items)) for start in range(0, n_items, chunk_size)]
+
+
+def map_chunks(
+    func : Callable[[IntArray], T],
+    n_items : int,
+    n_jobs : int = 1,
+    executor : str = "thread",
+    chunk_size : Optional[int] = None,
+    ) -> List[T]:
+    """Apply a function to the chunks of item indices, optionally in parallel.
+
+    The results are returned in the chunk order, so that the output does not depend on `n_jobs`.
+
+    Parameters
+    ----------
+    func : Callable[[IntArray], T]
+        The function applied to the item indices of each chunk. Must be picklable if `executor` is "process".
+    n_items : int
+        The number of items.
+    n_jobs : int, optional
+        The number of workers. Negative values are counted back from the number of CPUs, by default 1.
+    executor : str, optional
+        The executor type, either "thread" or "process", by default "thread".
+    chunk_size : Optional[int], optional
+        The number of items per chunk. If None, determined from `n_jobs`.
+
+    Returns
+    -------
+    results : List[T]
+        The results for each chunk.
+    """
+    n_jobs = _resolve_n_jobs(n_jobs)
+    chunks = split_into_chunks(n_items, n_jobs, chunk_size)
+    if n_jobs == 1 or len(chunks) <= 1:
+        return [func(chunk) for chunk in chunks]
+    pool : Executor
+    with executors[executor](max_workers=n_jobs) as pool:
+        return list(pool.map(func, chunks))
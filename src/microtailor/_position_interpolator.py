@@ -1,15 +1,173 @@
+from pydantic import BaseModel, Field
 from abc import ABC, abstractmethod
-import pandas as pd
+from typing import Dict, Optional, Tuple, Union
+from scipy import stats
+import numpy as np
+from ._typing_utils import NumArray, Float, FloatArray, IntArray
 
-class PositionInterpolator(ABC):
+class PositionInterpolator(ABC,BaseModel):
     @abstractmethod
-    def __call__(self, positions, ) -> pd.DataFrame:
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            candidate_displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Union[Float,FloatArray],
+            index_displacement : Optional[NumArray] = None,
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Filter out the outlier candidate displacements and interpolate them.
+
+        Parameters
+        ----------
+        images : NumArray
+            The input images. The first dimension corresponds to the mosaic position.
+        pair_indices : IntArray
+            The (n_pairs, 2) array of the image indices of the pairs.
+        candidate_displacement : NumArray
+            The (n_pairs, ndim) array of the candidate displacement.
+        estimated_displacement : Optional[NumArray]
+            The (n_pairs, ndim) array of the estimated displacement. NaN values mean that the displacement
+            is not estimated.
+        allowed_error : Union[Float,FloatArray]
+            The allowed error from the `estimated_displacement` in pixel, or the (n_pairs,) array of the allowed errors.
+        index_displacement : Optional[NumArray], optional
+            The (n_pairs, ndim) array of the tile index displacement. NaN values mean that the tile indices are not given.
+
+        Returns
+        -------
+        interpolated_displacement : FloatArray
+            The (n_pairs, ndim) array of the interpolated displacement.
+        extra_fields : Dict[str,NumArray]
+            The additional per-pair values to be stored in the pair dataframe. If "search_radius" is included,
+            the pair optimizer searches within this radius around the interpolated displacement
+            instead of `allowed_error` around the estimated displacement. NaN values mean no restriction.
+        """
         ...
 
+def _min_cov_det(values : FloatArray, support_fraction : Float, max_iterations : int = 30) -> Tuple[FloatArray, FloatArray, int]:
+    """Estimate the robust location and covariance by the minimum covariance determinant (MCD) with concentration steps.
+
+    The concentration steps start from the points closest to the coordinate-wise median in the units of the
+    median absolute deviation, and the estimate is corrected for consistency and reweighted (Rousseeuw and Van Driessen, 1999).
+    The reweighted covariance is unbiased and corrected for the truncation of the Gaussian at the retained fraction.
+    The number of the samples supporting the returned estimate is returned as well.
+    """
+    n, ndim = values.shape
+    h = min(max(int(np.ceil(support_fraction * n)), (n + ndim + 1) // 2), n)
+    median = np.median(values, axis=0)
+    mad = np.maximum(np.median(np.abs(values - median), axis=0), np.finfo(np.float64).eps)
+    subset = np.argsort(np.sum(((values - median) / mad) ** 2, axis=1))[:h]
+
+    def mahalanobis(location : FloatArray, covariance : FloatArray) -> FloatArray:
+        centered = values - location
+        return np.einsum("ij,ij->i", centered @ np.linalg.pinv(covariance), centered)
+
+    for _ in range(max_iterations):
+        location = values[subset].mean(axis=0)
+        covariance = np.cov(values[subset], rowvar=False, bias=True).reshape(ndim, ndim)
+        new_subset = np.argsort(mahalanobis(location, covariance))[:h]
+        if np.array_equal(np.sort(new_subset), np.sort(subset)):
+            break
+        subset = new_subset
+
+    distances = mahalanobis(location, covariance)
+    correction = np.median(distances) / stats.chi2.ppf(0.5, ndim)
+    if correction > 0:
+        covariance = covariance * correction
+        distances = distances / correction
+    cutoff = stats.chi2.ppf(0.975, ndim)
+    inliers = distances <= cutoff
+    n_inliers = int(np.count_nonzero(inliers))
+    if n_inliers > ndim + 1:
+        location = values[inliers].mean(axis=0)
+        # unbiased and corrected for the truncation of the distribution at the retained fraction
+        retained = n_inliers / n
+        truncation = retained / stats.chi2.cdf(stats.chi2.ppf(retained, ndim), ndim + 2) if retained < 1 else 1.
+        covariance = np.cov(values[inliers], rowvar=False).reshape(ndim, ndim) * truncation
+        return location, covariance, n_inliers
+    return location, covariance, h
+
+def _prediction_threshold(quantile : Float, n_samples : int, ndim : int) -> Float:
+    """The quantile of the squared Mahalanobis distance of a new sample from the mean and covariance estimated
+    from `n_samples` Gaussian samples, approaching the chi-squared quantile for large samples."""
+    return ndim * (n_samples - 1) * (n_samples + 1) / (n_samples * (n_samples - ndim)) \
+        * stats.f.ppf(quantile, ndim, n_samples - ndim)
+
 class EllipticEnvelopeInterpolator(PositionInterpolator):
-    def __call__(self, positions, ) -> pd.DataFrame:
-        ...
+    """Model the stage by the robust distribution of the displacements for each tile index displacement.
+
+    The deviations of the candidate displacements from the estimated displacements (or the candidate displacements
+    themselves if not estimated) are grouped by the tile index displacement, e.g. the right and the bottom neighbors.
+    The robust mean and covariance of each group are estimated by the minimum covariance determinant, and the candidates
+    outside the elliptic envelope are replaced by the group mean. The envelope also bounds the search radius of the pair optimizer.
+
+    If the tile indices are not given, the groups are made by the estimated displacements in the units of the tile shape.
+    """
+    support_fraction : float = Field(0.5,
+        description="The fraction of the pairs supporting the MCD estimate of each group.")
+    outlier_quantile : float = Field(0.99,
+        description="The chi-squared quantile of the squared Mahalanobis distance beyond which the candidates are outliers.")
+    min_std : float = Field(1.0,
+        description="The lower bound of the standard deviation of the displacements in pixel, accounting for the pixel quantization.")
+    min_samples : Optional[int] = Field(None,
+        description="The minimum number of the valid candidates to model a group. If None, ndim + 2 is used.")
+
+    def __call__(
+            self,
+            images : NumArray,
+            pair_indices : IntArray,
+            candidate_displacement : NumArray,
+            estimated_displacement : Optional[NumArray],
+            allowed_error : Union[Float,FloatArray],
+            index_displacement : Optional[NumArray] = None,
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        candidate_displacement = np.asarray(candidate_displacement, dtype=np.float64)
+        n_pairs, ndim = candidate_displacement.shape
+        image_shape = np.array(images.shape[1:])
+        allowed_errors = np.broadcast_to(np.asarray(allowed_error, dtype=np.float64), (n_pairs,))
+        nan = np.full((n_pairs, ndim), np.nan)
+        estimated = nan if estimated_displacement is None else np.asarray(estimated_displacement, dtype=np.float64)
+        indices = nan if index_displacement is None else np.asarray(index_displacement, dtype=np.float64)
+
+        # model the deviation from the estimate, grouped by the tile index displacement
+        is_estimated = np.all(np.isfinite(estimated), axis=1, keepdims=True)
+        baseline = np.where(is_estimated, estimated, 0)
+        deviations = candidate_displacement - baseline
+        keys = np.where(np.all(np.isfinite(indices), axis=1, keepdims=True), indices,
+            np.where(is_estimated, np.round(estimated / image_shape), np.round(candidate_displacement / image_shape)))
+        valid = np.all(np.isfinite(deviations), axis=1)
+        keys = np.nan_to_num(keys, nan=np.iinfo(np.int32).min)
+
+        interpolated_displacement = candidate_displacement.copy()
+        outlier = ~valid
+        search_radius = np.full(n_pairs, np.nan)
+        min_samples = ndim + 2 if self.min_samples is None else self.min_samples
+        _, groups = np.unique(keys, axis=0, return_inverse=True)
+        groups = groups.ravel()
+        for group in np.unique(groups):
+            members = np.nonzero(groups == group)[0]
+            fitted = members[valid[members]]
+            if len(fitted) < min_samples:
+                continue
+            location, covariance, n_support = _min_cov_det(deviations[fitted], self.support_fraction)
+            threshold = _prediction_threshold(self.outlier_quantile, n_support, ndim)
+            covariance = covariance + self.min_std ** 2 * np.eye(ndim)
+            centered = deviations[members] - location
+            distances = np.einsum("ij,ij->i", centered @ np.linalg.inv(covariance), centered)
+            is_outlier = ~valid[members] | ~(distances <= threshold)
+            outlier[members] = is_outlier
+            replaced = members[is_outlier]
+            interpolated_displacement[replaced] = location + baseline[replaced]
+            # the half width of the envelope along the axes
+            radius = np.ceil(np.sqrt(threshold * np.max(np.diag(covariance))))
+            search_radius[members] = np.minimum(radius, allowed_errors[members])
+
+        # the unmodeled invalid candidates fall back to the estimates
+        fallback = ~valid & np.isnan(search_radius)
+        interpolated_displacement[fallback] = estimated[fallback]
+        return interpolated_displacement, {"outlier" : outlier, "search_radius" : search_radius}
 
 position_interpolators={
     "elliptic_envelope" : EllipticEnvelopeInterpolator,
-}
\ No newline at end of file
+}
@@ -0,0 +1,106 @@
+import hashlib
+import pickle
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ._typing_utils import FloatArray, NumArray
+
+
+def tile_digest(tile : NumArray) -> str:
+    """Compute the content hash of a tile including its shape and dtype."""
+    tile = np.ascontiguousarray(tile)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str((tile.shape, tile.dtype.str)).encode())
+    digest.update(tile.data)
+    return digest.hexdigest()
+
+
+def pair_result_keys(
+    stage_key : str,
+    tile_digests : Sequence[str],
+    pair_indices : NumArray,
+    displacements : Sequence[Optional[NumArray]],
+    allowed_errors : NumArray,
+) -> List[str]:
+    """Compute the keys of the per-pair stage results.
+
+    Parameters
+    ----------
+    stage_key : str
+        The description of the stage and its parameters.
+    tile_digests : Sequence[str]
+        The content hashes of the tiles.
+    pair_indices : NumArray
+        The (n_pairs, 2) array of the image indices of the pairs.
+    displacements : Sequence[Optional[NumArray]]
+        The (n_pairs, ndim) input displacements of the stage, defining the search window.
+    allowed_errors : NumArray
+        The (n_pairs,) array of the allowed errors.
+
+    Returns
+    -------
+    keys : List[str]
+        The keys of the pairs.
+    """
+    keys = []
+    for j, (index1, index2) in enumerate(pair_indices):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(stage_key.encode())
+        digest.update(tile_digests[index1].encode())
+        digest.update(tile_digests[index2].encode())
+        for d in displacements:
+            digest.update(b"-" if d is None else np.asarray(d[j], dtype=np.float64).tobytes())
+        digest.update(np.float64(allowed_errors[j]).tobytes())
+        keys.append(digest.hexdigest())
+    return keys
+
+
+class PairResultStore:
+    """File-backed store of the per-pair stage results, backed by SQLite.
+
+    The values are the displacement and the extra fields of a pair, keyed by `pair_result_keys`,
+    so that the results survive crashes and are shared by re-runs with the same tiles and stage parameters.
+
+    Parameters
+    ----------
+    path : str
+        The path of the database file. Created if it does not exist.
+    """
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)")
+        self._connection.commit()
+
+    def get_many(self, keys : Sequence[str]) -> Dict[str, Tuple[FloatArray, Dict[str, Any]]]:
+        """Return the stored results of the keys found in the store."""
+        found : Dict[str, Tuple[FloatArray, Dict[str, Any]]] = {}
+        for start in range(0, len(keys), 500):
+            batch = list(keys[start:start + 500])
+            rows = self._connection.execute(
+                f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(batch))})", batch)
+            for key, value in rows:
+                found[key] = pickle.loads(value)  # noqa: S301 - the store is written by this class only
+        return found
+
+    def put_many(self, items : Iterable[Tuple[str, Tuple[FloatArray, Dict[str, Any]]]]) -> None:
+        """Store the results and commit them to the file."""
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+            [(key, pickle.dumps(value)) for key, value in items])
+        self._connection.commit()
+
+    def __len__(self) -> int:
+        return int(self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0])
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "PairResultStore":
+        return self
+
+    def __exit__(self, *args : Any) -> None:
+        self.close()
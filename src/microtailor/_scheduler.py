@@ -0,0 +1,107 @@
+import numpy as np
+from typing import Optional
+
+from ._typing_utils import IntArray, NumArray
+
+
+def _snake_keys(coords : IntArray) -> IntArray:
+    """Calculate the boustrophedon (snake) traversal keys of integer grid coordinates.
+
+    The direction along each axis is reversed whenever the sum of the keys of the preceding axes is odd,
+    so that consecutive tiles in the order are next to each other on a regular grid.
+    """
+    coords = coords - coords.min(axis=0)
+    keys = coords.copy()
+    preceding_sum = np.zeros(len(coords), dtype=np.int64)
+    for axis in range(1, coords.shape[1]):
+        preceding_sum += keys[:, axis-1]
+        max_coord = coords[:, axis].max()
+        keys[:, axis] = np.where(preceding_sum % 2 == 1, max_coord - coords[:, axis], coords[:, axis])
+    return keys
+
+
+def _hilbert_distances(coords : IntArray) -> IntArray:
+    """Calculate the distances along the Hilbert curve of two-dimensional integer coordinates."""
+    coords = coords - coords.min(axis=0)
+    order = max(int(np.ceil(np.log2(max(int(coords.max()), 1) + 1))), 1)
+    x = coords[:, 0].astype(np.int64).copy()
+    y = coords[:, 1].astype(np.int64).copy()
+    distances = np.zeros(len(coords), dtype=np.int64)
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        distances += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return distances
+
+
+def order_tiles(grid_coords : NumArray, method : str = "snake") -> IntArray:
+    """Order the tiles so that consecutive tiles are spatially close.
+
+    Parameters
+    ----------
+    grid_coords : NumArray
+        The (n_tiles, ndim) array of the tile coordinates in the unit of the tile grid.
+    method : str, optional
+        The traversal, either "snake" (boustrophedon) or "hilbert", by default "snake".
+        The Hilbert curve is applied to the last two axes, the leading axes being traversed in order.
+
+    Returns
+    -------
+    rank : IntArray
+        The rank of each tile in the traversal.
+    """
+    coords = np.round(np.asarray(grid_coords, dtype=np.float64)).astype(np.int64)
+    if method == "snake":
+        keys = _snake_keys(coords)
+    elif method == "hilbert":
+        if coords.shape[1] < 2:
+            keys = coords
+        else:
+            keys = np.concatenate([coords[:, :-2], _hilbert_distances(coords[:, -2:])[:, np.newaxis]], axis=1)
+    else:
+        raise ValueError(f"Unknown traversal method {method}.")
+    order = np.lexsort(keys.T[::-1])
+    rank = np.empty(len(coords), dtype=np.int64)
+    rank[order] = np.arange(len(coords))
+    return rank
+
+
+def order_pairs(
+    pair_indices : IntArray,
+    grid_coords : Optional[NumArray],
+    method : Optional[str] = "snake",
+    ) -> IntArray:
+    """Order the pairs for tile locality.
+
+    The pairs are visited when their later tile is reached in the tile traversal, so that
+    the earlier tile has been read recently and each tile is read about once with a tile cache
+    of a few rows of tiles.
+
+    Parameters
+    ----------
+    pair_indices : IntArray
+        The (n_pairs, 2) array of the image indices of the pairs.
+    grid_coords : Optional[NumArray]
+        The (n_tiles, ndim) array of the tile coordinates in the unit of the tile grid.
+    method : Optional[str], optional
+        The tile traversal, "snake", "hilbert" or None to keep the input order, by default "snake".
+
+    Returns
+    -------
+    order : IntArray
+        The permutation of the pairs.
+    """
+    pair_indices = np.asarray(pair_indices)
+    if method is None or grid_coords is None or len(pair_indices) == 0:
+        return np.arange(len(pair_indices))
+    rank = order_tiles(grid_coords, method)
+    pair_ranks = rank[pair_indices]
+    return np.lexsort((pair_ranks.min(axis=1), pair_ranks.max(axis=1)))
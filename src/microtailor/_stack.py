@@ -0,0 +1,123 @@
+import itertools
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from ._fusion import MosaicFuser
+from ._stitcher import Stitcher, _position_columns
+from ._tile_source import StackTileSource, SubsetTileSource
+from ._typing_utils import FloatArray, IntArray, NumArray
+
+
+class StackStitcher:
+    """Stitch a multichannel or time-lapse stack by registering a reference image once.
+
+    The stack has the shape (n_tiles, *stack_shape, *tile_shape), e.g. (n_tiles, T, C, Y, X). The tiles of the
+    reference image are stitched with the full search. Along the `refine_axes` (e.g. the time axis), the images
+    at the reference indices of the other axes are re-registered warm-started from the reference positions with
+    the small `refine_allowed_error`, and the positions are reused along the other axes (e.g. the channel axis).
+    The re-registered positions are offset to have the same mean as the reference positions.
+
+    Parameters
+    ----------
+    stitcher : Optional[Stitcher], optional
+        The stitcher providing the stages and the scheduling options. If None, the default Stitcher is used.
+    fuser : Optional[MosaicFuser], optional
+        The fuser of the stack. If None, the default MosaicFuser is used.
+    refine_axes : Sequence[int], optional
+        The stack axes, counted from 0 after the tile axis, along which the images are re-registered.
+        By default empty, i.e. the reference positions are reused for all the images.
+    refine_allowed_error : float, optional
+        The allowed error from the reference positions in pixel for the re-registration, by default 3.
+    overlap_threshold_percentage : float, optional
+        The area percentage threshold to calculate pair displacement between tiles. Effective only when tile_indices is None.
+    allowed_error : float, optional
+        The allowed error from the `estimated_positions` in pixel for the reference, by default 20.
+    """
+
+    def __init__(
+        self,
+        stitcher : Optional[Stitcher] = None,
+        fuser : Optional[MosaicFuser] = None,
+        refine_axes : Sequence[int] = (),
+        refine_allowed_error : float = 3,
+        overlap_threshold_percentage : float = 5,
+        allowed_error : float = 20,
+    ) -> None:
+        self.stitcher = stitcher if stitcher is not None else Stitcher()
+        self.fuser = fuser if fuser is not None else MosaicFuser()
+        self.refine_axes = tuple(refine_axes)
+        self.refine_allowed_error = refine_allowed_error
+        self.overlap_threshold_percentage = overlap_threshold_percentage
+        self.allowed_error = allowed_error
+
+    def stitch(
+        self,
+        stack : Any,
+        reference : Sequence[int],
+        tile_indices : Optional[IntArray] = None,
+        estimated_positions : Optional[NumArray] = None,
+    ) -> Tuple[FloatArray, Dict[Tuple[int,...],pd.DataFrame]]:
+        """Calculate the stitched positions of the tiles of all the images in the stack.
+
+        Parameters
+        ----------
+        stack : Any
+            The array-like stack of the tiles with the shape (n_tiles, *stack_shape, *tile_shape).
+        reference : Sequence[int]
+            The stack index of the reference image, e.g. (t, c).
+        tile_indices : Optional[IntArray], optional
+            The integer index of the tiles. If None, `estimated_positions` must be supplied.
+        estimated_positions : Optional[NumArray], optional
+            The estimated position of the tiles in pixel. If None, `tile_indices` must be supplied.
+
+        Returns
+        -------
+        positions : FloatArray
+            The (*stack_shape, n_tiles, ndim) array of the stitched tile positions of each image.
+        pairs_dfs : Dict[Tuple[int,...],pd.DataFrame]
+            The pair dataframes returned by `Stitcher.stitch` for each registered stack index.
+        """
+        reference = tuple(int(i) for i in reference)
+        source = StackTileSource(stack, len(reference))
+        stack_shape = source.stack_shape
+        if any(not 0 <= i < n for i, n in zip(reference, stack_shape)):
+            raise ValueError(f"reference {reference} is out of the stack shape {stack_shape}.")
+        if any(not 0 <= axis < len(stack_shape) for axis in self.refine_axes):
+            raise ValueError(f"refine_axes must be the stack axes in [0, {len(stack_shape)}).")
+        ndim = len(source.tile_shape)
+
+        def stitch_image(stack_index : Tuple[int,...], positions : Optional[NumArray],
+                         allowed_error : float) -> Tuple[pd.DataFrame,pd.DataFrame]:
+            return self.stitcher.stitch(
+                SubsetTileSource(source, source.image_indices(stack_index)),
+                tile_indices=tile_indices,
+                estimated_positions=positions,
+                overlap_threshold_percentage=self.overlap_threshold_percentage,
+                allowed_error=allowed_error,
+            )
+
+        positions_df, pairs_df = stitch_image(reference, estimated_positions, self.allowed_error)
+        reference_positions = positions_df[_position_columns(ndim)].to_numpy(dtype=np.float64)
+        pairs_dfs = {reference : pairs_df}
+        positions = np.empty(stack_shape + reference_positions.shape)
+        refined = {}
+        for refine_index in itertools.product(*[range(stack_shape[axis]) for axis in self.refine_axes]):
+            stack_index = tuple(refine_index[self.refine_axes.index(axis)] if axis in self.refine_axes else i
+                                for axis, i in enumerate(reference))
+            if stack_index == reference:
+                refined[refine_index] = reference_positions
+                continue
+            positions_df, pairs_dfs[stack_index] = stitch_image(stack_index, reference_positions, self.refine_allowed_error)
+            refined_positions = positions_df[_position_columns(ndim)].to_numpy(dtype=np.float64)
+            # the stitched positions start at 0, so put them back to the coordinates of the reference
+            refined[refine_index] = refined_positions + np.nanmean(reference_positions - refined_positions, axis=0)
+
+        for stack_index in np.ndindex(*stack_shape):
+            positions[stack_index] = refined[tuple(stack_index[axis] for axis in self.refine_axes)]
+        return positions, pairs_dfs
+
+    def fuse(self, stack : Any, positions : NumArray, output : Optional[Union[str,Any]] = None) -> NumArray:
+        """Fuse all the images of the stack as one streaming job. See `MosaicFuser.fuse_stack`."""
+        return self.fuser.fuse_stack(stack, positions, output)
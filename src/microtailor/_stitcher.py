@@ -1,26 +1,184 @@
 from pydantic import BaseModel, Extra, Field, PrivateAttr
 import pandas as pd
 import numpy as np
-from itertools import combinations
-import networkx as nx
-from typing import Union, Optional, List, Dict, Any
+from collections import defaultdict
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.sparse import csgraph
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, Union, Optional, List, Dict, Any, Tuple, Sequence
+from typing_extensions import Literal
 from ._candidate_estimator import CandidateEstimator, candidate_estimators
 from ._position_interpolator import PositionInterpolator, position_interpolators
 from ._pair_optimizer import PairOptimizer, pair_optimizers
 from ._global_optimizer import GlobalOptimizer, global_optimizers
-from ._typing_utils import NumArray, IntArray, Int, ArgType
+from ._parallel import map_chunks, executors
+from ._result_store import PairResultStore, pair_result_keys, tile_digest
+from ._scheduler import order_pairs
+from ._tile_source import TileSource, TileSourceLike, SubsetTileSource, CachedTileSource, PrefetchingTileSource, PrefetchStats, as_tile_source, build_tile_pyramid
+from ._typing_utils import NumArray, FloatArray, IntArray, Int, ArgType
 
-steps = { "candidate_estimator" : candidate_estimators }
+steps = { 
+    "candidate_estimator" : candidate_estimators,
+    "position_interpolator" : position_interpolators,
+    "pair_optimizer" : pair_optimizers,
+    "global_optimizer" : global_optimizers,
+}
+
+SearchAgainCallback = Callable[[pd.DataFrame],Optional[Tuple[np.ndarray,FloatArray,Union[float,FloatArray]]]]
 
 def _calc_overlap_area_ratio(image_shape,relative_pos):
     """Calculate the image overlap area ratio with respect to the image area.
-    
+
+    Parameters
+    ----------
+    image_shape : List[Int]
+        The shape of a single input image.
+    relative_pos : NumArray
+        The relative position(s) of the second image. The last dimension must match `image_shape`,
+        so that an array of shape (n_pairs, ndim) is evaluated at once.
+
+    Returns
+    -------
+    ratio : FloatArray
+        The overlap area ratio with the shape `relative_pos.shape[:-1]`.
+    """
+    relative_pos = np.asarray(relative_pos, dtype=np.float64)
+    image_shape = np.asarray(image_shape, dtype=np.float64)
+    return np.prod(np.clip(1-np.abs(relative_pos/image_shape),0,None),axis=-1)
+
+
+def _find_tile_index_pairs(tile_indices : IntArray, start : int = 0) -> IntArray:
+    """Find the pairs of tiles which are next to each other or at the same index.
+
+    Each tile index is registered to a hash table and only the neighboring indices are looked up,
+    so that the cost scales linearly with the number of tiles.
+
+    Parameters
+    ----------
+    tile_indices : IntArray
+        The integer index of the tiles.
+    start : int, optional
+        Only the pairs including a tile numbered `start` or later are returned, by default 0.
+
+    Returns
+    -------
+    pairs : IntArray
+        The (n_pairs, 2) array of the tile numbers, sorted lexicographically with pairs[:,0] < pairs[:,1].
+    """
+    tile_indices = np.asarray(tile_indices)
+    ndim = tile_indices.shape[1]
+    index_to_tiles : Dict[Tuple[int,...],List[int]] = defaultdict(list)
+    for j, ind in enumerate(map(tuple, tile_indices.tolist())):
+        index_to_tiles[ind].append(j)
+
+    eye = np.eye(ndim, dtype=tile_indices.dtype)
+    offsets = np.concatenate([np.zeros((1,ndim),dtype=tile_indices.dtype), eye, -eye])
+    pairs = []
+    for j1 in range(start, len(tile_indices)):
+        for neighbor in map(tuple, (tile_indices[j1] + offsets).tolist()):
+            pairs.extend((min(j1,j2),max(j1,j2)) for j2 in index_to_tiles.get(neighbor,()) 
+                         if j2 > j1 or j2 < start)
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1,2)
+    return pairs[np.lexsort((pairs[:,1],pairs[:,0]))]
+
+
+def _find_overlapping_pairs(
+    image_shape : List[Int],
+    estimated_positions : NumArray,
+    overlap_threshold_percentage : float,
+    start : int = 0,
+    ) -> IntArray:
+    """Find the pairs of tiles whose overlap area exceeds the threshold.
+
+    The candidate pairs are searched by a KD-tree in the coordinate normalized by the image shape,
+    where two tiles can overlap only if their Chebyshev distance is not larger than one.
+
+    Parameters
+    ----------
+    image_shape : List[Int]
+        The shape of a single input image.
+    estimated_positions : NumArray
+        The estimated position of the tiles in pixel.
+    overlap_threshold_percentage : float
+        The area percentage threshold to calculate pair displacement between tiles.
+    start : int, optional
+        Only the pairs including a tile numbered `start` or later are returned, by default 0.
+
+    Returns
+    -------
+    pairs : IntArray
+        The (n_pairs, 2) array of the tile numbers, sorted lexicographically with pairs[:,0] < pairs[:,1].
+    """
+    estimated_positions = np.asarray(estimated_positions, dtype=np.float64)
+    normalized_positions = estimated_positions / np.asarray(image_shape, dtype=np.float64)
+    tree = cKDTree(normalized_positions)
+    if start == 0:
+        pairs = tree.query_pairs(r=1, p=np.inf, output_type="ndarray").astype(np.int64)
+    else:
+        neighbors = tree.query_ball_point(normalized_positions[start:], r=1, p=np.inf)
+        pairs = np.array([(j2,j1) if j2 < j1 else (j1,j2)
+            for j1, js in enumerate(neighbors, start) for j2 in js if j2 > j1 or j2 < start],
+            dtype=np.int64).reshape(-1,2)
+    pairs = np.sort(pairs, axis=1)
+    ratios = _calc_overlap_area_ratio(
+        image_shape, estimated_positions[pairs[:,1]] - estimated_positions[pairs[:,0]])
+    pairs = pairs[ratios > overlap_threshold_percentage/100]
+    return pairs[np.lexsort((pairs[:,1],pairs[:,0]))]
+
+
+def _find_pairs(
+    image_shape : List[Int],
+    tile_indices : Optional[IntArray] = None, 
+    estimated_positions : Optional[NumArray] = None,
+    overlap_threshold_percentage : float = 5,
+    start : int = 0,
+    ) -> pd.DataFrame:
+    """Find the image pairs and construct the pair dataframe without checking the connectivity.
+
+    See `_parse_positions_to_pairs` for the parameters. Only the pairs including a tile numbered `start` or later are returned.
+    """
+    ndim = len(image_shape)
+    if tile_indices is not None:
+        tile_indices = np.asarray(tile_indices)
+        pairs = _find_tile_index_pairs(tile_indices, start)
+        index_displacement = tile_indices[pairs[:,1]] - tile_indices[pairs[:,0]]
+    else:
+        pairs = _find_overlapping_pairs(image_shape, estimated_positions, overlap_threshold_percentage, start)
+        index_displacement = np.full((len(pairs), ndim), np.nan)
+
+    if estimated_positions is not None:
+        estimated_positions = np.asarray(estimated_positions)
+        # image 2 position with respect to image 1
+        estimated_displacement = estimated_positions[pairs[:,1]] - estimated_positions[pairs[:,0]]
+    else:
+        estimated_displacement = np.full((len(pairs), ndim), np.nan)
+
+    pairs_df = pd.DataFrame({
+        "image_index1":pairs[:,0],
+        "image_index2":pairs[:,1],
+    })
+    _set_displacements(pairs_df, "index_displacement", index_displacement)
+    _set_displacements(pairs_df, "estimated_displacement", estimated_displacement)
+    return pairs_df
+
+
+def _label_components(n_tiles : int, pair_indices : IntArray) -> Tuple[int, IntArray]:
+    """Label the connected components of the pair graph.
+
+    Returns
+    -------
+    n_components : int
+        The number of the connected components.
+    labels : IntArray
+        The component id of each tile.
     """
-    percentage = 1.
-    for s, p in zip(image_shape,relative_pos):
-        percentage *= np.clip(1-np.abs(p/s),0,None)
-        print(p,s,percentage)
-    return percentage
+    pair_indices = np.asarray(pair_indices).reshape(-1,2)
+    pairs_graph = sparse.coo_matrix(
+        (np.ones(len(pair_indices)), (pair_indices[:,0], pair_indices[:,1])),
+        shape=(n_tiles, n_tiles))
+    return csgraph.connected_components(pairs_graph, directed=False)
 
 
 def _parse_positions_to_pairs(
@@ -28,6 +186,7 @@ def _parse_positions_to_pairs(
     tile_indices : Optional[IntArray] = None, 
     estimated_positions : Optional[NumArray] = None,
     overlap_threshold_percentage : float = 5,
+    allow_disconnected : bool = False,
     ):
     """Parse image positions to image pairs.
 
@@ -41,49 +200,150 @@ def _parse_positions_to_pairs(
         The estimated position of the tiles in pixel. If None, `tile_indices` must be supplied.
     overlap_threshold_percentage : float, optional
         The area percentage threshold to calculate pair displacement between tiles. Effective only when tile_indices is None.
+    allow_disconnected : bool, optional
+        If False (default), raise ValueError when the pair graph has more than one connected component.
     """
 
-    image_pairs = []
-    if tile_indices is not None:
-        for (j1,ind1), (j2,ind2) in combinations(enumerate(tile_indices),2):
-            # if the images are the next to each other or at the same position
-            diff = np.abs(ind1 - ind2)
-            if ((np.max(diff) == 1 and np.sum(diff == 1) == 1)) or np.all(ind1 == ind2): 
-                if estimated_positions is not None:
-                    dpos = estimated_positions[j2]-estimated_positions[j1]
-                else:
-                    dpos = None
-                image_pairs.append({
-                    "image_index1":j1,
-                    "image_index2":j2,
-                    "index_displacement":ind2-ind1,
-                    "estimated_displacement":dpos,
-                }) # image 2 position with respect to image 1
-    else:
-        for (j1,pos1), (j2,pos2) in combinations(enumerate(estimated_positions),2):
-            if _calc_overlap_area_ratio(image_shape,np.array(pos2)-np.array(pos1)) > overlap_threshold_percentage/100:
-                image_pairs.append({
-                    "image_index1":j1,
-                    "image_index2":j2,
-                    "index_displacement":None,
-                    "estimated_displacement":pos2-pos1
-                })
-    
-    if len(image_pairs) == 0:
+    pairs_df = _find_pairs(image_shape, tile_indices, estimated_positions, overlap_threshold_percentage)
+    if len(pairs_df) == 0:
         raise RuntimeError("There is no valid image pairs. Please check tile_indices and estimated_positions.")
-
-    pairs_df = pd.DataFrame.from_records(image_pairs)
-    pairs_graph = nx.Graph()
     nodes_count = len(estimated_positions if estimated_positions is not None else tile_indices) 
-    pairs_graph.add_nodes_from(range(nodes_count))
-    pairs_graph.add_edges_from(pairs_df[["image_index1","image_index2"]].values)
-
-    if len(list(nx.connected_components(pairs_graph))) > 1:
+    n_components, _ = _label_components(nodes_count, pairs_df[["image_index1","image_index2"]].values)
+    if n_components > 1 and not allow_disconnected:
         raise ValueError("Parsing positions resulted more than one connected graphs.")
 
     return pairs_df
    
 
+def _axis_names(ndim : int) -> List[str]:
+    """The names of the image axes, e.g. ["y","x"] for two-dimensional images."""
+    if ndim <= 3:
+        return list("zyx"[3-ndim:])
+    return [f"axis{axis}" for axis in range(ndim)]
+
+
+def _position_columns(ndim : int) -> List[str]:
+    """The column names of the tile positions, e.g. ["y_pos","x_pos"] for two-dimensional images."""
+    return [f"{axis}_pos" for axis in _axis_names(ndim)]
+
+
+def _displacement_columns(name : str, ndim : int) -> List[str]:
+    """The per-axis column names of a pair displacement, e.g. ["estimated_displacement_y","estimated_displacement_x"]."""
+    return [f"{name}_{axis}" for axis in _axis_names(ndim)]
+
+
+def _get_displacements(pairs_df : pd.DataFrame, name : str, ndim : int) -> FloatArray:
+    """Read the (n_pairs, ndim) float array of a pair displacement from its per-axis columns. NaN means missing."""
+    return pairs_df[_displacement_columns(name, ndim)].to_numpy(dtype=np.float64)
+
+
+def _set_displacements(pairs_df : pd.DataFrame, name : str, values : NumArray) -> None:
+    """Store the (n_pairs, ndim) array of a pair displacement in its per-axis columns in place."""
+    values = np.asarray(values)
+    for column, axis_values in zip(_displacement_columns(name, values.shape[1]), values.T):
+        pairs_df[column] = axis_values
+
+
+def _pair_weights(pairs_df : pd.DataFrame) -> Optional[FloatArray]:
+    """The confidence of the pair displacements for the global optimization, from the latest stage providing NCC."""
+    for column in ["local_optimized_ncc", "ncc"]:
+        if column in pairs_df.columns:
+            return pairs_df[column].to_numpy(dtype=np.float64)
+    return None
+
+
+def _anchor_positions(
+    pair_indices : IntArray,
+    displacement : FloatArray,
+    tile_indices : Optional[IntArray],
+    estimated_positions : Optional[NumArray],
+    ) -> FloatArray:
+    """The positions to anchor the connected components.
+
+    The estimated positions are used if available. Otherwise the tile indices are scaled by the linear map
+    from the index displacement to the pair displacement fitted by least squares.
+    """
+    if estimated_positions is not None:
+        return np.asarray(estimated_positions, dtype=np.float64)
+    tile_indices = np.asarray(tile_indices, dtype=np.float64)
+    index_displacement = tile_indices[pair_indices[:,1]] - tile_indices[pair_indices[:,0]]
+    valid = ~np.any(np.isnan(displacement), axis=1)
+    if not np.any(valid):
+        raise RuntimeError("There is no valid pair displacement to anchor the components.")
+    scale, *_ = np.linalg.lstsq(index_displacement[valid], displacement[valid], rcond=None)
+    return tile_indices @ scale
+
+
+def _optimize_component_chunk(
+    global_optimizer : GlobalOptimizer,
+    images : TileSource,
+    pair_indices : IntArray,
+    displacement : FloatArray,
+    estimated_displacement : FloatArray,
+    allowed_error : Union[float,FloatArray],
+    weights : Optional[FloatArray],
+    component_labels : IntArray,
+    anchor_positions : FloatArray,
+    components : IntArray,
+    ) -> List[Tuple[IntArray, FloatArray]]:
+    """Optimize the positions of the tiles in each component, and shift them to match the anchor positions on average."""
+    results = []
+    for component in components:
+        tiles = np.nonzero(component_labels == component)[0]
+        pair_mask = component_labels[pair_indices[:,0]] == component
+        if not np.any(pair_mask):
+            results.append((tiles, anchor_positions[tiles]))
+            continue
+        local_indices = np.full(len(component_labels), -1, dtype=np.int64)
+        local_indices[tiles] = np.arange(len(tiles))
+        positions = global_optimizer(
+            SubsetTileSource(images, tiles),
+            local_indices[pair_indices[pair_mask]],
+            displacement[pair_mask],
+            estimated_displacement[pair_mask],
+            allowed_error if np.ndim(allowed_error) == 0 else allowed_error[pair_mask],
+            weights=None if weights is None else weights[pair_mask],
+        )
+        positions = positions + np.nanmean(anchor_positions[tiles] - positions, axis=0)
+        results.append((tiles, positions))
+    return results
+
+
+def _call_pair_stage(
+    stage : Union[CandidateEstimator,PairOptimizer],
+    images : NumArray,
+    pair_indices : IntArray,
+    displacements : Sequence[Optional[NumArray]],
+    allowed_error : Union[float,FloatArray],
+    chunk : IntArray,
+    ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+    """Run a per-pair stage on a chunk of the pairs."""
+    return stage(
+        images,
+        pair_indices[chunk],
+        *[None if d is None else d[chunk] for d in displacements],
+        allowed_error if np.ndim(allowed_error) == 0 else allowed_error[chunk],
+    )
+
+
+def _search_window(
+    interpolated_displacement : FloatArray,
+    estimated_displacement : FloatArray,
+    allowed_error : Union[float,FloatArray],
+    search_radius : Optional[FloatArray],
+    ) -> Tuple[FloatArray, Union[float,FloatArray]]:
+    """The center and the radius of the search window of the pair optimizer.
+
+    The pairs with the search radius given by the position interpolator are searched around the interpolated displacement,
+    the others within the allowed error around the estimated displacement.
+    """
+    if search_radius is None:
+        return estimated_displacement, allowed_error
+    modeled = np.isfinite(search_radius)
+    center = np.where(modeled[:, np.newaxis], interpolated_displacement, estimated_displacement)
+    return center, np.where(modeled, search_radius, allowed_error)
+
+
 class Stitcher(BaseModel, extra=Extra.forbid, arbitrary_types_allowed = True):
     """Stitching base class."""
 
@@ -100,18 +360,58 @@ class Stitcher(BaseModel, extra=Extra.forbid, arbitrary_types_allowed = True):
         description="The pair displacement filtering and interpolation method. "
         + f"Must be in [{','.join(position_interpolators.keys())}] or a PositionInterpolator instance."
     )
+    position_interpolator_params : Dict[str,ArgType] = Field({},description="The arguments for position_interpolator.")
+    _position_interpolator_obj : PositionInterpolator = PrivateAttr()
  
     pair_optimizer : Union[str,PairOptimizer] = Field(
         "normalized_cross_correlation",
         description="The pair position optimization method. "
         + f"Must be in [{','.join(pair_optimizers.keys())}] or a PairOptimizer instance."
     )
+    pair_optimizer_params : Dict[str,ArgType] = Field({},description="The arguments for pair_optimizer.")
+    _pair_optimizer_obj : PairOptimizer = PrivateAttr()
 
     global_optimizer : Union[str,GlobalOptimizer] = Field(
         "elastic",
         description="The global stage position optimization method. "
         + f"Must be in [{','.join(global_optimizers.keys())}] or a GlobalOptimizer instance."
     )
+    global_optimizer_params : Dict[str,ArgType] = Field({},description="The arguments for global_optimizer.")
+    _global_optimizer_obj : GlobalOptimizer = PrivateAttr()
+
+    n_jobs : int = Field(1,
+        description="The number of workers for the per-pair stages. Negative values are counted back from the number of CPUs.")
+    executor : Literal["thread","process"] = Field("thread",
+        description=f"The executor type for the per-pair stages. Must be in [{','.join(executors.keys())}].")
+    chunk_size : Optional[int] = Field(None,
+        description="The number of pairs per scheduled chunk. If None, about four chunks are made per worker.")
+    pair_order : Optional[Literal["snake","hilbert"]] = Field("snake",
+        description="The tile traversal to order the pairs for tile locality. If None, the pairs are processed in the input order.")
+    tile_cache_bytes : Optional[int] = Field(2**30,
+        description="The memory budget in bytes for the cache of the recently read tiles. If 0, tiles are not cached.")
+    prefetch_depth : int = Field(0,
+        description="The number of upcoming tiles read ahead on background threads. If 0, tiles are read on demand. "
+        + "If tile_cache_bytes is 0, only the prefetched tiles and the tile in use are kept in memory.")
+    prefetch_threads : int = Field(2, description="The number of background threads reading the tiles ahead.")
+    stitch_components_separately : bool = Field(False,
+        description="If True, the connected components of the pair graph are stitched independently and anchored by "
+        + "the estimated positions (or the tile indices scaled by the mean displacement), instead of raising ValueError. "
+        + "The component id is stored in the \"component\" column of the results.")
+    pyramid_levels : int = Field(0,
+        description="The number of the halved resolution levels for the coarse-to-fine candidate estimation and pair optimization. "
+        + "The displacements are searched within the allowed error on the coarsest level, then refined at each finer level. "
+        + "If 0, the stages run on the full-resolution tiles only.")
+    pyramid_search_radius : int = Field(2,
+        description="The allowed error in pixel around the upsampled displacements of the coarser level at each finer pyramid level.")
+    pyramid_cache_bytes : Optional[int] = Field(None,
+        description="The memory budget in bytes for the cache of each downsampled pyramid level, separate from tile_cache_bytes. "
+        + "If None, each level keeps all its tiles, about 4**-level times the float32 size of the tiles, "
+        + "so that each tile is downsampled once.")
+    result_store_path : Optional[str] = Field(None,
+        description="The path of the file storing the results of the candidate estimation and the pair optimization, "
+        + "keyed by the tile contents, the search windows and the stage parameters. The stored pairs are not recomputed "
+        + "in the later calls, e.g. after a crash or when only the global optimizer is changed. If None, the results are not stored.")
+    _prefetch_stats : Optional[PrefetchStats] = PrivateAttr(None)
 
     def __init__(self, **data: Any) -> None:
         super().__init__(**data)
@@ -120,20 +420,358 @@ class Stitcher(BaseModel, extra=Extra.forbid, arbitrary_types_allowed = True):
             if isinstance(getattr(self,key),str):
                 setattr(self,"_"+key+"_obj", choices[getattr(self,key)](**params))
             else:
-                setattr(self,"_"+key+"_obj", getattr(self,key)(**params))
+                setattr(self,"_"+key+"_obj", getattr(self,key))
+
+    @property
+    def prefetch_stats(self) -> Optional[PrefetchStats]:
+        """The tile I/O statistics of the last `stitch` call, available if `prefetch_depth` > 0."""
+        return self._prefetch_stats
+
+    def _run_pair_stage(self,
+            stage : Union[CandidateEstimator,PairOptimizer],
+            images : NumArray,
+            pair_indices : IntArray,
+            displacements : Sequence[Optional[NumArray]],
+            allowed_error : Union[float,FloatArray],
+            order : Optional[IntArray] = None,
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Run a per-pair stage over chunks of the pairs and concatenate the results in the pair order.
+
+        `allowed_error` is either a scalar or the per-pair array. If `order` is given, the pairs are processed
+        in that order and the results are permuted back.
+        """
+        if order is None:
+            order = np.arange(len(pair_indices))
+        results = map_chunks(
+            partial(_call_pair_stage, stage, images, pair_indices[order], 
+                    [None if d is None else d[order] for d in displacements],
+                    allowed_error if np.ndim(allowed_error) == 0 else np.asarray(allowed_error)[order]),
+            len(pair_indices),
+            self.n_jobs,
+            self.executor,
+            self.chunk_size,
+        )
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        values = np.concatenate([r[0] for r in results])[inverse]
+        extra_fields = {k : np.concatenate([r[1][k] for r in results])[inverse] for k in results[0][1]}
+        return values, extra_fields
+
+    def _run_pyramid_stage(self,
+            stage : Union[CandidateEstimator,PairOptimizer],
+            pyramid : Sequence[TileSource],
+            pair_indices : IntArray,
+            displacements : Sequence[Optional[NumArray]],
+            allowed_error : Union[float,FloatArray],
+            order : Optional[IntArray] = None,
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Run a per-pair stage coarse to fine over the tile pyramid.
+
+        The stage searches within `allowed_error` on the coarsest level. At each finer level, all the input displacements
+        are replaced by the doubled result of the coarser level and searched within `pyramid_search_radius`.
+        The extra fields of the full-resolution level are returned.
+        """
+        result : Optional[FloatArray] = None
+        for level in reversed(range(len(pyramid))):
+            if result is None:
+                scale = 2 ** level
+                level_displacements = [None if d is None else d / scale for d in displacements]
+                level_allowed_error = allowed_error / scale
+            else:
+                level_displacements = [2 * result for _ in displacements]
+                level_allowed_error = self.pyramid_search_radius
+            if isinstance(stage, CandidateEstimator) and len(pyramid) > 1:
+                # the cached spectra are specific to the level
+                stage.clear_cache()
+            result, extra_fields = self._run_pair_stage(
+                stage, pyramid[level], pair_indices, level_displacements, level_allowed_error, order)
+        return result, extra_fields
+
+    def _run_stored_stage(self,
+            stage : Union[CandidateEstimator,PairOptimizer],
+            pyramid : Sequence[TileSource],
+            pair_indices : IntArray,
+            displacements : Sequence[Optional[NumArray]],
+            allowed_error : Union[float,FloatArray],
+            order : Optional[IntArray],
+            store : Optional[PairResultStore],
+            tile_digests : Dict[int,str],
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Run a per-pair stage for the pairs missing in the result store, and store their results.
+
+        `tile_digests` caches the content hashes of the tiles and is updated in place.
+        """
+        if store is None:
+            return self._run_pyramid_stage(stage, pyramid, pair_indices, displacements, allowed_error, order)
+
+        for index in np.unique(pair_indices):
+            if index not in tile_digests:
+                tile_digests[index] = tile_digest(pyramid[0][index])
+        stage_key = ":".join([type(stage).__module__, type(stage).__qualname__, stage.json(sort_keys=True),
+                              str(self.pyramid_levels), str(self.pyramid_search_radius)])
+        allowed_errors = np.broadcast_to(np.asarray(allowed_error, dtype=np.float64), (len(pair_indices),))
+        keys = pair_result_keys(stage_key, tile_digests, pair_indices, displacements, allowed_errors)
+        results = store.get_many(keys)
+
+        missing = np.array([key not in results for key in keys], dtype=bool)
+        if np.any(missing):
+            subset = np.nonzero(missing)[0]
+            subset_order = None if order is None else (np.cumsum(missing) - 1)[order[missing[order]]]
+            values, extra_fields = self._run_pyramid_stage(
+                stage, pyramid, pair_indices[subset],
+                [None if d is None else d[subset] for d in displacements],
+                allowed_errors[subset], subset_order)
+            computed = [(keys[j], (values[i], {k : v[i] for k, v in extra_fields.items()})) for i, j in enumerate(subset)]
+            store.put_many(computed)
+            results.update(computed)
+
+        values = np.stack([results[key][0] for key in keys])
+        extra_fields = {k : np.array([results[key][1][k] for key in keys]) for k in results[keys[0]][1]}
+        return values, extra_fields
+
+    def _interpolate(self,
+            images : TileSource,
+            pairs_df : pd.DataFrame,
+            candidate_displacement : FloatArray,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            interpolation_context : Optional[pd.DataFrame] = None,
+            ) -> Tuple[FloatArray, Dict[str,NumArray]]:
+        """Run the position interpolator on the pairs, fitted together with the pairs of `interpolation_context` if given."""
+        ndim = len(images.shape[1:])
+        columns = ["image_index1","image_index2"]
+        if interpolation_context is None or len(interpolation_context) == 0:
+            return self._position_interpolator_obj(
+                images, 
+                pairs_df[columns].values,
+                candidate_displacement,
+                estimated_displacement,
+                allowed_error,
+                index_displacement=_get_displacements(pairs_df, "index_displacement", ndim),
+            )
+        n_context = len(interpolation_context)
+        interpolated_displacement, extra_fields = self._position_interpolator_obj(
+            images,
+            np.concatenate([interpolation_context[columns].values, pairs_df[columns].values]),
+            np.concatenate([_get_displacements(interpolation_context, "candidate_displacement", ndim), candidate_displacement]),
+            np.concatenate([_get_displacements(interpolation_context, "estimated_displacement", ndim), estimated_displacement]),
+            # the search radii of the context pairs are discarded
+            np.concatenate([np.full(n_context, np.inf), np.broadcast_to(allowed_error, (len(pairs_df),))]),
+            index_displacement=np.concatenate([_get_displacements(interpolation_context, "index_displacement", ndim),
+                                               _get_displacements(pairs_df, "index_displacement", ndim)]),
+        )
+        return interpolated_displacement[n_context:], {k : values[n_context:] for k, values in extra_fields.items()}
+
+    def _run_pair_stages(self,
+            images : TileSource,
+            pyramid : Sequence[TileSource],
+            pairs_df : pd.DataFrame,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            order : Optional[IntArray],
+            store : Optional[PairResultStore],
+            tile_digests : Dict[int,str],
+            interpolation_context : Optional[pd.DataFrame] = None,
+            ) -> FloatArray:
+        """Run the per-pair stages, store the pair results in `pairs_df` in place and return the local optimized displacements.
+
+        If `interpolation_context` is given, the position interpolator is fitted on its candidate displacements
+        together with those of `pairs_df`, and only the results of `pairs_df` are stored.
+        """
+        ndim = len(images.shape[1:])
+        pair_indices = pairs_df[["image_index1","image_index2"]].values
+        self._candidate_estimator_obj.clear_cache()
+        try:
+            candidate_displacement, extra_fields = self._run_stored_stage(
+                self._candidate_estimator_obj,
+                pyramid, 
+                pair_indices,
+                [estimated_displacement],
+                allowed_error,
+                order,
+                store,
+                tile_digests,
+            )
+        finally:
+            self._candidate_estimator_obj.clear_cache()
+        _set_displacements(pairs_df, "candidate_displacement", candidate_displacement)
+        for k, values in extra_fields.items():
+            pairs_df[k] = values
+
+        interpolated_displacement, extra_fields = self._interpolate(
+            images, pairs_df, candidate_displacement, estimated_displacement, allowed_error, interpolation_context)
+        _set_displacements(pairs_df, "interpolated_displacement", interpolated_displacement)
+        for k, values in extra_fields.items():
+            pairs_df[k] = values
+
+        window_center, window_radius = _search_window(
+            interpolated_displacement, estimated_displacement, allowed_error, extra_fields.get("search_radius"))
+        local_optimized_displacement, extra_fields = self._run_stored_stage(
+            self._pair_optimizer_obj,
+            pyramid, 
+            pair_indices,
+            [interpolated_displacement, window_center],
+            window_radius,
+            order,
+            store,
+            tile_digests,
+        )
+        _set_displacements(pairs_df, "local_optimized_displacement", local_optimized_displacement)
+        for k, values in extra_fields.items():
+            pairs_df["local_optimized_"+k] = values
+        return local_optimized_displacement
+
+    def _run_stages(self,
+            images : TileSource,
+            pairs_df : pd.DataFrame,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            order : Optional[IntArray] = None,
+            search_again : Optional[SearchAgainCallback] = None,
+            interpolation_context : Optional[pd.DataFrame] = None,
+            ) -> Tuple[FloatArray, Union[float,FloatArray]]:
+        """Run the per-pair stages on the pairs, store the pair results in `pairs_df` in place
+        and return the estimated displacements and allowed errors for the global optimization.
+
+        `allowed_error` is either a scalar or the per-pair array. If `result_store_path` is set, the per-pair results
+        are read from and written to the result store. See `_run_pair_stages` for `interpolation_context`.
+        If `search_again` is given, it is called with `pairs_df` after the per-pair stages and returns None or the mask
+        of the pairs to search again with the new estimated displacements and allowed errors of all the pairs.
+        Only these pairs run the per-pair stages again, fitting the position interpolator together with the other pairs
+        with their "estimated_displacement" columns as the baseline, and the new estimated displacements and allowed errors are returned.
+        """
+        tile_digests : Dict[int,str] = {}
+        pyramid = build_tile_pyramid(images, self.pyramid_levels, self.pyramid_cache_bytes)
+        with PairResultStore(self.result_store_path) if self.result_store_path is not None else nullcontext() as store:
+            self._run_pair_stages(
+                images, pyramid, pairs_df, estimated_displacement, allowed_error, order, store, tile_digests,
+                interpolation_context)
+            researched = search_again(pairs_df) if search_again is not None else None
+            if researched is not None and np.any(researched[0]):
+                mask, estimated_displacement, allowed_error = researched
+                subset = np.nonzero(mask)[0]
+                subset_order = None if order is None else (np.cumsum(mask) - 1)[order[mask[order]]]
+                subset_df = pairs_df.iloc[subset].copy()
+                # the interpolator is fitted on the full set of the pairs, not only on the searched again ones
+                context_df = pairs_df.iloc[np.nonzero(~mask)[0]]
+                if interpolation_context is not None:
+                    context_df = pd.concat([interpolation_context, context_df], ignore_index=True)
+                self._run_pair_stages(
+                    images, pyramid, subset_df, estimated_displacement[subset],
+                    np.broadcast_to(allowed_error, (len(pairs_df),))[subset],
+                    subset_order, store, tile_digests, context_df)
+                for column in subset_df.columns:
+                    pairs_df.loc[pairs_df.index[subset], column] = subset_df[column].to_numpy()
+        return estimated_displacement, allowed_error
+
+    def _register_pairs(self,
+            images : TileSource,
+            pairs_df : pd.DataFrame,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            grid_coords : NumArray,
+            search_again : Optional[SearchAgainCallback] = None,
+            interpolation_context : Optional[pd.DataFrame] = None,
+            ) -> Tuple[FloatArray, Union[float,FloatArray]]:
+        """Run the per-pair stages in the locality order of `grid_coords`, reading the tiles through the prefetcher
+        or the tile cache. See `_run_stages` for the other arguments."""
+        pair_indices = pairs_df[["image_index1","image_index2"]].values
+        order = order_pairs(pair_indices, grid_coords, self.pair_order)
+        if self.prefetch_depth > 0:
+            tile_order = pd.unique(pair_indices[order].ravel())
+            # without the cache, the prefetched tiles are kept only until they are used
+            images = PrefetchingTileSource(images, tile_order, self.prefetch_depth, self.prefetch_threads,
+                self.tile_cache_bytes if self.tile_cache_bytes != 0 else (self.prefetch_depth + 1) * images.tile_nbytes)
+            self._prefetch_stats = images.stats
+        elif self.tile_cache_bytes != 0:
+            images = CachedTileSource(images, self.tile_cache_bytes)
+
+        try:
+            return self._run_stages(images, pairs_df, estimated_displacement, allowed_error, order,
+                search_again, interpolation_context)
+        finally:
+            if isinstance(images, PrefetchingTileSource):
+                images.close()
+
+    def _optimize_positions(self,
+            images : TileSource,
+            pairs_df : pd.DataFrame,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            component_labels : Optional[IntArray] = None,
+            tile_indices : Optional[IntArray] = None,
+            estimated_positions : Optional[NumArray] = None,
+            initial_positions : Optional[NumArray] = None,
+            ) -> FloatArray:
+        """Optimize the tile positions from the local optimized displacements in `pairs_df`.
+
+        If `component_labels` is given, the global optimization runs for each component independently,
+        anchored by `estimated_positions` or `tile_indices`. Otherwise it is warm-started from `initial_positions`.
+        """
+        ndim = len(images.shape[1:])
+        pair_indices = pairs_df[["image_index1","image_index2"]].values
+        local_optimized_displacement = _get_displacements(pairs_df, "local_optimized_displacement", ndim)
+        if component_labels is not None:
+            return self._optimize_components(
+                images, 
+                pair_indices,
+                local_optimized_displacement,
+                estimated_displacement,
+                allowed_error,
+                _pair_weights(pairs_df),
+                component_labels,
+                _anchor_positions(pair_indices, local_optimized_displacement, tile_indices, estimated_positions),
+            )
+        return self._global_optimizer_obj(
+            images, 
+            pair_indices,
+            local_optimized_displacement,
+            estimated_displacement,
+            allowed_error,
+            initial_positions=initial_positions,
+            weights=_pair_weights(pairs_df),
+        )
+
+    def _optimize_components(self,
+            images : TileSource,
+            pair_indices : IntArray,
+            displacement : FloatArray,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            weights : Optional[FloatArray],
+            component_labels : IntArray,
+            anchor_positions : FloatArray,
+            ) -> FloatArray:
+        """Run the global optimizer for each connected component in parallel and anchor the components."""
+        n_components = int(component_labels.max()) + 1
+        results = map_chunks(
+            partial(_optimize_component_chunk, self._global_optimizer_obj, images, pair_indices, displacement,
+                    estimated_displacement, allowed_error, weights, component_labels, anchor_positions),
+            n_components,
+            self.n_jobs,
+            self.executor,
+            chunk_size=1,
+        )
+        positions = np.empty_like(anchor_positions, dtype=np.float64)
+        for chunk_results in results:
+            for tiles, component_positions in chunk_results:
+                positions[tiles] = component_positions
+        return positions
 
     def stitch(self, 
-               images : NumArray, 
+               images : TileSourceLike, 
                tile_indices : Optional[IntArray] = None, 
                estimated_positions : Optional[NumArray] = None,
                overlap_threshold_percentage : float = 5,
-               allowed_error : float = 20):
+               allowed_error : float = 20) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """Calculate stitched positions of mosaic images.
 
         Parameters
         ----------
-        images : NumArray
+        images : TileSourceLike
             The input images. The first dimension corresponds to the mosaic position.
+            Either an array-like object (e.g. ndarray, np.memmap or a chunked array), 
+            a TileSource, or a callable returning tile i. The tiles are read on demand.
         tile_indices : Optional[IntArray], optional
             The integer index of the tiles. If None, `estimated_positions` must be supplied.
         estimated_positions : Optional[NumArray], optional
@@ -142,9 +780,19 @@ class Stitcher(BaseModel, extra=Extra.forbid, arbitrary_types_allowed = True):
             The area percentage threshold to calculate pair displacement between tiles. Effective only when tile_indices is None.
         allowed_error : float, optional
             The allowed error from the `estimated_positions` in pixel, by default 20.
+
+        Returns
+        -------
+        positions_df : pd.DataFrame
+            The stitched tile positions indexed by the tile number, with the columns such as "y_pos" and "x_pos".
+        pairs_df : pd.DataFrame
+            The image pairs with the displacements computed at each stage, stored in the numeric per-axis columns
+            such as "candidate_displacement_y" and "candidate_displacement_x". NaN means missing.
         """
         if tile_indices is None and estimated_positions is None:
             raise ValueError("tile_indices and estimated_positions must not be None together.")
+        images = as_tile_source(images, 
+            n_tiles=len(tile_indices) if tile_indices is not None else len(estimated_positions))
         if (tile_indices is not None and estimated_positions is not None) and (len(tile_indices) != len(estimated_positions)):
             raise ValueError("tile_indices and estimated_positions must have the same length.")
         if (estimated_positions is not None) and len(estimated_positions) < 2:
@@ -159,39 +807,69 @@ class Stitcher(BaseModel, extra=Extra.forbid, arbitrary_types_allowed = True):
             images.shape[1:],
             tile_indices,
             estimated_positions,
-            overlap_threshold_percentage
+            overlap_threshold_percentage,
+            allow_disconnected=self.stitch_components_separately,
         )
+        estimated_displacement = _get_displacements(pairs_df, "estimated_displacement", len(images.shape[1:]))
+        return self.stitch_pairs(images, pairs_df, estimated_displacement, allowed_error, tile_indices, estimated_positions)
 
-        pair_indices = pairs_df[["image_index1","image_index2"]].values
-        pairs_df["candidate_displacement"], extra_fields = self._candidate_estimator_obj(
-            images, 
-            pair_indices,
-            pairs_df["estimated_displacement"].to_numpy(),
-            allowed_error,
-        )
-        for k, values in extra_fields.items():
-            pairs_df[k] = values
+    def stitch_pairs(self,
+            images : TileSource,
+            pairs_df : pd.DataFrame,
+            estimated_displacement : FloatArray,
+            allowed_error : Union[float,FloatArray],
+            tile_indices : Optional[IntArray] = None,
+            estimated_positions : Optional[NumArray] = None,
+            search_again : Optional[SearchAgainCallback] = None,
+            ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Run the stitching stages on already parsed pairs with the given search windows.
 
-        pairs_df["interpolated_displacement"] = self.position_interpolator(
-            images, 
-            pair_indices,
-            pairs_df["candidate_displacement"].to_numpy(),
-            pairs_df["estimated_displacement"].to_numpy(),
-            allowed_error,
-        )
+        Parameters
+        ----------
+        images : TileSource
+            The input images.
+        pairs_df : pd.DataFrame
+            The image pairs with the "image_index1", "image_index2", "estimated_displacement" and "index_displacement"
+            columns, as returned by `stitch`. Updated in place.
+        estimated_displacement : FloatArray
+            The estimated displacements of the pairs, the centers of the search windows.
+        allowed_error : Union[float,FloatArray]
+            The allowed error from `estimated_displacement` in pixel, either a scalar or the per-pair array.
+        tile_indices : Optional[IntArray], optional
+            The integer index of the tiles. If None, `estimated_positions` must be supplied.
+        estimated_positions : Optional[NumArray], optional
+            The estimated position of the tiles in pixel. If None, `tile_indices` must be supplied.
+        search_again : Optional[SearchAgainCallback], optional
+            Called with `pairs_df` after the per-pair stages. Returns None, or the mask of the pairs to search again
+            with the new estimated displacements and allowed errors of all the pairs. The position interpolator of the
+            searched again pairs is fitted together with the other pairs.
 
-        pairs_df["local_optimized_displacement"] = self.pair_optimizer(
-            images, 
-            pair_indices,
-            pairs_df["interpolated_displacement"].to_numpy(),
-            pairs_df["estimated_displacement"].to_numpy(),
-            allowed_error,
-        )
+        Returns
+        -------
+        positions_df : pd.DataFrame
+            The stitched tile positions. See `stitch`.
+        pairs_df : pd.DataFrame
+            The image pairs with the displacements computed at each stage. See `stitch`.
+        """
+        if self.stitch_components_separately:
+            _, component_labels = _label_components(len(images), pairs_df[["image_index1","image_index2"]].values)
+        else:
+            component_labels = None
 
-        pairs_df["global_optimized_position"] = self.global_optimizer(
-            images, 
-            pair_indices,
-            pairs_df["local_optimized_displacement"].to_numpy(),
-            pairs_df["estimated_displacement"].to_numpy(),
-            allowed_error,
-        )
\ No newline at end of file
+        ndim = len(images.shape[1:])
+        pair_indices = pairs_df[["image_index1","image_index2"]].values
+
+        if tile_indices is not None:
+            grid_coords = tile_indices
+        else:
+            grid_coords = np.asarray(estimated_positions) / np.array(images.shape[1:])
+        estimated_displacement, allowed_error = self._register_pairs(
+            images, pairs_df, estimated_displacement, allowed_error, grid_coords, search_again)
+        positions = self._optimize_positions(images, pairs_df, estimated_displacement, allowed_error,
+            component_labels, tile_indices, estimated_positions)
+
+        positions_df = pd.DataFrame(positions, columns=_position_columns(ndim))
+        if component_labels is not None:
+            positions_df["component"] = component_labels
+            pairs_df["component"] = component_labels[pair_indices[:,0]]
+        return positions_df, pairs_df
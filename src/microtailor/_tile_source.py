@@ -0,0 +1,577 @@
+import mmap
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+from pydantic import BaseModel, Field
+
+from ._cache import LRUCache
+from ._typing_utils import FloatArray, NumArray
+
+
+class TileSource(ABC):
+    """Random access to the tiles of a mosaic, read on demand.
+
+    Subclasses implement `shape`, `dtype` and `__getitem__` for an integer tile index.
+    The stitching stages only access `shape`, `dtype`, `len()`, `source[i]` and `read_region`,
+    so that only the tiles in flight are held in memory.
+    """
+
+    @property
+    @abstractmethod
+    def shape(self) -> Tuple[int, ...]:
+        """The shape of the whole dataset, (n_tiles, *tile_shape)."""
+        ...
+
+    @property
+    @abstractmethod
+    def dtype(self) -> np.dtype:
+        """The dtype of the tiles."""
+        ...
+
+    @abstractmethod
+    def __getitem__(self, index : int) -> NumArray:
+        """Read the tile `index` as an ndarray."""
+        ...
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def tile_shape(self) -> Tuple[int, ...]:
+        return tuple(self.shape[1:])
+
+    @property
+    def tile_nbytes(self) -> int:
+        """The memory size of a single tile in bytes."""
+        return int(np.prod(self.tile_shape)) * np.dtype(self.dtype).itemsize
+
+    def read_region(self, index : int, slices : Tuple[slice, ...]) -> NumArray:
+        """Read a region of the tile `index`. Subclasses may override it to avoid reading the whole tile."""
+        return self[index][slices]
+
+
+class ArrayTileSource(TileSource):
+    """Tile source backed by an array-like object.
+
+    Any object with `shape`, `dtype` and NumPy-style indexing works, e.g. `np.ndarray`, `np.memmap`,
+    or chunked arrays such as zarr, h5py or dask arrays. Only the requested tiles are converted to ndarrays.
+
+    Parameters
+    ----------
+    array : Any
+        The array-like object. The first dimension corresponds to the mosaic position.
+    """
+
+    def __init__(self, array : Any) -> None:
+        self.array = array
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self.array.shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.array.dtype)
+
+    def __getitem__(self, index : int) -> NumArray:
+        return np.asarray(self.array[int(index)])
+
+    def read_region(self, index : int, slices : Tuple[slice, ...]) -> NumArray:
+        return np.asarray(self.array[(int(index),) + tuple(slices)])
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # reopen memory-mapped files instead of copying their contents to worker processes
+        if isinstance(self.array, np.memmap) and self.array.filename is not None \
+                and getattr(self.array, "_mmap", None) is not None:
+            position = _memmap_file_position(self.array)
+            contiguous = self.array.flags.c_contiguous or self.array.flags.f_contiguous
+            if contiguous and position == self.array.offset \
+                    and os.path.getsize(self.array.filename) - self.array.offset == self.array.nbytes:
+                return {
+                    "memmap": dict(
+                        filename=self.array.filename,
+                        dtype=self.array.dtype,
+                        mode="r",
+                        offset=self.array.offset,
+                        shape=self.array.shape,
+                        order="F" if self.array.flags.f_contiguous and not self.array.flags.c_contiguous else "C",
+                    )
+                }
+            # a view of the file, e.g. sliced or strided, is rebuilt from its position and strides
+            return {
+                "memmap_view": dict(
+                    filename=self.array.filename,
+                    dtype=self.array.dtype,
+                    shape=self.array.shape,
+                    strides=self.array.strides,
+                    offset=position,
+                )
+            }
+        return {"array": self.array}
+
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        if "memmap" in state:
+            self.array = np.memmap(**state["memmap"])
+        elif "memmap_view" in state:
+            view = dict(state["memmap_view"])
+            self.array = np.ndarray(buffer=np.memmap(view.pop("filename"), dtype=np.uint8, mode="r"), **view)
+        else:
+            self.array = state["array"]
+
+
+def _memmap_file_position(array : np.memmap) -> int:
+    """The byte position in the file of the first element of a memory-mapped array or its view."""
+    # np.memmap maps the file from the offset rounded down to the allocation granularity
+    mapped_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    return mapped_start + array.ctypes.data - np.frombuffer(array._mmap, dtype=np.uint8).ctypes.data
+
+
+class CallableTileSource(TileSource):
+    """Tile source backed by a loader function returning tile i.
+
+    Parameters
+    ----------
+    loader : Callable[[int], NumArray]
+        The function to load a tile from the tile index.
+    n_tiles : int
+        The number of tiles.
+    tile_shape : Optional[Tuple[int, ...]], optional
+        The shape of a single tile. If None, the first tile is loaded to determine it.
+    dtype : Optional[npt.DTypeLike], optional
+        The dtype of the tiles. If None, the first tile is loaded to determine it.
+    """
+
+    def __init__(
+        self,
+        loader : Callable[[int], NumArray],
+        n_tiles : int,
+        tile_shape : Optional[Tuple[int, ...]] = None,
+        dtype : Optional[npt.DTypeLike] = None,
+    ) -> None:
+        self.loader = loader
+        self.n_tiles = n_tiles
+        if tile_shape is None or dtype is None:
+            first_tile = np.asarray(loader(0))
+            tile_shape = first_tile.shape if tile_shape is None else tile_shape
+            dtype = first_tile.dtype if dtype is None else dtype
+        self._tile_shape = tuple(tile_shape)
+        self._dtype = np.dtype(dtype)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (self.n_tiles,) + self._tile_shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    def __getitem__(self, index : int) -> NumArray:
+        index = int(index)
+        if not 0 <= index < self.n_tiles:
+            raise IndexError(f"tile index {index} is out of range for {self.n_tiles} tiles.")
+        tile = np.asarray(self.loader(index))
+        if tile.shape != self._tile_shape:
+            raise ValueError(f"the loader returned the shape {tile.shape} for tile {index}, expected {self._tile_shape}.")
+        return tile
+
+
+class CachedTileSource(TileSource):
+    """Tile source keeping the recently read tiles in an LRU cache under a memory budget.
+
+    Parameters
+    ----------
+    source : TileSource
+        The underlying tile source.
+    max_bytes : Optional[int]
+        The memory budget of the cache in bytes. If None, the cache is unbounded.
+    """
+
+    def __init__(self, source : TileSource, max_bytes : Optional[int]) -> None:
+        self.source = source
+        self.cache = LRUCache(max_bytes)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.source.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.source.dtype
+
+    def __getitem__(self, index : int) -> NumArray:
+        index = int(index)
+        return self.cache.get_or_compute(index, lambda: self.source[index])
+
+
+class SubsetTileSource(TileSource):
+    """Tile source exposing a subset of the tiles of another source, renumbered from zero.
+
+    Parameters
+    ----------
+    source : TileSource
+        The underlying tile source.
+    indices : Sequence[int]
+        The tile indices in `source` of the subset.
+    """
+
+    def __init__(self, source : TileSource, indices : Sequence[int]) -> None:
+        self.source = source
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (len(self.indices),) + tuple(self.source.shape[1:])
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.source.dtype
+
+    def __getitem__(self, index : int) -> NumArray:
+        return self.source[self.indices[int(index)]]
+
+    def read_region(self, index : int, slices : Tuple[slice, ...]) -> NumArray:
+        return self.source.read_region(self.indices[int(index)], slices)
+
+
+class StackTileSource(TileSource):
+    """Tile source flattening a multichannel or time-lapse stack of the tiles.
+
+    The stack has the shape (n_tiles, *stack_shape, *tile_shape), e.g. (n_tiles, T, C, Y, X).
+    The flat tile `s * n_tiles + i` is the tile i of the image at the C-order flat stack index s,
+    so that `image_indices` selects the tiles of one image for `SubsetTileSource`. Only the requested tiles are read.
+
+    Parameters
+    ----------
+    stack : Any
+        The array-like stack, e.g. `np.ndarray`, `np.memmap` or a chunked array.
+    stack_ndim : int
+        The number of the stack axes after the tile axis.
+    """
+
+    def __init__(self, stack : Any, stack_ndim : int) -> None:
+        if stack_ndim < 0 or stack.ndim < stack_ndim + 2:
+            raise ValueError("stack must have the tile axis, the stack axes and at least one spatial axis.")
+        self.stack = stack
+        self.stack_ndim = stack_ndim
+
+    @property
+    def n_tiles(self) -> int:
+        return int(self.stack.shape[0])
+
+    @property
+    def stack_shape(self) -> Tuple[int, ...]:
+        return tuple(self.stack.shape[1:1 + self.stack_ndim])
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (self.n_tiles * int(np.prod(self.stack_shape)),) + tuple(self.stack.shape[1 + self.stack_ndim:])
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.stack.dtype)
+
+    def image_indices(self, stack_index : Tuple[int, ...]) -> NumArray:
+        """Return the flat tile indices of the image at `stack_index`."""
+        start = int(np.ravel_multi_index(tuple(stack_index), self.stack_shape)) * self.n_tiles
+        return np.arange(start, start + self.n_tiles)
+
+    def _stack_index(self, index : int) -> Tuple[int, ...]:
+        flat_stack_index, tile_index = divmod(int(index), self.n_tiles)
+        return (tile_index,) + tuple(int(i) for i in np.unravel_index(flat_stack_index, self.stack_shape))
+
+    def __getitem__(self, index : int) -> NumArray:
+        return np.asarray(self.stack[self._stack_index(index)])
+
+    def read_region(self, index : int, slices : Tuple[slice, ...]) -> NumArray:
+        return np.asarray(self.stack[self._stack_index(index) + tuple(slices)])
+
+
+def downsample_mean(array : NumArray, factor : int = 2) -> FloatArray:
+    """Average an array over blocks of `factor` pixels along each axis in float32.
+
+    The trailing pixels that do not fill a block are discarded.
+    """
+    array = np.asarray(array, dtype=np.float32)
+    shape = tuple(n // factor for n in array.shape)
+    array = array[tuple(slice(0, n * factor) for n in shape)]
+    blocks = array.reshape(tuple(m for n in shape for m in (n, factor)))
+    return blocks.mean(axis=tuple(range(1, 2 * len(shape), 2)))
+
+
+class DownsampledTileSource(TileSource):
+    """Tile source averaging the tiles of another source over blocks of `factor` pixels along each axis.
+
+    The trailing pixels that do not fill a block are discarded.
+
+    Parameters
+    ----------
+    source : TileSource
+        The underlying tile source.
+    factor : int, optional
+        The downsampling factor, by default 2.
+    """
+
+    def __init__(self, source : TileSource, factor : int = 2) -> None:
+        if factor < 1:
+            raise ValueError("factor must be positive.")
+        self.source = source
+        self.factor = factor
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (len(self.source),) + tuple(n // self.factor for n in self.source.tile_shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(np.float32)
+
+    def __getitem__(self, index : int) -> NumArray:
+        return downsample_mean(self.source[index], self.factor)
+
+
+def build_tile_pyramid(source : TileSource, n_levels : int, max_bytes : Optional[int] = None) -> List[TileSource]:
+    """Build the tile pyramid halving the tiles at each level.
+
+    Each level is computed from the cached tiles of the previous level, so that each tile is downsampled
+    once per level as long as it stays in the cache. The level caches are independent of the cache of `source`.
+
+    Parameters
+    ----------
+    source : TileSource
+        The full-resolution tile source, returned as level 0.
+    n_levels : int
+        The number of the downsampled levels.
+    max_bytes : Optional[int], optional
+        The memory budget in bytes of the cache of each downsampled level. If None, the caches are unbounded
+        and each level keeps all its tiles.
+
+    Returns
+    -------
+    pyramid : List[TileSource]
+        The tile sources from the full resolution to the coarsest level.
+    """
+    pyramid = [source]
+    for _ in range(n_levels):
+        pyramid.append(CachedTileSource(DownsampledTileSource(pyramid[-1], 2), max_bytes))
+    return pyramid
+
+
+class ConcatenatedTileSource(TileSource):
+    """Tile source chaining several tile sources with the same tile shape, e.g. batches of acquired tiles.
+
+    Parameters
+    ----------
+    sources : Sequence[TileSource]
+        The tile sources. More sources can be appended later with `append`.
+    """
+
+    def __init__(self, sources : Sequence[TileSource] = ()) -> None:
+        self.sources : List[TileSource] = []
+        self._offsets = [0]
+        for source in sources:
+            self.append(source)
+
+    def append(self, source : TileSource) -> None:
+        """Append the tiles of a source after the current tiles."""
+        if self.sources and source.tile_shape != self.tile_shape:
+            raise ValueError(f"the tile shape {source.tile_shape} differs from {self.tile_shape}.")
+        self.sources.append(source)
+        self._offsets.append(self._offsets[-1] + len(source))
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if not self.sources:
+            return (0,)
+        return (self._offsets[-1],) + self.sources[0].tile_shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.result_type(*[source.dtype for source in self.sources])
+
+    def _locate(self, index : int) -> Tuple[TileSource, int]:
+        index = int(index)
+        if not 0 <= index < self._offsets[-1]:
+            raise IndexError(f"tile index {index} is out of range for {self._offsets[-1]} tiles.")
+        source_index = int(np.searchsorted(self._offsets, index, side="right")) - 1
+        return self.sources[source_index], index - self._offsets[source_index]
+
+    def __getitem__(self, index : int) -> NumArray:
+        source, local_index = self._locate(index)
+        return source[local_index]
+
+    def read_region(self, index : int, slices : Tuple[slice, ...]) -> NumArray:
+        source, local_index = self._locate(index)
+        return source.read_region(local_index, slices)
+
+
+class PrefetchStats(BaseModel):
+    """The I/O statistics of a PrefetchingTileSource."""
+
+    n_requests : int = Field(0, description="The number of tile requests.")
+    n_ready : int = Field(0, description="The number of requests served without waiting.")
+    n_waited : int = Field(0, description="The number of requests waiting for a prefetch in flight.")
+    n_sync_reads : int = Field(0, description="The number of tiles read synchronously because they were not prefetched.")
+    wait_seconds : float = Field(0., description="The total time spent waiting for tiles in seconds.")
+    max_wait_seconds : float = Field(0., description="The longest wait for a single tile in seconds.")
+
+
+class PrefetchingTileSource(TileSource):
+    """Tile source reading the upcoming tiles on background threads.
+
+    When a tile is requested, the next `depth` tiles in `tile_order` are submitted to a thread pool,
+    so that reading them overlaps with the computation on the current tiles. The read tiles are kept
+    in an LRU cache under a memory budget.
+
+    Parameters
+    ----------
+    source : TileSource
+        The underlying tile source.
+    tile_order : Sequence[int]
+        The expected order of the tile requests.
+    depth : int, optional
+        The number of tiles to read ahead, by default 4.
+    n_threads : int, optional
+        The number of reader threads, by default 2.
+    max_bytes : Optional[int], optional
+        The memory budget of the tile cache in bytes. If None, the cache is unbounded.
+        Must hold at least `depth` tiles to be effective.
+    """
+
+    def __init__(
+        self,
+        source : TileSource,
+        tile_order : Sequence[int],
+        depth : int = 4,
+        n_threads : int = 2,
+        max_bytes : Optional[int] = None,
+    ) -> None:
+        self.source = source
+        self.tile_order = [int(i) for i in tile_order]
+        self.depth = depth
+        self.n_threads = n_threads
+        self.max_bytes = max_bytes
+        self.cache = LRUCache(max_bytes)
+        self.stats = PrefetchStats()
+        self._positions = {index: position for position, index in enumerate(self.tile_order)}
+        self._futures : Dict[int, "Future[NumArray]"] = {}
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.source.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.source.dtype
+
+    def _read(self, index : int) -> NumArray:
+        tile = self.source[index]
+        self.cache.put(index, tile)
+        with self._lock:
+            self._futures.pop(index, None)
+        return tile
+
+    def _prefetch_after(self, index : int) -> None:
+        position = self._positions.get(index)
+        if position is None:
+            return
+        with self._lock:
+            for next_index in self.tile_order[position + 1 : position + 1 + self.depth]:
+                if next_index in self._futures or next_index in self.cache:
+                    continue
+                self._futures[next_index] = self._pool.submit(self._read, next_index)
+
+    def __getitem__(self, index : int) -> NumArray:
+        index = int(index)
+        self._prefetch_after(index)
+        tile = self.cache.get(index)
+        if tile is not None:
+            with self._lock:
+                self.stats.n_requests += 1
+                self.stats.n_ready += 1
+            return tile
+
+        start = time.perf_counter()
+        with self._lock:
+            future = self._futures.get(index)
+        if future is not None:
+            tile = future.result()
+        else:
+            # the prefetch may have finished after the cache lookup
+            tile = self.cache.get(index)
+            if tile is None:
+                tile = self._read(index)
+        wait = time.perf_counter() - start
+        with self._lock:
+            self.stats.n_requests += 1
+            if future is not None:
+                self.stats.n_waited += 1
+            else:
+                self.stats.n_sync_reads += 1
+            self.stats.wait_seconds += wait
+            self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, wait)
+        return tile
+
+    def close(self) -> None:
+        """Stop the reader threads."""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> "PrefetchingTileSource":
+        return self
+
+    def __exit__(self, *args : Any) -> None:
+        self.close()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in ["source", "tile_order", "depth", "n_threads", "max_bytes"]}
+
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.__init__(**state)  # type: ignore[misc]
+
+
+TileSourceLike = Union[TileSource, NumArray, Callable[[int], NumArray], Any]
+
+
+def read_tile_region(images : Any, index : int, slices : Tuple[slice, ...]) -> NumArray:
+    """Read a region of a tile, without reading the whole tile if the source supports it."""
+    if isinstance(images, TileSource):
+        return images.read_region(index, slices)
+    return np.asarray(images[index][slices])
+
+
+def as_tile_source(images : TileSourceLike, n_tiles : Optional[int] = None) -> TileSource:
+    """Convert the input images to a TileSource.
+
+    Parameters
+    ----------
+    images : TileSourceLike
+        A TileSource, an array-like object whose first dimension corresponds to the mosaic position,
+        or a callable returning tile i.
+    n_tiles : Optional[int], optional
+        The number of tiles. Required if `images` is a callable.
+
+    Returns
+    -------
+    source : TileSource
+        The tile source.
+    """
+    if isinstance(images, TileSource):
+        return images
+    if hasattr(images, "shape") and hasattr(images, "__getitem__"):
+        return ArrayTileSource(images)
+    if callable(images):
+        if n_tiles is None:
+            raise ValueError("n_tiles must be supplied when images is a callable.")
+        return CallableTileSource(images, n_tiles)
+    return ArrayTileSource(np.asarray(images))
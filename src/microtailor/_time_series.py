@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+from ._stitcher import Stitcher, _get_displacements, _parse_positions_to_pairs, _set_displacements
+from ._tile_source import TileSourceLike, as_tile_source
+from ._typing_utils import FloatArray, IntArray, NumArray
+
+
+class TimeSeriesStitcher:
+    """Stitch the frames of a time-lapse mosaic, tracking the pair displacements from frame to frame.
+
+    The first frame is stitched with the full search within `allowed_error`. For each later frame, the local optimized
+    displacements of the previous frame are used as the estimated displacements and searched within the small
+    `tracking_allowed_error`. The pairs whose previous displacement is missing are searched within `allowed_error`
+    around the original estimates. The pairs whose NCC drops below `min_ncc_ratio` times the NCC of the previous frame
+    are searched again in the same way, and only these pairs run the per-pair stages again before the single global
+    optimization of the frame.
+
+    The default stitcher crops the candidate estimation to the search windows, so that the tracked pairs correlate
+    only the small windows around their overlaps instead of the full frames.
+
+    Parameters
+    ----------
+    tile_indices : Optional[IntArray], optional
+        The integer index of the tiles, common to all the frames. If None, `estimated_positions` must be supplied.
+    estimated_positions : Optional[NumArray], optional
+        The estimated position of the tiles in pixel. If None, `tile_indices` must be supplied.
+    stitcher : Optional[Stitcher], optional
+        The stitcher providing the stages and the scheduling options.
+        If None, the Stitcher with `candidate_estimator_params={"crop_to_overlap": True}` is used.
+    overlap_threshold_percentage : float, optional
+        The area percentage threshold to calculate pair displacement between tiles. Effective only when tile_indices is None.
+    allowed_error : float, optional
+        The allowed error from the `estimated_positions` in pixel for the full search, by default 20.
+    tracking_allowed_error : float, optional
+        The allowed error from the displacements of the previous frame in pixel, by default 3.
+    min_ncc_ratio : float, optional
+        The ratio of the NCC of the tracked displacement to that of the previous frame below which the pair
+        is searched again, by default 0.5.
+    """
+
+    def __init__(
+        self,
+        tile_indices : Optional[IntArray] = None,
+        estimated_positions : Optional[NumArray] = None,
+        stitcher : Optional[Stitcher] = None,
+        overlap_threshold_percentage : float = 5,
+        allowed_error : float = 20,
+        tracking_allowed_error : float = 3,
+        min_ncc_ratio : float = 0.5,
+    ) -> None:
+        if tile_indices is None and estimated_positions is None:
+            raise ValueError("tile_indices and estimated_positions must not be None together.")
+        self.tile_indices = tile_indices
+        self.estimated_positions = estimated_positions
+        self.stitcher = stitcher if stitcher is not None else Stitcher(candidate_estimator_params={"crop_to_overlap": True})
+        self.overlap_threshold_percentage = overlap_threshold_percentage
+        self.allowed_error = allowed_error
+        self.tracking_allowed_error = tracking_allowed_error
+        self.min_ncc_ratio = min_ncc_ratio
+        self.n_frames = 0
+        self._base_pairs_df : Optional[pd.DataFrame] = None
+        self._previous_displacement : Optional[FloatArray] = None
+        self._previous_ncc : Optional[FloatArray] = None
+
+    def add_frame(self, images : TileSourceLike) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Stitch the next frame.
+
+        Parameters
+        ----------
+        images : TileSourceLike
+            The tiles of the frame. See `Stitcher.stitch` for the accepted types.
+
+        Returns
+        -------
+        positions_df : pd.DataFrame
+            The stitched tile positions indexed by the tile number, with the columns such as "y_pos" and "x_pos".
+        pairs_df : pd.DataFrame
+            The image pairs with the displacements computed at each stage. The "tracking_displacement" columns hold
+            the estimated displacements used as the search centers, and "tracked" is False for the fully searched pairs.
+        """
+        n_tiles = len(self.tile_indices) if self.tile_indices is not None else len(self.estimated_positions)
+        images = as_tile_source(images, n_tiles=n_tiles)
+        if len(images) != n_tiles:
+            raise ValueError("images must have the same number of tiles as the positions.")
+        ndim = len(images.tile_shape)
+        if self._base_pairs_df is None:
+            self._base_pairs_df = _parse_positions_to_pairs(
+                images.tile_shape,
+                self.tile_indices,
+                self.estimated_positions,
+                self.overlap_threshold_percentage,
+                allow_disconnected=self.stitcher.stitch_components_separately,
+            )
+        original_displacement = _get_displacements(self._base_pairs_df, "estimated_displacement", ndim)
+
+        if self._previous_displacement is None:
+            full_search = np.ones(len(original_displacement), dtype=bool)
+            estimated_displacement = original_displacement
+        else:
+            full_search = np.any(np.isnan(self._previous_displacement), axis=1)
+            estimated_displacement = np.where(full_search[:, np.newaxis], original_displacement, self._previous_displacement)
+
+        def search_lost(pairs_df : pd.DataFrame) -> Optional[Tuple[np.ndarray, FloatArray, FloatArray]]:
+            if self._previous_ncc is None or "local_optimized_ncc" not in pairs_df:
+                return None
+            ncc = pairs_df["local_optimized_ncc"].to_numpy(dtype=np.float64)
+            lost = ~full_search & ~(ncc >= self.min_ncc_ratio * self._previous_ncc)
+            full_search[lost] = True
+            return lost, np.where(full_search[:, np.newaxis], original_displacement, estimated_displacement), \
+                np.where(full_search, self.allowed_error, self.tracking_allowed_error)
+
+        pairs_df = self._base_pairs_df.copy()
+        positions_df, pairs_df = self.stitcher.stitch_pairs(
+            images,
+            pairs_df,
+            estimated_displacement,
+            np.where(full_search, self.allowed_error, self.tracking_allowed_error),
+            self.tile_indices,
+            self.estimated_positions,
+            search_again=search_lost,
+        )
+        _set_displacements(pairs_df, "tracking_displacement",
+                           np.where(full_search[:, np.newaxis], original_displacement, estimated_displacement))
+        pairs_df["tracked"] = ~full_search
+
+        self._previous_displacement = _get_displacements(pairs_df, "local_optimized_displacement", ndim)
+        if "local_optimized_ncc" in pairs_df:
+            self._previous_ncc = pairs_df["local_optimized_ncc"].to_numpy(dtype=np.float64)
+        self.n_frames += 1
+        return positions_df, pairs_df
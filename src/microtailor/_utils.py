@@ -1,5 +1,11 @@
 import numpy as np
-from ._typing_utils import NumArray, FloatArray, Float
+import numpy.typing as npt
+from scipy import fft as sp_fft
+from scipy.ndimage import maximum_filter
+from itertools import product
+from typing import Callable, List, Optional, Sequence, Tuple
+from ._typing_utils import NumArray, FloatArray, Float, IntArray
+
 
 def calc_phase_correlation_matrix(image1: NumArray, image2: NumArray) -> FloatArray:
     """Compute phase correlation matrix for two images.
@@ -7,23 +13,260 @@ def calc_phase_correlation_matrix(image1: NumArray, image2: NumArray) -> FloatAr
     Parameters
     ---------
     image1 : np.ndarray
-        the first image (the dimension must be 2)
+        the first image of any dimension
 
     image2 : np.ndarray
-        the second image (the dimension must be 2)
+        the second image with the same shape as `image1`
 
     Returns
     -------
     pcm : np.ndarray
         the phase correlation matrix
     """
-    assert image1.ndim == 2
-    assert image2.ndim == 2
     assert np.array_equal(image1.shape, image2.shape)
-    F1 = np.fft.fft2(image1)
-    F2 = np.fft.fft2(image2)
+    F1 = np.fft.fftn(image1)
+    F2 = np.fft.fftn(image2)
+    return calc_phase_correlation_matrix_from_spectra(F1, F2)
+
+def calc_phase_correlation_matrix_from_spectra(F1: NumArray, F2: NumArray) -> FloatArray:
+    """Compute phase correlation matrix from the Fourier transforms of two images.
+
+    Parameters
+    ---------
+    F1 : np.ndarray
+        the Fourier transform of the first image
+
+    F2 : np.ndarray
+        the Fourier transform of the second image
+
+    Returns
+    -------
+    pcm : np.ndarray
+        the phase correlation matrix
+    """
+    assert np.array_equal(F1.shape, F2.shape)
     FC = F1 * np.conjugate(F2)
-    return np.fft.ifft2(FC / np.abs(FC)).real.astype(np.float32)
+    return np.fft.ifftn(FC / np.abs(FC)).real.astype(np.float32)
+
+def calc_real_spectra(images: NumArray, dtype: npt.DTypeLike = np.float32, workers: Optional[int] = None) -> NumArray:
+    """Compute the real-input Fourier transforms of a stack of images.
+
+    Parameters
+    ---------
+    images : np.ndarray
+        the stacked images. The first dimension corresponds to the batch.
+
+    dtype : npt.DTypeLike
+        the working precision (np.float32 or np.float64)
+
+    workers : Optional[int]
+        the number of workers for scipy.fft. If None, a single worker is used.
+
+    Returns
+    -------
+    spectra : np.ndarray
+        the half spectra of the images with the complex dtype corresponding to `dtype`
+    """
+    images = np.asarray(images, dtype=dtype)
+    return sp_fft.rfftn(images, axes=tuple(range(1, images.ndim)), workers=workers)
+
+def calc_phase_correlation_matrices_from_real_spectra(
+        F1: NumArray, F2: NumArray, shape: Tuple[int, ...], workers: Optional[int] = None) -> FloatArray:
+    """Compute phase correlation matrices from the stacked real-input Fourier transforms of image pairs.
+
+    Parameters
+    ---------
+    F1 : np.ndarray
+        the stacked half spectra of the first images, computed by `calc_real_spectra`
+
+    F2 : np.ndarray
+        the stacked half spectra of the second images, computed by `calc_real_spectra`
+
+    shape : Tuple[int, ...]
+        the shape of a single image
+
+    workers : Optional[int]
+        the number of workers for scipy.fft. If None, a single worker is used.
+
+    Returns
+    -------
+    pcms : np.ndarray
+        the stacked phase correlation matrices in the real dtype corresponding to the spectra
+    """
+    assert np.array_equal(F1.shape, F2.shape)
+    FC = F1 * np.conjugate(F2)
+    FC /= np.maximum(np.abs(FC), np.finfo(FC.real.dtype).tiny)
+    return sp_fft.irfftn(FC, s=shape, axes=tuple(range(1, FC.ndim)), workers=workers)
+
+def calc_phase_correlation_matrices(
+        images1: NumArray, images2: NumArray, dtype: npt.DTypeLike = np.float32, workers: Optional[int] = None) -> FloatArray:
+    """Compute phase correlation matrices for a batch of same-shaped image pairs.
+
+    Parameters
+    ---------
+    images1 : np.ndarray
+        the stacked first images. The first dimension corresponds to the batch.
+
+    images2 : np.ndarray
+        the stacked second images with the same shape as `images1`
+
+    dtype : npt.DTypeLike
+        the working precision (np.float32 or np.float64)
+
+    workers : Optional[int]
+        the number of workers for scipy.fft. If None, a single worker is used.
+
+    Returns
+    -------
+    pcms : np.ndarray
+        the stacked phase correlation matrices
+    """
+    assert np.array_equal(np.shape(images1), np.shape(images2))
+    return calc_phase_correlation_matrices_from_real_spectra(
+        calc_real_spectra(images1, dtype, workers),
+        calc_real_spectra(images2, dtype, workers),
+        np.shape(images1)[1:],
+        workers,
+    )
+
+def calc_upsampled_phase_correlation(
+        FC: NumArray, shape: Tuple[int, ...], coords: Sequence[NumArray]) -> FloatArray:
+    """Evaluate the phase correlation matrix on an arbitrary grid by matrix-multiply DFTs.
+
+    The inverse transform is evaluated only at the requested coordinates, axis by axis, so that the cost
+    is proportional to the number of the sampled points instead of the upsampling factor.
+
+    Parameters
+    ---------
+    FC : np.ndarray
+        the normalized cross-power half spectrum of the real-input Fourier transforms
+
+    shape : Tuple[int, ...]
+        the shape of the images
+
+    coords : Sequence[np.ndarray]
+        the sampled coordinates along each axis in pixel
+
+    Returns
+    -------
+    values : np.ndarray
+        the phase correlation on the grid of `coords`
+    """
+    values = FC
+    for axis, (n, axis_coords) in enumerate(zip(shape, coords)):
+        if axis == len(shape) - 1:
+            # combine the conjugate-symmetric halves of the real-input spectrum
+            frequencies = np.arange(FC.shape[axis])
+            weights = np.full(len(frequencies), 2.0)
+            weights[0] = 1
+            if n % 2 == 0:
+                weights[-1] = 1
+        else:
+            frequencies = sp_fft.fftfreq(n, 1 / n)
+            weights = np.ones(n)
+        kernel = weights * np.exp(2j * np.pi * np.outer(axis_coords, frequencies) / n)
+        values = np.tensordot(values, kernel, axes=([0], [1]))
+    return values.real / np.prod(shape)
+
+def refine_peak_subpixel(
+        F1: NumArray,
+        F2: NumArray,
+        shape: Tuple[int, ...],
+        peak: NumArray,
+        upsample_factor: int) -> Tuple[FloatArray, Float]:
+    """Refine a phase correlation peak to the subpixel precision by the upsampled DFT (Guizar-Sicairos et al., 2008).
+
+    The phase correlation is evaluated once on the grid of 1 / `upsample_factor` pixel spacing
+    over the 1.5 pixel neighborhood of the peak, and the maximum of the grid is returned.
+
+    Parameters
+    ---------
+    F1 : np.ndarray
+        the half spectrum of the first image, computed by `calc_real_spectra`
+
+    F2 : np.ndarray
+        the half spectrum of the second image, computed by `calc_real_spectra`
+
+    shape : Tuple[int, ...]
+        the shape of the images
+
+    peak : np.ndarray
+        the integer position of the peak
+
+    upsample_factor : int
+        the inverse of the precision in pixel
+
+    Returns
+    -------
+    peak : np.ndarray
+        the refined position of the peak
+
+    value : Float
+        the phase correlation at the refined peak
+    """
+    FC = F1 * np.conjugate(F2)
+    FC /= np.maximum(np.abs(FC), np.finfo(FC.real.dtype).tiny)
+    region_size = int(np.ceil(upsample_factor * 1.5))
+    offsets = (np.arange(region_size) - region_size // 2) / upsample_factor
+    coords = [c + offsets for c in np.asarray(peak, dtype=np.float64)]
+    values = calc_upsampled_phase_correlation(FC, shape, coords)
+    best = np.unravel_index(np.argmax(values), values.shape)
+    return np.array([c[b] for c, b in zip(coords, best)]), values[best]
+
+def find_top_peaks(
+        matrix: FloatArray,
+        num_peaks: int,
+        suppression_radius: int = 1,
+        window: Optional[Tuple[IntArray, IntArray]] = None) -> IntArray:
+    """Find the highest distinct local maxima of a periodic matrix such as the phase correlation matrix.
+
+    A position is a peak if it is the maximum within `suppression_radius` along each axis, with the periodic
+    boundary. The peaks are selected by `np.argpartition`, so that the cost is linear in the searched size.
+
+    Parameters
+    ---------
+    matrix : np.ndarray
+        the periodic matrix of any dimension
+
+    num_peaks : int
+        the maximum number of the peaks
+
+    suppression_radius : int
+        the radius of the non-maximum suppression. If 0, the highest values are returned.
+
+    window : Optional[Tuple[np.ndarray, np.ndarray]]
+        the inclusive lower and upper positions of the searched region, wrapped periodically. If None, the whole matrix is searched.
+
+    Returns
+    -------
+    peaks : np.ndarray
+        the (n_peaks, ndim) array of the peak positions in the descending order of the values, n_peaks <= num_peaks
+    """
+    shape = matrix.shape
+    r = suppression_radius
+    inner_indices = []
+    for axis, n in enumerate(shape):
+        lower, upper = (0, n - 1) if window is None else (int(window[0][axis]), int(window[1][axis]))
+        if upper < lower:
+            return np.zeros((0, len(shape)), dtype=np.int64)
+        if upper - lower + 1 >= n:
+            lower, upper = 0, n - 1
+        inner_indices.append(np.arange(lower, upper + 1))
+    extended = matrix[np.ix_(*[np.arange(ix[0] - r, ix[-1] + r + 1) % n for ix, n in zip(inner_indices, shape)])]
+    if r > 0:
+        is_peak = extended == maximum_filter(extended, size=2 * r + 1, mode="nearest")
+        inner = tuple(slice(r, -r) for _ in shape)
+        values = np.where(is_peak[inner], extended[inner], -np.inf).ravel()
+    else:
+        values = extended.ravel()
+    num_peaks = min(num_peaks, values.size)
+    if num_peaks == 0:
+        return np.zeros((0, len(shape)), dtype=np.int64)
+    top = np.argpartition(-values, num_peaks - 1)[:num_peaks]
+    top = top[np.argsort(-values[top], kind="stable")]
+    top = top[np.isfinite(values[top])]
+    positions = np.unravel_index(top, tuple(len(ix) for ix in inner_indices))
+    return np.stack([ix[p] % n for ix, p, n in zip(inner_indices, positions, shape)], axis=1)
 
 def calc_normalized_cross_correlation(image1: NumArray, image2: NumArray) -> Float:
     """Compute the normalized cross correlation for two images.
@@ -31,21 +274,285 @@ def calc_normalized_cross_correlation(image1: NumArray, image2: NumArray) -> Flo
     Parameters
     ---------
     image1 : np.ndarray
-        the first image (the dimension must be 2)
+        the first image of any dimension
 
     image2 : np.ndarray
-        the second image (the dimension must be 2)
+        the second image with the same shape as `image1`
 
     Returns
     -------
     ncc : Float
         the normalized cross correlation
     """
-    assert image1.ndim == 2
-    assert image2.ndim == 2
     assert np.array_equal(image1.shape, image2.shape)
-    image1 = image1.flatten()
-    image2 = image2.flatten()
+    image1 = np.ravel(image1)
+    image2 = np.ravel(image2)
     n = np.dot(image1 - np.mean(image1), image2 - np.mean(image2))
     d = np.linalg.norm(image1) * np.linalg.norm(image2)
-    return n / d
\ No newline at end of file
+    return n / d
+
+def calc_overlap_slices(shape: Tuple[int, ...], displacement: NumArray) -> Tuple[Tuple[slice, ...], Tuple[slice, ...]]:
+    """Compute the slices of the overlapping region of two images.
+
+    Parameters
+    ---------
+    shape : Tuple[int, ...]
+        the shape of the images
+
+    displacement : np.ndarray
+        the integer position of the second image with respect to the first image
+
+    Returns
+    -------
+    slices1 : Tuple[slice, ...]
+        the slices of the overlapping region in the first image
+
+    slices2 : Tuple[slice, ...]
+        the slices of the overlapping region in the second image
+    """
+    slices1 = []
+    slices2 = []
+    for n, d in zip(shape, displacement):
+        d = int(d)
+        slices1.append(slice(min(max(0, d), n), max(min(n, n + d), 0)))
+        slices2.append(slice(min(max(0, -d), n), max(min(n, n - d), 0)))
+    return tuple(slices1), tuple(slices2)
+
+def calc_summed_area_table(image: NumArray) -> FloatArray:
+    """Compute the summed-area table (integral image) of an image.
+
+    Parameters
+    ---------
+    image : np.ndarray
+        the image of any dimension
+
+    Returns
+    -------
+    sat : np.ndarray
+        the table padded by one zero row at the start of each axis, so that
+        `sat[i, j]` is the sum of `image[:i, :j]`
+    """
+    sat = np.zeros(tuple(n + 1 for n in image.shape), dtype=np.float64)
+    inner = sat[tuple(slice(1, None) for _ in image.shape)]
+    inner[...] = image
+    for axis in range(image.ndim):
+        np.cumsum(inner, axis=axis, out=inner)
+    return sat
+
+def sum_from_summed_area_table(sat: FloatArray, slices: Tuple[slice, ...]) -> Float:
+    """Compute the sum of an image region from its summed-area table in O(2^ndim).
+
+    Parameters
+    ---------
+    sat : np.ndarray
+        the summed-area table computed by `calc_summed_area_table`
+
+    slices : Tuple[slice, ...]
+        the region with explicit start and stop
+
+    Returns
+    -------
+    total : Float
+        the sum of the region
+    """
+    total = 0.
+    for corner in product((0, 1), repeat=len(slices)):
+        index = tuple(s.stop if c else s.start for s, c in zip(slices, corner))
+        sign = (-1) ** (len(slices) - sum(corner))
+        total += sign * sat[index]
+    return total
+
+class SummedAreaTile:
+    """A tile, or a region of a tile, with the summed-area tables of its values and squared values.
+
+    Floating point tiles are kept in their dtype, other tiles are converted to float32. The tables are in float64.
+
+    Parameters
+    ---------
+    image : np.ndarray
+        the tile or the tile region of any dimension
+
+    origin : Optional[np.ndarray]
+        the position of the region in the tile. If None, `image` is the whole tile.
+    """
+
+    def __init__(self, image: NumArray, origin: Optional[IntArray] = None) -> None:
+        image = np.asarray(image)
+        self.image = image if np.issubdtype(image.dtype, np.floating) else image.astype(np.float32)
+        self.origin = np.zeros(image.ndim, dtype=np.int64) if origin is None else np.asarray(origin, dtype=np.int64)
+        self.sat = calc_summed_area_table(self.image)
+        self.sat_squared = calc_summed_area_table(np.square(self.image, dtype=np.float64))
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.nbytes + self.sat.nbytes + self.sat_squared.nbytes
+
+def _sums_from_summed_area_table(sat: FloatArray, starts: IntArray, stops: IntArray) -> FloatArray:
+    """Compute the sums of many regions from a summed-area table at once. `starts` and `stops` are (n_regions, ndim) arrays."""
+    totals = np.zeros(len(starts))
+    ndim = starts.shape[1]
+    for corner in product((0, 1), repeat=ndim):
+        index = tuple(np.where(c, stops[:, axis], starts[:, axis]) for axis, c in enumerate(corner))
+        totals += (-1) ** (ndim - sum(corner)) * sat[index]
+    return totals
+
+# the overlaps up to this size are stacked to compute their cross terms in batched passes
+_CROSS_TERM_BATCH_MAX_SIZE = 2**13
+_CROSS_TERM_BATCH_BYTES = 2**24
+
+def _overlap_statistics(
+        tile1: SummedAreaTile,
+        tile2: SummedAreaTile,
+        displacements: IntArray,
+        shape: Optional[Tuple[int, ...]]) -> Tuple[IntArray, IntArray, IntArray, FloatArray, FloatArray]:
+    """Compute the overlaps of two tiles for many displacements and their sums from the summed-area tables.
+
+    Returns the starts of the overlaps in the two tiles (or regions), the overlap shapes, the products of the sums
+    divided by the overlap sizes and the denominators of the normalized cross correlations.
+    """
+    displacements = np.asarray(displacements, dtype=np.int64).reshape(-1, tile1.image.ndim)
+    shape = np.array(tile1.image.shape if shape is None else shape)
+    starts1 = np.clip(displacements, 0, shape)
+    stops1 = np.clip(shape + displacements, 0, shape)
+    starts2 = np.clip(-displacements, 0, shape)
+    stops2 = np.clip(shape - displacements, 0, shape)
+    sizes = np.prod(np.maximum(stops1 - starts1, 0), axis=1)
+    # to the coordinates of the regions
+    starts1, stops1 = starts1 - tile1.origin, np.maximum(stops1, starts1) - tile1.origin
+    starts2, stops2 = starts2 - tile2.origin, np.maximum(stops2, starts2) - tile2.origin
+    if np.any(sizes > 0) and (np.any(starts1[sizes > 0] < 0) or np.any(stops1[sizes > 0] > tile1.image.shape)
+                              or np.any(starts2[sizes > 0] < 0) or np.any(stops2[sizes > 0] > tile2.image.shape)):
+        raise ValueError("the tile regions do not contain the overlaps.")
+
+    sums1 = _sums_from_summed_area_table(tile1.sat, starts1, stops1)
+    sums2 = _sums_from_summed_area_table(tile2.sat, starts2, stops2)
+    squared_sums1 = _sums_from_summed_area_table(tile1.sat_squared, starts1, stops1)
+    squared_sums2 = _sums_from_summed_area_table(tile2.sat_squared, starts2, stops2)
+    denominators = np.where(sizes > 0, np.sqrt(np.maximum(squared_sums1, 0) * np.maximum(squared_sums2, 0)), 0)
+    mean_products = sums1 * sums2 / np.maximum(sizes, 1)
+    return starts1, starts2, stops1 - starts1, mean_products, denominators
+
+def _group_indices(labels: IntArray, n_labels: int) -> Sequence[IntArray]:
+    """Split the indices of an array of labels in [0, n_labels) into the groups of the same label."""
+    order = np.argsort(labels, kind="stable")
+    return np.split(order, np.cumsum(np.bincount(labels, minlength=n_labels))[:-1])
+
+def _nccs_from_overlap_statistics(
+        images1: Sequence[NumArray],
+        images2: Sequence[NumArray],
+        starts1: IntArray,
+        starts2: IntArray,
+        overlap_shapes: IntArray,
+        mean_products: FloatArray,
+        denominators: FloatArray) -> FloatArray:
+    """Compute the normalized cross correlations from the overlap statistics of `_overlap_statistics`.
+
+    The cross terms of the small overlaps with the same shape are computed in batched passes over the stacked overlaps.
+    """
+    nccs = np.full(len(starts1), -np.inf)
+    valid = np.nonzero(denominators > 0)[0]
+    if len(valid) == 0:
+        return nccs
+    subscripts = "abcdefghijklmnopqrstuvwxy"[:overlap_shapes.shape[1]]
+    unique_shapes, shape_labels = np.unique(overlap_shapes[valid], axis=0, return_inverse=True)
+    for overlap_shape, members in zip(unique_shapes, _group_indices(shape_labels.ravel(), len(unique_shapes))):
+        members = valid[members]
+        overlap_size = int(np.prod(overlap_shape))
+        def overlaps(images: Sequence[NumArray], starts: IntArray, batch: IntArray) -> List[NumArray]:
+            return [images[k][tuple(slice(a, a + n) for a, n in zip(starts[k], overlap_shape))] for k in batch]
+        if overlap_size > _CROSS_TERM_BATCH_MAX_SIZE:
+            # the large overlaps are summed on the views, as copying them to a stack costs more than the calls
+            cross = np.array([np.einsum(f"{subscripts},{subscripts}->", overlap1, overlap2, dtype=np.float64)
+                              for overlap1, overlap2 in zip(overlaps(images1, starts1, members), overlaps(images2, starts2, members))])
+            nccs[members] = (cross - mean_products[members]) / denominators[members]
+            continue
+        batch_size = max(1, _CROSS_TERM_BATCH_BYTES // (8 * overlap_size))
+        for batch_start in range(0, len(members), batch_size):
+            batch = members[batch_start:batch_start + batch_size]
+            cross = np.einsum(f"z{subscripts},z{subscripts}->z",
+                np.stack(overlaps(images1, starts1, batch)), np.stack(overlaps(images2, starts2, batch)), dtype=np.float64)
+            nccs[batch] = (cross - mean_products[batch]) / denominators[batch]
+    return nccs
+
+def calc_overlap_nccs(
+        tile1: SummedAreaTile,
+        tile2: SummedAreaTile,
+        displacements: IntArray,
+        shape: Optional[Tuple[int, ...]] = None) -> FloatArray:
+    """Compute the normalized cross correlations of the overlaps of two tiles for many displacements.
+
+    The result equals `calc_normalized_cross_correlation` on the overlapping regions. The sums and the squared
+    sums are gathered from the summed-area tables for all the displacements at once, and the cross terms of the
+    small overlaps with the same shape are computed in batched passes. If the tiles are regions, they must contain the overlaps.
+
+    Parameters
+    ---------
+    tile1 : SummedAreaTile
+        the first tile
+
+    tile2 : SummedAreaTile
+        the second tile
+
+    displacements : np.ndarray
+        the (n_displacements, ndim) array of the integer positions of the second tile with respect to the first tile
+
+    shape : Optional[Tuple[int, ...]]
+        the shape of the whole tiles. If None, the shape of `tile1` is used.
+
+    Returns
+    -------
+    nccs : np.ndarray
+        the normalized cross correlations, -inf for the displacements without overlap
+    """
+    statistics = _overlap_statistics(tile1, tile2, displacements, shape)
+    n_displacements = len(statistics[0])
+    return _nccs_from_overlap_statistics([tile1.image] * n_displacements, [tile2.image] * n_displacements, *statistics)
+
+def score_overlap_candidates(
+        get_tiles: Callable[[int], Tuple[SummedAreaTile, SummedAreaTile]],
+        candidate_pairs: IntArray,
+        displacements: IntArray,
+        shape: Optional[Tuple[int, ...]] = None) -> FloatArray:
+    """Score many (pair, displacement) candidates by the normalized cross correlation of the overlaps.
+
+    The candidates are grouped by the pair once to gather the sums from the summed-area tables, and the cross
+    terms of the candidates with the same small overlap shape are computed in batched passes across the pairs.
+
+    Parameters
+    ---------
+    get_tiles : Callable[[int], Tuple[SummedAreaTile, SummedAreaTile]]
+        the function returning the summed-area tiles (or regions containing the overlaps) of a pair from the pair number
+
+    candidate_pairs : np.ndarray
+        the (n_candidates,) array of the pair number of each candidate
+
+    displacements : np.ndarray
+        the (n_candidates, ndim) array of the candidate displacements
+
+    shape : Optional[Tuple[int, ...]]
+        the shape of the whole tiles. If None, the tiles must be whole.
+
+    Returns
+    -------
+    nccs : np.ndarray
+        the (n_candidates,) array of the normalized cross correlations
+    """
+    candidate_pairs = np.asarray(candidate_pairs)
+    displacements = np.asarray(displacements, dtype=np.int64).reshape(len(candidate_pairs), -1)
+    n_candidates, ndim = displacements.shape
+    starts1 = np.zeros((n_candidates, ndim), dtype=np.int64)
+    starts2 = np.zeros((n_candidates, ndim), dtype=np.int64)
+    overlap_shapes = np.zeros((n_candidates, ndim), dtype=np.int64)
+    mean_products = np.zeros(n_candidates)
+    denominators = np.zeros(n_candidates)
+    images1: List[NumArray] = [None] * n_candidates  # type: ignore[list-item]
+    images2: List[NumArray] = [None] * n_candidates  # type: ignore[list-item]
+    pairs, pair_labels = np.unique(candidate_pairs, return_inverse=True)
+    for pair, members in zip(pairs, _group_indices(pair_labels.ravel(), len(pairs))):
+        tile1, tile2 = get_tiles(int(pair))
+        (starts1[members], starts2[members], overlap_shapes[members], mean_products[members],
+         denominators[members]) = _overlap_statistics(tile1, tile2, displacements[members], shape)
+        for k in members:
+            images1[k], images2[k] = tile1.image, tile2.image
+    return _nccs_from_overlap_statistics(
+        images1, images2, starts1, starts2, overlap_shapes, mean_products, denominators)
@@ -0,0 +1,124 @@
+"""Test cases for the mosaic fusion."""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import ndimage as ndi
+
+from microtailor import CallableTileSource, MosaicFuser, StackStitcher
+from microtailor._fusion import blending_weights, mosaic_geometry
+from microtailor._multiscale import read_multiscale_level, read_multiscale_metadata
+from microtailor._tile_source import downsample_mean
+
+
+def _make_tiles(grid_shape=(3, 4), tile_shape=(40, 50), step=(32, 41), seed=0):
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in grid_shape], indexing="ij"), axis=-1).reshape(-1, len(grid_shape))
+    positions = grid * np.array(step) + rng.integers(0, 4, size=grid.shape) + 7
+    whole = ndi.gaussian_filter(rng.random(positions.max(axis=0) + np.array(tile_shape)), 1)
+    tiles = np.array([whole[tuple(slice(p, p + s) for p, s in zip(pos, tile_shape))] for pos in positions])
+    origin = positions.min(axis=0)
+    return tiles, positions, whole[tuple(slice(o, None) for o in origin)]
+
+
+@pytest.mark.parametrize("blending", ["linear", "average"])
+def test_fuse_matches_the_whole_image(blending) -> None:
+    tiles, positions, whole = _make_tiles()
+    offsets, mosaic_shape = mosaic_geometry(positions + 0.3, tiles.shape[1:])
+    assert mosaic_shape == whole.shape
+    positions_df = pd.DataFrame(positions, columns=["y_pos", "x_pos"])
+    fuser = MosaicFuser(block_shape=(23, 37), blending=blending, n_jobs=2)
+    mosaic = fuser.fuse(tiles, positions_df)
+    covered = np.zeros(mosaic_shape, dtype=bool)
+    for offset in offsets:
+        covered[tuple(slice(o, o + s) for o, s in zip(offset, tiles.shape[1:]))] = True
+    assert np.allclose(mosaic[covered], whole[covered], atol=1e-6)
+    assert np.all(mosaic[~covered] == 0)
+
+
+def test_fuse_to_memmap(tmp_path) -> None:
+    tiles, positions, whole = _make_tiles()
+    tiles = (tiles * 1000).astype(np.uint16)
+    read = []
+
+    def loader(i):
+        read.append(i)
+        return tiles[i]
+
+    source = CallableTileSource(loader, len(tiles), tiles.shape[1:], tiles.dtype)
+    path = str(tmp_path / "mosaic.npy")
+    MosaicFuser(block_shape=(50, 60), tile_cache_bytes=0).fuse(source, positions, path)
+    mosaic = np.load(path)
+    assert mosaic.dtype == np.uint16
+    assert np.array_equal(mosaic, MosaicFuser(block_shape=(1000, 1000)).fuse(tiles, positions))
+    # each block reads only the intersecting tiles
+    assert len(read) < 4 * len(tiles)
+
+    with pytest.raises(ValueError):
+        MosaicFuser().fuse(tiles, positions, np.zeros((3, 3)))
+
+
+def test_blending_weights() -> None:
+    weights = blending_weights((4, 5), "linear")
+    assert np.array_equal(weights[0], [1, 2, 3, 2, 1])
+    assert np.array_equal(weights[:, 2], [3, 6, 6, 3])
+
+
+@pytest.mark.parametrize("block_shape", [(16, 16), (24, 20)])
+def test_fuse_multiscale(tmp_path, block_shape) -> None:
+    tiles, positions, _ = _make_tiles()
+    path = str(tmp_path / "mosaic")
+    fuser = MosaicFuser(block_shape=block_shape, blending="average", n_jobs=2)
+    writer = fuser.fuse_multiscale(tiles, positions, path, n_levels=3)
+    mosaic = fuser.fuse(tiles, positions)
+
+    metadata = read_multiscale_metadata(path)
+    assert [level["shape"] for level in metadata["levels"]] == [list(s) for s in writer.shapes]
+    assert np.array_equal(read_multiscale_level(path, 0), mosaic)
+    expected = mosaic
+    for level in range(1, 3):
+        expected = downsample_mean(expected)
+        assert np.allclose(read_multiscale_level(path, level), expected, atol=1e-5)
+    assert np.array_equal(read_multiscale_level(path, 1, (slice(5, 30), slice(17, 19))),
+                          read_multiscale_level(path, 1)[5:30, 17:19])
+
+
+def test_stack_stitcher(tmp_path) -> None:
+    tiles, positions, _ = _make_tiles(grid_shape=(2, 3), tile_shape=(64, 80), step=(50, 60))
+    grid = np.stack(np.meshgrid(np.arange(2), np.arange(3), indexing="ij"), axis=-1).reshape(-1, 2)
+    # 3 timepoints drifting by a pixel along x, 2 channels with the inverted intensity in the second channel
+    n_times, n_channels = 3, 2
+    drifted = [np.roll(tiles, t, axis=2) for t in range(n_times)]
+    stack = np.stack([np.stack([d, 1 - d], axis=1) for d in drifted], axis=1)
+    assert stack.shape == (len(tiles), n_times, n_channels) + tiles.shape[1:]
+
+    stitcher = StackStitcher(refine_axes=[0], refine_allowed_error=3,
+                             fuser=MosaicFuser(block_shape=(40, 50), blending="average", n_jobs=2))
+    stack_positions, pairs_dfs = stitcher.stitch(stack, (0, 0), tile_indices=grid)
+    assert stack_positions.shape == (n_times, n_channels, len(tiles), 2)
+    assert set(pairs_dfs) == {(0, 0), (1, 0), (2, 0)}
+    # the positions are reused along the channel axis
+    assert np.array_equal(stack_positions[:, 0], stack_positions[:, 1])
+    for t in range(n_times):
+        relative = stack_positions[t, 0] - stack_positions[t, 0, 0]
+        assert np.allclose(relative, positions - positions[0], atol=1e-6)
+
+    path = str(tmp_path / "stack.npy")
+    fused = np.load(stitcher.fuse(stack, stack_positions, path).filename)
+    for t in range(n_times):
+        for c in range(n_channels):
+            mosaic = MosaicFuser(blending="average").fuse(stack[:, t, c], stack_positions[t, c])
+            assert np.allclose(fused[t, c], mosaic)
+
+
+def test_stack_stitcher_keeps_the_reference_coordinates() -> None:
+    tiles, positions, whole = _make_tiles(grid_shape=(2, 3), tile_shape=(64, 80), step=(50, 60))
+    grid = np.stack(np.meshgrid(np.arange(2), np.arange(3), indexing="ij"), axis=-1).reshape(-1, 2)
+    # the tiles of the first column, including the leftmost tile, move by 2 pixels in the second frame
+    shift = np.where(grid[:, 1:] == 0, [0, 2], [0, 0])
+    moved = positions - positions.min(axis=0) + shift
+    moved_tiles = np.array([whole[tuple(slice(p, p + s) for p, s in zip(pos, tiles.shape[1:]))] for pos in moved])
+    stack = np.stack([tiles, moved_tiles], axis=1)
+
+    stitcher = StackStitcher(refine_axes=[0], refine_allowed_error=3)
+    stack_positions, _ = stitcher.stitch(stack, (0,), tile_indices=grid)
+    assert np.allclose(stack_positions[1] - stack_positions[0], shift - shift.mean(axis=0), atol=1e-6)
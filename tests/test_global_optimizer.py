@@ -0,0 +1,133 @@
+"""Test cases for the global optimizers."""
+from typing import Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+from microtailor._global_optimizer import ElasticOptimizer, MaximumSpanningTreeOptimizer
+from microtailor import Stitcher
+from microtailor._stitcher import _anchor_positions, _label_components, _parse_positions_to_pairs
+from microtailor._tile_source import as_tile_source
+
+
+def _make_problem(grid_shape=(6, 7), seed=0) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in grid_shape], indexing="ij"), axis=-1).reshape(-1, 2)
+    positions = grid * np.array([90, 110]) + rng.uniform(-5, 5, size=grid.shape)
+    positions -= positions.min(axis=0)
+    pairs_df = _parse_positions_to_pairs((100, 120), grid)
+    pair_indices = pairs_df[["image_index1", "image_index2"]].values
+    displacement = positions[pair_indices[:, 1]] - positions[pair_indices[:, 0]]
+    return positions, pair_indices, displacement
+
+
+@pytest.mark.parametrize("solver", ["lsqr", "cg"])
+def test_elastic_optimizer_exact(solver) -> None:
+    positions, pair_indices, displacement = _make_problem()
+    images = np.zeros((len(positions), 100, 120), dtype=np.uint8)
+    result = ElasticOptimizer(solver=solver)(images, pair_indices, displacement, None, 20)
+    assert np.allclose(result, positions, atol=1e-4)
+
+
+def test_elastic_optimizer_robust_and_warm_start() -> None:
+    rng = np.random.default_rng(1)
+    positions, pair_indices, displacement = _make_problem()
+    images = np.zeros((len(positions), 100, 120), dtype=np.uint8)
+    displacement = displacement + rng.normal(0, 0.3, size=displacement.shape)
+    outliers = rng.choice(len(displacement), 5, replace=False)
+    displacement[outliers] += 40
+    displacement[0] = np.nan
+
+    plain = ElasticOptimizer()(images, pair_indices, displacement, None, 20)
+    robust = ElasticOptimizer(robust_iterations=15)(images, pair_indices, displacement, None, 20)
+    assert np.max(np.abs(robust - positions)) < 2
+    assert np.max(np.abs(robust - positions)) < np.max(np.abs(plain - positions))
+
+    warm = ElasticOptimizer(robust_iterations=15)(
+        images, pair_indices, displacement, None, 20, initial_positions=positions + 100)
+    assert np.max(np.abs(warm - positions - 100)) < 2
+
+
+def test_elastic_optimizer_unconstrained_tiles() -> None:
+    positions, pair_indices, displacement = _make_problem()
+    images = np.zeros((len(positions), 100, 120), dtype=np.uint8)
+    # all the pairs of the tile 0 are invalid
+    cut = np.any(pair_indices == 0, axis=1)
+    displacement[cut] = np.nan
+    estimated_displacement = positions[pair_indices[:, 1]] - positions[pair_indices[:, 0]] + 1
+
+    result = ElasticOptimizer()(images, pair_indices, displacement, estimated_displacement, 20)
+    assert np.allclose(result[1:] - result[1], positions[1:] - positions[1], atol=1e-3)
+    assert np.allclose(result[0] - result[1], positions[0] - positions[1] - 1, atol=1e-3)
+
+    result = ElasticOptimizer()(images, pair_indices, displacement, None, 20)
+    assert np.all(np.isnan(result[0]))
+    assert np.allclose(result[1:], positions[1:] - positions[1:].min(axis=0), atol=1e-4)
+
+
+def test_maximum_spanning_tree_optimizer() -> None:
+    positions, pair_indices, displacement = _make_problem()
+    images = np.zeros((len(positions), 100, 120), dtype=np.uint8)
+    result = MaximumSpanningTreeOptimizer()(images, pair_indices, displacement, None, 20)
+    assert np.allclose(result, positions)
+
+    # the low-confidence outliers are not used in the tree
+    rng = np.random.default_rng(0)
+    weights = rng.uniform(0.5, 1, size=len(displacement))
+    outliers = rng.choice(len(displacement), 5, replace=False)
+    displacement[outliers] += 40
+    weights[outliers] = 0.1
+    result = MaximumSpanningTreeOptimizer()(images, pair_indices, displacement, None, 20, weights=weights)
+    assert np.allclose(result, positions)
+
+    result = MaximumSpanningTreeOptimizer()(
+        images, pair_indices, displacement, None, 20, initial_positions=positions + 10, weights=weights)
+    assert np.allclose(result, positions + 10)
+
+
+def test_maximum_spanning_tree_optimizer_unconstrained_tiles() -> None:
+    positions, pair_indices, displacement = _make_problem()
+    images = np.zeros((len(positions), 100, 120), dtype=np.uint8)
+    # all the pairs of the tile 0 are invalid
+    cut = np.any(pair_indices == 0, axis=1)
+    displacement[cut] = np.nan
+    estimated_displacement = positions[pair_indices[:, 1]] - positions[pair_indices[:, 0]] + 1
+    # the estimates of the valid pairs are not used
+    estimated_displacement[~cut] += 10
+
+    result = MaximumSpanningTreeOptimizer()(images, pair_indices, displacement, estimated_displacement, 20)
+    assert np.allclose(result[1:] - result[1], positions[1:] - positions[1])
+    assert np.allclose(result[0] - result[1], positions[0] - positions[1] - 1)
+
+    result = MaximumSpanningTreeOptimizer()(images, pair_indices, displacement, None, 20)
+    assert np.all(np.isnan(result[0]))
+    assert np.allclose(result[1:], positions[1:] - positions[1:].min(axis=0))
+
+
+@pytest.mark.parametrize("global_optimizer", ["elastic", "maximum_spanning_tree"])
+def test_optimize_components(global_optimizer) -> None:
+    rng = np.random.default_rng(0)
+    grid = np.array([(0, 0), (0, 1), (1, 0), (1, 1), (5, 5), (5, 6), (6, 5), (9, 9)])
+    positions = grid * np.array([90, 110]) + rng.uniform(-5, 5, size=grid.shape)
+    estimated_positions = grid * np.array([90, 110])
+    pairs_df = _parse_positions_to_pairs((100, 120), grid, estimated_positions, allow_disconnected=True)
+    pair_indices = pairs_df[["image_index1", "image_index2"]].values
+    n_components, labels = _label_components(len(grid), pair_indices)
+    assert n_components == 3
+    with pytest.raises(ValueError):
+        _parse_positions_to_pairs((100, 120), grid, estimated_positions)
+
+    displacement = positions[pair_indices[:, 1]] - positions[pair_indices[:, 0]]
+    images = as_tile_source(np.zeros((len(grid), 100, 120), dtype=np.uint8))
+    stitcher = Stitcher(global_optimizer=global_optimizer, n_jobs=2, stitch_components_separately=True)
+    result = stitcher._optimize_components(
+        images, pair_indices, displacement, np.full_like(displacement, np.nan), 20, None, labels, estimated_positions)
+    for component in range(n_components):
+        members = labels == component
+        error = result[members] - positions[members]
+        assert np.allclose(error, error[0], atol=1e-4)
+        assert np.allclose(np.mean(result[members] - estimated_positions[members], axis=0), 0)
+
+    anchors = _anchor_positions(pair_indices, displacement, grid, None)
+    assert np.allclose(anchors[1] - anchors[0], [0, 110], atol=10)
@@ -1,7 +1,29 @@
-from microtailor._stitcher import _calc_overlap_area_ratio, _parse_positions_to_pairs
+from microtailor import Stitcher, IncrementalStitcher, TimeSeriesStitcher
+from microtailor._stitcher import _calc_overlap_area_ratio, _parse_positions_to_pairs, _find_pairs
+from microtailor import _candidate_estimator as candidate_estimator_module
+from microtailor._candidate_estimator import PhaseCorrelationEstimator
+from microtailor._pair_optimizer import NormalizedClossCorrelationOptimizer
+from microtailor._position_interpolator import EllipticEnvelopeInterpolator
+from microtailor._tile_source import as_tile_source, build_tile_pyramid
+from microtailor._utils import (
+    SummedAreaTile,
+    calc_overlap_nccs,
+    calc_phase_correlation_matrix,
+    calc_phase_correlation_matrices,
+    calc_normalized_cross_correlation,
+    calc_overlap_slices,
+    calc_real_spectra,
+    find_top_peaks,
+    refine_peak_subpixel,
+    score_overlap_candidates,
+    sum_from_summed_area_table,
+)
 import numpy as np
+import pandas as pd
+from scipy import ndimage as ndi
 import networkx as nx
 import pytest
+from itertools import combinations
 
 def test_calc_overlap_area_ratio() -> None:
     image_shape = (123,456)
@@ -40,8 +62,11 @@ def test_parse_positions_to_pairs_tile_indices() -> None:
     pairs_graph = nx.from_edgelist(pairs_df[["image_index1","image_index2"]].values)
     assert nx.is_isomorphic(pairs_graph,nx.from_edgelist(edges)) 
     pairs_df = pairs_df.set_index(["image_index1","image_index2"])
-    assert np.array_equal(pairs_df.loc[(1,3),"estimated_displacement"],[0,400])
-    assert np.array_equal(pairs_df.loc[(1,2),"estimated_displacement"],[10,10])
+    columns = ["estimated_displacement_y","estimated_displacement_x"]
+    assert np.array_equal(pairs_df.loc[(1,3),columns],[0,400])
+    assert np.array_equal(pairs_df.loc[(1,2),columns],[10,10])
+    assert all(np.issubdtype(pairs_df[column].dtype, np.number) for column in columns)
+    assert np.array_equal(pairs_df.loc[(1,3),["index_displacement_y","index_displacement_x"]],[0,1])
 
     tile_indices = np.array([(-1,1,1),(0,1,1),(1,1,1),(0,1,4)])
     with pytest.raises(ValueError):
@@ -62,4 +87,471 @@ def test_parse_positions_to_pairs_estimated_positions() -> None:
         overlap_threshold_percentage=overlap_threshold_percentage)
     pairs_graph = nx.from_edgelist(pairs_df[["image_index1","image_index2"]].values)
     assert nx.is_isomorphic(pairs_graph,nx.from_edgelist(edges)) 
- 
\ No newline at end of file
+ 
+def test_parse_positions_to_pairs_matches_exhaustive_search() -> None:
+    np.random.seed(0)
+    image_shape = (100,120)
+    overlap_threshold_percentage = 5
+    grid = np.stack(np.meshgrid(np.arange(8),np.arange(9),indexing="ij"),axis=-1).reshape(-1,2)
+    estimated_positions = grid * np.array([80,100]) + np.random.uniform(-5,5,size=grid.shape)
+
+    pairs_df = _parse_positions_to_pairs(image_shape,
+        estimated_positions=estimated_positions,
+        overlap_threshold_percentage=overlap_threshold_percentage)
+    expected = [(j1,j2) for (j1,pos1),(j2,pos2) in combinations(enumerate(estimated_positions),2)
+        if _calc_overlap_area_ratio(image_shape,pos2-pos1) > overlap_threshold_percentage/100]
+    assert [tuple(p) for p in pairs_df[["image_index1","image_index2"]].values] == expected
+
+    pairs_df = _parse_positions_to_pairs(image_shape,grid,estimated_positions)
+    expected = [(j1,j2) for (j1,ind1),(j2,ind2) in combinations(enumerate(grid),2)
+        if np.sum(np.abs(ind1-ind2)) == 1]
+    assert [tuple(p) for p in pairs_df[["image_index1","image_index2"]].values] == expected
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    assert np.array_equal(pairs_df[["estimated_displacement_y","estimated_displacement_x"]].values,
+        estimated_positions[pair_indices[:,1]]-estimated_positions[pair_indices[:,0]])
+
+def _make_mosaic(grid_shape=(3,3), tile_shape=(64,80), step=(50,60), jitter=3, seed=0):
+    """Cut overlapping tiles from a smooth random image and return the tiles with their positions."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in grid_shape],indexing="ij"),axis=-1).reshape(-1,len(grid_shape))
+    positions = grid * np.array(step) + rng.integers(0,jitter+1,size=grid.shape)
+    whole_shape = positions.max(axis=0) + np.array(tile_shape) + 1
+    whole = ndi.gaussian_filter(rng.random(whole_shape),1)
+    tiles = np.array([whole[tuple(slice(p,p+s) for p,s in zip(pos,tile_shape))] for pos in positions])
+    return tiles, grid, positions
+
+def test_phase_correlation_estimator() -> None:
+    tiles, grid, positions = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+
+    # without the suppression, the split peaks keep their neighboring pixels as candidates
+    estimator = PhaseCorrelationEstimator(peak_suppression_radius=0)
+    candidate_displacement, extra_fields = estimator(tiles,pair_indices,None,20)
+    assert np.array_equal(candidate_displacement,expected)
+    assert np.all(extra_fields["ncc"] > 0)
+    # each tile spectrum is computed only once
+    assert estimator._spectrum_cache.misses == len(tiles)
+
+    estimated_displacement = expected + np.array([5,-5])
+    candidate_displacement, _ = estimator(tiles,pair_indices,estimated_displacement,10)
+    assert np.array_equal(candidate_displacement,expected)
+
+def test_phase_correlation_estimator_without_candidates() -> None:
+    tiles, grid, _ = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    # no displacement within the allowed error leaves an overlap
+    estimated_displacement = np.tile(np.array(tiles.shape[1:]) + 3, (len(pair_indices),1)).astype(np.float64)
+
+    candidate_displacement, extra_fields = PhaseCorrelationEstimator()(tiles,pair_indices,estimated_displacement,2)
+    assert np.all(np.isnan(candidate_displacement))
+    assert np.all(np.isnan(extra_fields["ncc"]))
+
+def test_phase_correlation_estimator_rejects_candidates_beyond_tiles(monkeypatch) -> None:
+    tiles, grid, _ = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    # the interpretations beyond the tile on two axes must not count as overlapping
+    peak_interpretations = candidate_estimator_module._peak_interpretations
+    monkeypatch.setattr(candidate_estimator_module, "_peak_interpretations",
+        lambda peak, shape: peak_interpretations(peak, shape) - 2 * np.array(shape))
+
+    candidate_displacement, _ = PhaseCorrelationEstimator()(tiles,pair_indices,None,20)
+    assert np.all(np.isnan(candidate_displacement))
+
+def test_phase_correlation_estimator_crop_to_overlap() -> None:
+    tiles, grid, positions = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    estimated_displacement = expected + np.array([2,-3])
+
+    estimator = PhaseCorrelationEstimator(crop_to_overlap=True)
+    candidate_displacement, _ = estimator(tiles,pair_indices,estimated_displacement,5)
+    assert np.array_equal(candidate_displacement,expected)
+
+def test_subpixel_phase_correlation() -> None:
+    rng = np.random.default_rng(0)
+    whole = ndi.gaussian_filter(rng.random((128,160)),0.5)
+    shifts = [np.array([3.3,-5.6]), np.array([-10.45,2.72])]
+    images = [whole] + [np.fft.ifftn(ndi.fourier_shift(np.fft.fftn(whole),shift)).real for shift in shifts]
+    tiles = np.array([image[30:94,40:121] for image in images])
+    pair_indices = np.array([(0,1),(0,2)])
+    # the second tile is shifted by `shift`, so that it is placed at -shift
+    expected = -np.array(shifts)
+
+    spectra = calc_real_spectra(tiles, np.float64)
+    peak, value = refine_peak_subpixel(spectra[0], spectra[1], tiles.shape[1:], np.round(expected[0]), 100)
+    assert np.allclose(peak, expected[0], atol=0.05)
+    assert value > 0.5
+
+    estimator = PhaseCorrelationEstimator(upsample_factor=20)
+    candidate_displacement, _ = estimator(tiles,pair_indices,None,20)
+    assert np.allclose(candidate_displacement,expected,atol=0.05)
+    assert not np.allclose(candidate_displacement,np.round(candidate_displacement))
+
+def test_stitch_subpixel() -> None:
+    rng = np.random.default_rng(0)
+    spectrum = np.fft.fftn(ndi.gaussian_filter(rng.random((200,260)),0.5))
+    grid = np.stack(np.meshgrid(np.arange(2),np.arange(3),indexing="ij"),axis=-1).reshape(-1,2)
+    positions = grid * np.array([40,50]) + rng.uniform(0,3,size=grid.shape) + 10
+    tiles = []
+    for position in positions:
+        integer = np.floor(position).astype(np.int64)
+        shifted = np.fft.ifftn(ndi.fourier_shift(spectrum,integer - position)).real
+        tiles.append(shifted[integer[0]:integer[0]+64,integer[1]:integer[1]+80])
+    tiles = np.array(tiles)
+
+    positions_df, pairs_df = Stitcher(candidate_estimator_params={"upsample_factor":20}).stitch(tiles,grid)
+    stitched = positions_df[["y_pos","x_pos"]].values
+    assert np.allclose(stitched - stitched[0], positions - positions[0], atol=0.1)
+    local_optimized = pairs_df[["local_optimized_displacement_y","local_optimized_displacement_x"]].values
+    assert not np.allclose(local_optimized, np.round(local_optimized))
+
+def test_pyramid_pair_stages() -> None:
+    tiles, grid, positions = _make_mosaic(tile_shape=(128,160), step=(100,120), jitter=6)
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    estimated_displacement = (expected + np.array([12,-10])).astype(np.float64)
+
+    stitcher = Stitcher(pyramid_levels=2, pair_optimizer_params={"search":"exhaustive"})
+    pyramid = build_tile_pyramid(as_tile_source(tiles), stitcher.pyramid_levels)
+    assert pyramid[2].shape == (len(tiles),32,40)
+    candidate_displacement, _ = stitcher._run_pyramid_stage(
+        stitcher._candidate_estimator_obj, pyramid, pair_indices, [estimated_displacement], 20)
+    assert np.array_equal(candidate_displacement,expected)
+
+    local_optimized_displacement, extra_fields = stitcher._run_pyramid_stage(
+        stitcher._pair_optimizer_obj, pyramid, pair_indices, [estimated_displacement, estimated_displacement], 20)
+    assert np.array_equal(local_optimized_displacement,expected)
+    assert np.all(extra_fields["ncc"] > 0)
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_calc_phase_correlation_matrices(dtype) -> None:
+    rng = np.random.default_rng(0)
+    images1 = rng.random((4,30,41))
+    images2 = rng.random((4,30,41))
+    pcms = calc_phase_correlation_matrices(images1,images2,dtype,workers=2)
+    assert pcms.dtype == dtype
+    for pcm, image1, image2 in zip(pcms,images1,images2):
+        assert np.allclose(pcm,calc_phase_correlation_matrix(image1,image2),atol=1e-5)
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_parallel_pair_stage_matches_serial(executor) -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(4,4))
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    serial = Stitcher()
+    parallel = Stitcher(n_jobs=2, executor=executor, chunk_size=5)
+    expected, expected_fields = serial._run_pair_stage(
+        serial._candidate_estimator_obj, tiles, pair_indices, [None], 20)
+    result, result_fields = parallel._run_pair_stage(
+        parallel._candidate_estimator_obj, tiles, pair_indices, [None], 20)
+    assert np.array_equal(result, expected)
+    assert np.array_equal(result_fields["ncc"], expected_fields["ncc"])
+
+def test_find_pairs_incrementally() -> None:
+    np.random.seed(0)
+    image_shape = (100,120)
+    grid = np.stack(np.meshgrid(np.arange(5),np.arange(6),indexing="ij"),axis=-1).reshape(-1,2)
+    estimated_positions = grid * np.array([80,100]) + np.random.uniform(-5,5,size=grid.shape)
+    for tile_indices in [grid, None]:
+        pairs_df = _find_pairs(image_shape,tile_indices,estimated_positions)
+        expected = set(map(tuple,pairs_df[["image_index1","image_index2"]].values))
+        found = set()
+        for start in range(0,len(grid),7):
+            stop = min(start+7,len(grid))
+            new_pairs_df = _find_pairs(image_shape,
+                None if tile_indices is None else tile_indices[:stop],
+                estimated_positions[:stop],start=start)
+            new_pairs = set(map(tuple,new_pairs_df[["image_index1","image_index2"]].values))
+            assert all(j2 >= start for _, j2 in new_pairs)
+            assert not found & new_pairs
+            found |= new_pairs
+        assert found == expected
+
+def test_incremental_stitcher_keeps_previous_pairs() -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(4,3))
+    stitcher = IncrementalStitcher(allowed_error=10)
+    estimated_positions = grid * np.array([50,60])
+    stitcher.add_tiles(tiles[:6],estimated_positions=estimated_positions[:6])
+    previous_pairs_df = stitcher.pairs_df.copy()
+    new_pairs_df = stitcher.add_tiles(tiles[6:],estimated_positions=estimated_positions[6:])
+    assert len(new_pairs_df) > 0
+    # the previous pairs are not optimized again, so their interpolation is kept
+    pd.testing.assert_frame_equal(stitcher.pairs_df.iloc[:len(previous_pairs_df)],previous_pairs_df)
+    pair_indices = stitcher.pairs_df[["image_index1","image_index2"]].values
+    local_optimized_displacement = stitcher.pairs_df[["local_optimized_displacement_y","local_optimized_displacement_x"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    # the diagonal pairs overlap only at the corners
+    adjacent = np.sum(np.abs(np.diff(estimated_positions[pair_indices],axis=1)[:,0]) > 0,axis=1) == 1
+    assert np.array_equal(local_optimized_displacement[adjacent],expected[adjacent])
+    positions_df = stitcher.current_positions()
+    assert len(positions_df) == len(tiles) and not positions_df.isna().any().any()
+
+def test_find_top_peaks() -> None:
+    matrix = np.random.default_rng(0).random((20,30)) * 0.1
+    matrix[5,7] = 3
+    matrix[5,8] = 2.5 # shoulder of the highest peak
+    matrix[19,0] = 2  # wraps around to the neighbor of (0,29)
+    matrix[0,29] = 1
+    matrix[12,15] = 1.5
+    peaks = find_top_peaks(matrix,3)
+    assert np.array_equal(peaks,[(5,7),(19,0),(12,15)])
+    assert np.array_equal(find_top_peaks(matrix,2,suppression_radius=0),[(5,7),(5,8)])
+    # the window wraps around the periodic boundary
+    peaks = find_top_peaks(matrix,5,window=(np.array([-3,-5]),np.array([2,3])))
+    assert np.array_equal(peaks[0],(19,0))
+    assert not np.any(np.all(peaks == (0,29),axis=1))
+    assert np.all(np.isin(peaks[:,0],[17,18,19,0,1,2])) and np.all(np.isin(peaks[:,1],[25,26,27,28,29,0,1,2,3]))
+    peaks = find_top_peaks(matrix,5,window=(np.array([10,10]),np.array([14,20])))
+    assert np.array_equal(peaks[0],(12,15))
+    assert len(peaks) == 5
+
+def test_phase_correlation_estimator_distinct_peaks(monkeypatch) -> None:
+    tiles, grid, positions = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    found = []
+    def recording_find_top_peaks(matrix, *args, **kwargs):
+        peaks = find_top_peaks(matrix, *args, **kwargs)
+        found.append((peaks, matrix.shape))
+        return peaks
+    monkeypatch.setattr(candidate_estimator_module, "find_top_peaks", recording_find_top_peaks)
+
+    candidate_displacement, _ = PhaseCorrelationEstimator()(tiles,pair_indices,None,20)
+    # the pixel next to a split peak is left to the pair optimizer
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    assert np.all(np.abs(candidate_displacement - expected) <= 1)
+    # no two candidates of a pair are the neighboring pixels of the same peak
+    for peaks, shape in found:
+        for peak1, peak2 in combinations(peaks, 2):
+            distance = np.abs(peak1 - peak2)
+            assert np.max(np.minimum(distance, np.array(shape) - distance)) > 1
+
+def test_summed_area_table_ncc() -> None:
+    rng = np.random.default_rng(0)
+    image1 = rng.random((20,30))
+    image2 = rng.random((20,30))
+    tile1 = SummedAreaTile(image1)
+    tile2 = SummedAreaTile(image2)
+    displacements = np.array([(0,0),(3,-5),(-19,29),(10,12),(20,0)])
+    nccs = calc_overlap_nccs(tile1,tile2,displacements)
+    assert nccs[-1] == -np.inf
+    for displacement, ncc in zip(displacements[:-1],nccs):
+        slices1, slices2 = calc_overlap_slices(image1.shape,displacement)
+        assert np.isclose(sum_from_summed_area_table(tile1.sat,slices1),image1[slices1].sum())
+        assert np.isclose(ncc,calc_normalized_cross_correlation(image1[slices1],image2[slices2]))
+
+    tiles = {0:tile1,1:tile2,2:SummedAreaTile(image1[::-1])}
+    pair_indices = np.array([(0,1),(1,2)])
+    candidate_pairs = np.array([1,0,1,0])
+    scores = score_overlap_candidates(lambda j: (tiles[pair_indices[j,0]],tiles[pair_indices[j,1]]),
+                                      candidate_pairs,displacements[:4])
+    assert np.allclose(scores[[1,3]],calc_overlap_nccs(tile1,tile2,displacements[[1,3]]))
+    assert np.allclose(scores[[0,2]],calc_overlap_nccs(tile2,tiles[2],displacements[[0,2]]))
+
+    # the regions containing the overlaps give the same values
+    region1 = SummedAreaTile(image1[2:,:12],(2,0))
+    region2 = SummedAreaTile(image2[:18,4:],(0,4))
+    region_displacements = np.array([(3,-19),(2,-20),(4,-18)])
+    assert np.allclose(calc_overlap_nccs(region1,region2,region_displacements,image1.shape),
+                       calc_overlap_nccs(tile1,tile2,region_displacements))
+    with pytest.raises(ValueError):
+        calc_overlap_nccs(region1,region2,np.array([(0,0)]),image1.shape)
+
+@pytest.mark.parametrize("tile_shape", [(20,30), (120,140)])
+def test_score_overlap_candidates_batches(tile_shape) -> None:
+    rng = np.random.default_rng(0)
+    tiles = [SummedAreaTile(rng.random(tile_shape).astype(np.float32)) for _ in range(4)]
+    # the pairs share the overlap shapes of the candidates
+    displacements = np.tile(np.array([(3,-5),(-4,6),(3,-5),(5,2)]), (3,1))
+    candidate_pairs = np.repeat([2,0,1], 4)
+    requested = []
+    def get_tiles(j):
+        requested.append(j)
+        return tiles[j], tiles[j+1]
+
+    scores = score_overlap_candidates(get_tiles, candidate_pairs, displacements)
+    assert sorted(requested) == [0,1,2]
+    for j, displacement, score in zip(candidate_pairs, displacements, scores):
+        slices1, slices2 = calc_overlap_slices(tile_shape, displacement)
+        assert np.isclose(score, calc_normalized_cross_correlation(tiles[j].image[slices1], tiles[j+1].image[slices2]))
+
+def test_three_dimensional_pair_stages() -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(1,2,2), tile_shape=(12,40,48), step=(0,30,36))
+    assert np.all(positions[:,0] <= 3)
+    assert np.isclose(calc_normalized_cross_correlation(tiles[0],tiles[0]),
+                      calc_normalized_cross_correlation(tiles[0].ravel(),tiles[0].ravel()))
+    pcm = calc_phase_correlation_matrix(tiles[0],tiles[1])
+    assert pcm.shape == tiles.shape[1:]
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    estimated_displacement = (expected + np.array([1,2,-2])).astype(np.float64)
+
+    for crop_to_overlap in [False, True]:
+        estimator = PhaseCorrelationEstimator(crop_to_overlap=crop_to_overlap, peak_suppression_radius=0)
+        candidate_displacement, _ = estimator(tiles.astype(np.float32),pair_indices,estimated_displacement,5)
+        assert np.array_equal(candidate_displacement,expected)
+
+    optimizer = NormalizedClossCorrelationOptimizer(search="exhaustive")
+    local_optimized_displacement, extra_fields = optimizer(
+        tiles.astype(np.float32),pair_indices,estimated_displacement,estimated_displacement,3)
+    assert np.array_equal(local_optimized_displacement,expected)
+
+@pytest.mark.parametrize("search", ["hill_climb", "exhaustive"])
+def test_normalized_cross_correlation_optimizer(search) -> None:
+    tiles, grid, positions = _make_mosaic()
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:],grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    expected = positions[pair_indices[:,1]] - positions[pair_indices[:,0]]
+    initial_displacement = (expected + np.random.default_rng(0).integers(-2,3,size=expected.shape)).astype(float)
+    initial_displacement[0] = np.nan
+
+    optimizer = NormalizedClossCorrelationOptimizer(search=search)
+    optimized_displacement, extra_fields = optimizer(tiles,pair_indices,initial_displacement,None,3)
+    assert np.all(np.isnan(optimized_displacement[0]))
+    assert np.array_equal(optimized_displacement[1:],expected[1:])
+    assert np.all(extra_fields["ncc"][1:] > 0)
+
+def test_elliptic_envelope_interpolator() -> None:
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(np.arange(6),np.arange(6),indexing="ij"),axis=-1).reshape(-1,2)
+    pairs_df = _parse_positions_to_pairs((100,120),grid)
+    pair_indices = pairs_df[["image_index1","image_index2"]].values
+    index_displacement = grid[pair_indices[:,1]] - grid[pair_indices[:,0]]
+    stage_means = {(0,1):np.array([3,110]),(1,0):np.array([92,-4])}
+    true_displacement = np.array([stage_means[tuple(d)] for d in index_displacement]) + rng.integers(-1,2,size=(len(pairs_df),2))
+    candidate_displacement = true_displacement.astype(np.float64)
+    outliers = np.array([0,7,20])
+    candidate_displacement[outliers] += np.array([[30,-40],[-25,0],[0,50]])
+    candidate_displacement[11] = np.nan
+
+    interpolator = EllipticEnvelopeInterpolator()
+    images = np.zeros((len(grid),100,120))
+    interpolated_displacement, extra_fields = interpolator(
+        images,pair_indices,candidate_displacement,None,20,index_displacement=index_displacement)
+    assert np.array_equal(np.nonzero(extra_fields["outlier"])[0],[0,7,11,20])
+    inliers = ~extra_fields["outlier"]
+    assert np.array_equal(interpolated_displacement[inliers],candidate_displacement[inliers])
+    assert np.all(np.abs(interpolated_displacement[~inliers] - true_displacement[~inliers]) <= 2)
+    assert np.all(extra_fields["search_radius"] <= 6)
+    assert np.all(np.abs(interpolated_displacement - true_displacement) <= extra_fields["search_radius"][:,np.newaxis])
+
+    # without tile indices, the pairs are grouped by the estimated displacements
+    estimated_displacement = np.array([stage_means[tuple(d)] for d in index_displacement]) + np.array([2,-1])
+    _, extra_fields2 = interpolator(images,pair_indices,candidate_displacement,estimated_displacement,20)
+    assert np.array_equal(extra_fields2["outlier"],extra_fields["outlier"])
+
+@pytest.mark.parametrize("n_samples", [9, 20, 50])
+def test_elliptic_envelope_interpolator_false_outlier_rate(n_samples) -> None:
+    rng = np.random.default_rng(n_samples)
+    interpolator = EllipticEnvelopeInterpolator()
+    images = np.zeros((2,100,120))
+    pair_indices = np.zeros((n_samples,2),dtype=np.int64)
+    index_displacement = np.tile([0.,1.],(n_samples,1))
+    rates = []
+    for _ in range(200):
+        candidate_displacement = rng.normal(0,4,size=(n_samples,2)) + np.array([3,110])
+        _, extra_fields = interpolator(
+            images,pair_indices,candidate_displacement,None,100,index_displacement=index_displacement)
+        rates.append(np.mean(extra_fields["outlier"]))
+    # the clean Gaussian groups are flagged at about the nominal rate of 1 - outlier_quantile
+    assert np.mean(rates) < 0.02
+
+def test_stitch() -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(4,4))
+    positions_df, pairs_df = Stitcher().stitch(tiles,grid)
+    stitched = positions_df[["y_pos","x_pos"]].values
+    assert np.allclose(stitched - stitched[0], positions - positions[0])
+    assert {"outlier","search_radius","local_optimized_ncc"} <= set(pairs_df.columns)
+
+def test_stitch_with_result_store(tmp_path, monkeypatch) -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(3,4))
+    store_path = str(tmp_path / "pairs.sqlite")
+    positions_df, pairs_df = Stitcher(result_store_path=store_path).stitch(tiles,grid)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the stored pairs must not be recomputed.")
+    monkeypatch.setattr(PhaseCorrelationEstimator, "__call__", fail)
+    monkeypatch.setattr(NormalizedClossCorrelationOptimizer, "__call__", fail)
+    stitcher = Stitcher(result_store_path=store_path, global_optimizer="maximum_spanning_tree")
+    positions_df2, pairs_df2 = stitcher.stitch(tiles,grid)
+    pd.testing.assert_frame_equal(pairs_df2, pairs_df)
+    stitched = positions_df2[["y_pos","x_pos"]].values
+    assert np.allclose(stitched - stitched[0], positions - positions[0])
+
+    # the changed tiles are recomputed
+    with pytest.raises(AssertionError):
+        stitcher.stitch(tiles[:, ::-1], grid)
+
+@pytest.mark.parametrize("crop_to_overlap", [False, True])
+def test_stitch_with_result_store_and_estimated_positions(tmp_path, monkeypatch, crop_to_overlap) -> None:
+    tiles, grid, positions = _make_mosaic(grid_shape=(3,3))
+    estimated_positions = grid * np.array([50,60])
+    store_path = str(tmp_path / "pairs.sqlite")
+    stitcher = Stitcher(result_store_path=store_path, global_optimizer="maximum_spanning_tree",
+                        candidate_estimator_params={"crop_to_overlap":crop_to_overlap})
+    positions_df, pairs_df = stitcher.stitch(tiles,estimated_positions=estimated_positions)
+    stitched = positions_df[["y_pos","x_pos"]].values
+    assert np.allclose(stitched - stitched[0], positions - positions[0])
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the stored pairs must not be recomputed.")
+    monkeypatch.setattr(PhaseCorrelationEstimator, "__call__", fail)
+    monkeypatch.setattr(NormalizedClossCorrelationOptimizer, "__call__", fail)
+    positions_df2, pairs_df2 = stitcher.stitch(tiles,estimated_positions=estimated_positions)
+    pd.testing.assert_frame_equal(pairs_df2, pairs_df)
+
+def test_time_series_stitcher(monkeypatch) -> None:
+    grid_shape, tile_shape, step = (3,3), (64,80), (50,60)
+    rng = np.random.default_rng(1)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in grid_shape],indexing="ij"),axis=-1).reshape(-1,2)
+    positions = grid * np.array(step) + rng.integers(0,4,size=grid.shape) + 5
+    whole = ndi.gaussian_filter(rng.random(positions.max(axis=0) + np.array(tile_shape) + 10),1)
+
+    n_searched = []
+    run_pyramid_stage = Stitcher._run_pyramid_stage
+    def counting_run_pyramid_stage(self, stage, pyramid, pair_indices, *args, **kwargs):
+        if stage is self._candidate_estimator_obj:
+            n_searched.append(len(pair_indices))
+        return run_pyramid_stage(self, stage, pyramid, pair_indices, *args, **kwargs)
+    monkeypatch.setattr(Stitcher, "_run_pyramid_stage", counting_run_pyramid_stage)
+    n_interpolated = []
+    interpolate = EllipticEnvelopeInterpolator.__call__
+    def counting_interpolate(self, images, pair_indices, *args, **kwargs):
+        n_interpolated.append(len(pair_indices))
+        return interpolate(self, images, pair_indices, *args, **kwargs)
+    monkeypatch.setattr(EllipticEnvelopeInterpolator, "__call__", counting_interpolate)
+
+    stitcher = TimeSeriesStitcher(tile_indices=grid, tracking_allowed_error=3)
+    assert stitcher.stitcher._candidate_estimator_obj.crop_to_overlap
+    for frame in range(4):
+        positions = positions + rng.integers(-1,2,size=positions.shape)
+        tiles = np.array([whole[tuple(slice(p,p+s) for p,s in zip(pos,tile_shape))] for pos in positions])
+        if frame == 3:
+            tiles[4] = rng.random(tile_shape)
+        n_searched.clear()
+        n_interpolated.clear()
+        positions_df, pairs_df = stitcher.add_frame(tiles)
+        if frame == 0:
+            assert not pairs_df["tracked"].any()
+        elif frame < 3:
+            assert pairs_df["tracked"].all()
+            assert n_searched == [len(pairs_df)]
+        else:
+            # only the pairs of the corrupted tile are searched again
+            corrupted = np.any(pairs_df[["image_index1","image_index2"]].values == 4, axis=1)
+            assert not pairs_df["tracked"][corrupted].any()
+            assert pairs_df["tracked"][~corrupted].all()
+            assert n_searched == [len(pairs_df), np.sum(corrupted)]
+            # the searched again pairs are interpolated with the model fitted on all the pairs
+            assert n_interpolated == [len(pairs_df), len(pairs_df)]
+        if frame < 3:
+            stitched = positions_df[["y_pos","x_pos"]].values
+            assert np.allclose(stitched - stitched[0], positions - positions[0])
+    assert stitcher.n_frames == 4
@@ -0,0 +1,188 @@
+"""Test cases for the tile sources."""
+import collections
+import pickle
+from os import path
+
+import numpy as np
+import pytest
+
+from microtailor import ArrayTileSource, CallableTileSource, Stitcher
+from microtailor import _stitcher as stitcher_module
+from microtailor._stitcher import _parse_positions_to_pairs
+from microtailor._scheduler import order_pairs
+from microtailor._tile_source import CachedTileSource, PrefetchingTileSource, as_tile_source, build_tile_pyramid
+
+
+def test_array_tile_source_memmap(tmp_path) -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.integers(0, 1000, size=(5, 20, 30)).astype(np.uint16)
+    filename = path.join(tmp_path, "tiles.dat")
+    memmap = np.memmap(filename, dtype=np.uint16, mode="w+", shape=tiles.shape)
+    memmap[:] = tiles
+    memmap.flush()
+
+    source = as_tile_source(np.memmap(filename, dtype=np.uint16, mode="r", shape=tiles.shape))
+    assert isinstance(source, ArrayTileSource)
+    assert source.shape == tiles.shape
+    assert source.tile_nbytes == 20 * 30 * 2
+    assert np.array_equal(source[3], tiles[3])
+    assert np.array_equal(source.read_region(2, (slice(5, 10), slice(0, 4))), tiles[2, 5:10, :4])
+
+
+def test_callable_tile_source() -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.random((4, 10, 12))
+    loaded = []
+
+    def loader(i):
+        loaded.append(i)
+        return tiles[i]
+
+    source = as_tile_source(loader, n_tiles=4)
+    assert isinstance(source, CallableTileSource)
+    assert source.shape == (4, 10, 12)
+    assert source.dtype == tiles.dtype
+    assert np.array_equal(source[2], tiles[2])
+    assert loaded == [0, 2]
+    with pytest.raises(IndexError):
+        source[4]
+    with pytest.raises(ValueError):
+        as_tile_source(loader)
+
+
+def test_candidate_estimation_with_lazy_source() -> None:
+    rng = np.random.default_rng(0)
+    whole = rng.random((110, 160))
+    positions = np.array([(0, 0), (0, 55), (40, 1), (41, 54)])
+    grid = np.array([(0, 0), (0, 1), (1, 0), (1, 1)])
+    tiles = np.array([whole[y:y + 60, x:x + 80] for y, x in positions])
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:], grid)
+    pair_indices = pairs_df[["image_index1", "image_index2"]].values
+
+    stitcher = Stitcher()
+    expected, _ = stitcher._run_pair_stage(stitcher._candidate_estimator_obj, tiles, pair_indices, [None], 20)
+    source = CallableTileSource(lambda i: tiles[i], len(tiles))
+    result, _ = stitcher._run_pair_stage(stitcher._candidate_estimator_obj, source, pair_indices, [None], 20)
+    assert np.array_equal(result, expected)
+    assert np.array_equal(result, positions[pair_indices[:, 1]] - positions[pair_indices[:, 0]])
+
+
+@pytest.mark.parametrize("method", ["snake", "hilbert"])
+def test_locality_ordered_pairs_read_tiles_once(method) -> None:
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(np.arange(6), np.arange(6), indexing="ij"), axis=-1).reshape(-1, 2)
+    tiles = rng.random((len(grid), 16, 16))
+    loaded = []
+
+    def loader(i):
+        loaded.append(i)
+        return tiles[i]
+
+    pairs_df = _parse_positions_to_pairs(tiles.shape[1:], grid)
+    pair_indices = pairs_df[["image_index1", "image_index2"]].values
+    order = order_pairs(pair_indices, grid, method)
+    assert sorted(order) == list(range(len(pair_indices)))
+
+    source = CachedTileSource(CallableTileSource(loader, len(tiles), (16, 16), tiles.dtype), 16 * tiles[0].nbytes)
+    for index1, index2 in pair_indices[order]:
+        source[index1]
+        source[index2]
+    assert set(loaded) == set(range(len(tiles)))
+    if method == "snake":
+        assert len(loaded) == len(tiles)
+    else:
+        assert len(loaded) <= 1.2 * len(tiles)
+
+
+def test_prefetching_tile_source() -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.random((10, 8, 8))
+    tile_order = [3, 1, 4, 0, 5, 9, 2, 6, 8, 7]
+    source = CallableTileSource(lambda i: tiles[i], len(tiles), (8, 8), tiles.dtype)
+    with PrefetchingTileSource(source, tile_order, depth=3, n_threads=2) as prefetching:
+        for index in tile_order:
+            assert np.array_equal(prefetching[index], tiles[index])
+        stats = prefetching.stats
+    assert stats.n_requests == len(tiles)
+    assert stats.n_ready + stats.n_waited + stats.n_sync_reads == len(tiles)
+    # only the first tile is not prefetched
+    assert stats.n_sync_reads == 1
+    assert stats.wait_seconds >= 0
+
+
+def test_tile_pyramid_downsamples_each_tile_once() -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.random((3, 17, 24))
+    loaded = []
+
+    def loader(i):
+        loaded.append(i)
+        return tiles[i]
+
+    pyramid = build_tile_pyramid(CallableTileSource(loader, len(tiles), (17, 24), tiles.dtype), 2)
+    assert [level.tile_shape for level in pyramid] == [(17, 24), (8, 12), (4, 6)]
+    assert np.allclose(pyramid[1][1], tiles[1][:16].reshape(8, 2, 12, 2).mean(axis=(1, 3)))
+    assert np.allclose(pyramid[2][1], tiles[1][:16].reshape(4, 4, 6, 4).mean(axis=(1, 3)))
+    for _ in range(2):
+        for level in pyramid[1:]:
+            for i in range(len(tiles)):
+                level[i]
+    assert sorted(loaded) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("view", [
+    lambda m: m,
+    lambda m: m[2:],
+    lambda m: m[1:4, 3:, ::-1],
+    lambda m: m[::2, :, 5:25:3],
+])
+def test_array_tile_source_memmap_pickle(tmp_path, view) -> None:
+    tiles = np.arange(6 * 20 * 30, dtype=np.uint16).reshape(6, 20, 30)
+    filename = path.join(tmp_path, "tiles.npy")
+    np.save(filename, tiles)
+
+    array = view(np.load(filename, mmap_mode="r"))
+    restored = pickle.loads(pickle.dumps(ArrayTileSource(array)))
+    assert restored.shape == array.shape
+    for i in range(len(restored)):
+        assert np.array_equal(restored[i], view(tiles)[i])
+    # the file is reopened instead of copying its contents
+    assert len(pickle.dumps(ArrayTileSource(array))) < tiles.nbytes // 10
+
+
+def test_prefetching_without_cache_is_bounded(monkeypatch) -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.random((9, 64, 80))
+    grid = np.stack(np.meshgrid(np.arange(3), np.arange(3), indexing="ij"), axis=-1).reshape(-1, 2)
+    cached_bytes = []
+
+    class RecordingTileSource(PrefetchingTileSource):
+        def __getitem__(self, index):
+            tile = super().__getitem__(index)
+            cached_bytes.append(self.cache.total_bytes)
+            return tile
+
+    monkeypatch.setattr(stitcher_module, "PrefetchingTileSource", RecordingTileSource)
+    Stitcher(tile_cache_bytes=0, prefetch_depth=2).stitch(tiles, grid)
+    assert cached_bytes
+    # only the prefetched tiles and the tile in use are kept
+    assert max(cached_bytes) <= 3 * tiles[0].nbytes
+
+
+def test_tile_pyramid_without_tile_cache() -> None:
+    rng = np.random.default_rng(0)
+    tiles = rng.random((9, 64, 80))
+    grid = np.stack(np.meshgrid(np.arange(3), np.arange(3), indexing="ij"), axis=-1).reshape(-1, 2)
+
+    def count_reads(pyramid_levels):
+        loaded = []
+        def loader(i):
+            loaded.append(i)
+            return tiles[i]
+        source = CallableTileSource(loader, len(tiles), (64, 80), tiles.dtype)
+        Stitcher(tile_cache_bytes=0, pyramid_levels=pyramid_levels).stitch(source, grid)
+        return loaded
+
+    # the downsampled levels read each base tile once, independent of the raw-tile cache
+    extra_reads = collections.Counter(count_reads(2)) - collections.Counter(count_reads(0))
+    assert extra_reads == collections.Counter(range(len(tiles)))